@@ -22,43 +22,109 @@ import cProfile
 import pstats
 from pstats import SortKey
 
+from hashing import hash_file, hash_file_ends, hash_file_range, new_hasher, DEFAULT_BLOCK_SIZE, DEFAULT_PARTIAL_SIZE
+from indexes import update_minhash, update_fingerprint
+
 
 	
 
-def get_file_checksum(target_dict, checksum_method = "md5"):
+def get_file_checksum(target_dict, checksum_method = "md5", block_size = DEFAULT_BLOCK_SIZE, extra_checksum_methods = (), use_fadvise = True, rate_limiters = ()):
 	"""calculate checksum of file
 	
-	arguments: path_to_file - string with path to file
-		checksum_method - string with checksum algorhytm, currently supperted: "md5" or "sha512"
-	returns: tuple of path and checksum, both as strings
+	arguments: target_dict - dict with key "full_path" - string with path to file
+		checksum_method - string with checksum algorhytm, one of hashing.CHECKSUM_ALGORITHMS keys, i.e. "md5", "sha512", "blake2b"
+		block_size - size of one read in bytes, file is read into reusable buffer (or via mmap for large files)
+		extra_checksum_methods - list of additional algorhytms, all checksums are calculated in one read of file
+		use_fadvise - read file with posix_fadvise hints and drop its pages from page cache after hashing
+		rate_limiters - objects with consume(n) method, shared by workers, each block read waits for all of them
+	returns: target_dict with added checksum (string, or None if file does not exist), checksum_algorithm,
+		extra_checksums (dict algorhytm: checksum), date_start and date_end
 	"""
 	
 	path_to_file = target_dict["full_path"]
-	blocksize = 65536
 	target_dict["checksum"] = None
+	target_dict["checksum_algorithm"] = checksum_method
+	target_dict["extra_checksums"] = {}
 	target_dict["date_start"] = datetime.datetime.now()
 	if not os.path.isfile(path_to_file):
 		target_dict["date_end"] = datetime.datetime.now()
 		return target_dict
-	f = open(path_to_file, "rb")
-	buf = f.read(blocksize)
-	if checksum_method == "sha512":
-		h = hashlib.sha512()
-	else:
-		h = hashlib.md5()
-		
-	while len(buf) > 0:
-		h.update(buf)
-		buf = f.read(blocksize)
-	result = h.hexdigest()
-	f.close()
-	target_dict["checksum"] = result
+	h = new_hasher(checksum_method)
+	extra_hashers = {method: new_hasher(method) for method in extra_checksum_methods if method != checksum_method}
+	hash_file(path_to_file, [h] + list(extra_hashers.values()), block_size = block_size, use_fadvise = use_fadvise, rate_limiters = rate_limiters)
+	target_dict["checksum"] = h.hexdigest()
+	target_dict["extra_checksums"] = {method: eh.hexdigest() for method, eh in extra_hashers.items()}
 	target_dict["date_end"] = datetime.datetime.now()
 	return target_dict
 
 
-def get_file_checksum_sha512(target_dict):
-	return get_file_checksum(target_dict, checksum_method = "sha512")
+def get_file_checksum_sha512(target_dict, block_size = DEFAULT_BLOCK_SIZE):
+	return get_file_checksum(target_dict, checksum_method = "sha512", block_size = block_size)
+
+
+def get_file_chunk_checksum(target_dict, checksum_method = "md5", block_size = DEFAULT_BLOCK_SIZE, use_fadvise = True, rate_limiters = ()):
+	"""calculate checksum of one chunk of file, for tree checksum of large file
+	
+	arguments: target_dict - dict with keys "full_path", "chunk_offset" and "chunk_length", as in hashing.TreeChecksumCollector.chunks
+	returns: target_dict with added chunk_checksum (string)
+	"""
+	h = new_hasher(checksum_method)
+	hash_file_range(target_dict["full_path"], [h], target_dict["chunk_offset"], target_dict["chunk_length"], block_size = block_size, use_fadvise = use_fadvise, rate_limiters = rate_limiters)
+	target_dict["chunk_checksum"] = h.hexdigest()
+	return target_dict
+
+
+def get_file_partial_checksum(target_dict, checksum_method = "md5", partial_size = DEFAULT_PARTIAL_SIZE, use_fadvise = True, rate_limiters = ()):
+	"""calculate checksum of first and last partial_size bytes of file, i.e. to find files that can not be equal
+	
+	arguments: target_dict - dict with key "full_path" - string with path to file
+	returns: target_dict with added partial_checksum (string, or None if file does not exist)
+	"""
+	target_dict["partial_checksum"] = None
+	if not os.path.isfile(target_dict["full_path"]):
+		return target_dict
+	h = new_hasher(checksum_method)
+	hash_file_ends(target_dict["full_path"], [h], partial_size = partial_size, use_fadvise = use_fadvise, rate_limiters = rate_limiters)
+	target_dict["partial_checksum"] = h.hexdigest()
+	return target_dict
+
+
+def scan_dir(path_to_dir, with_stat = False):
+	"""recursively walk dir using os.scandir, yielding files as they are found
+
+	arguments: path_to_dir - string with path to dir
+		with_stat - if True, st_dev, st_ino, st_size and st_mtime_ns of file are added to each dict
+	returns: generator of dicts {"full_path": path}, one for each regular file
+
+	Entry types are taken from DirEntry, so no additional stat is made for each path if with_stat is False.
+	Hidden entries (names starting with ".") are skipped, same as glob("**") did before.
+	"""
+	dirs_to_scan = [path_to_dir]
+	while len(dirs_to_scan) != 0:
+		current_dir = dirs_to_scan.pop()
+		try:
+			with os.scandir(current_dir) as it:
+				for entry in it:
+					if entry.name.startswith("."):
+						continue
+					if entry.is_dir():
+						dirs_to_scan.append(entry.path)
+					elif entry.is_file():
+						if not with_stat:
+							yield {"full_path": entry.path}
+							continue
+						try:
+							st = entry.stat()
+						except OSError as e:
+							logging.getLogger("duplicate_checker").error(f"scan_dir: could not stat file {entry.path}: {e}")
+							continue
+						yield {"full_path": entry.path,
+							"st_dev": st.st_dev,
+							"st_ino": st.st_ino,
+							"st_size": st.st_size,
+							"st_mtime_ns": st.st_mtime_ns}
+		except OSError as e:
+			logging.getLogger("duplicate_checker").error(f"scan_dir: could not scan dir {current_dir}: {e}")
 
 
 def normalize_path_to_dir(path_to_dir):
@@ -70,6 +136,34 @@ def normalize_path_to_dir(path_to_dir):
 		return path_to_dir
 
 
+def relative_path(full_path, path_to_dir):
+	"""path of file relative to dir"""
+	prefix = path_to_dir + "/"
+	if full_path.startswith(prefix):
+		return full_path[len(prefix):]
+	return os.path.relpath(full_path, path_to_dir)
+
+
+def update_dir_fingerprints(target_dir, added_files = (), removed_files = ()):
+	"""update fingerprint (by relative paths and checksums), content_fingerprint (by checksums only) and MinHash signature of dir
+	
+	arguments: target_dir - Directory
+		added_files, removed_files - lists of tuples (full_path, checksum_algorithm, checksum) of files
+	"""
+	if len(removed_files) != 0:
+		# signature can not be updated when files are removed, dir without signature is computed again when signature is needed
+		target_dir.minhash = None
+	elif target_dir.minhash is not None or target_dir.fingerprint is None:
+		target_dir.minhash = update_minhash(target_dir.minhash, [(a, c) for p, a, c in added_files if c is not None])
+	target_dir.fingerprint = update_fingerprint(target_dir.fingerprint,
+		[(relative_path(p, target_dir.full_path), a, c) for p, a, c in added_files],
+		[(relative_path(p, target_dir.full_path), a, c) for p, a, c in removed_files])
+	target_dir.content_fingerprint = update_fingerprint(target_dir.content_fingerprint,
+		[(a, c) for p, a, c in added_files],
+		[(a, c) for p, a, c in removed_files])
+	return target_dir
+
+
 def empty_on_None(ivar):
 	"""Jinja2 filter, converts None to empty string"""
 	if ivar is None:
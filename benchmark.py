@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+
+"""Benchmarks for DuplicateChecker internals. Benchmarks use temporary dir and temporary DB file.
+
+usage: benchmark.py NAME [NAME ...], where NAME is one of: inserts, engines, read_order, compare, rate_limit
+"""
+
+
+import sys
+import os
+import datetime
+import time
+import tempfile
+import shutil
+import logging
+import queue
+import random
+import tracemalloc
+import functools
+
+from managers import *
+from hashing import HASHING_ENGINES, READ_ORDER_STRATEGIES, MIB, create_hashing_engine, order_files
+
+
+
+_managers = None
+
+
+def init_managers(db_file):
+	"""create managers the same way DuplicateChecker does, but with temporary DB file"""
+	global _managers
+	if _managers is not None:
+		return _managers
+	logger = logging.getLogger("benchmark")
+	logger.addHandler(logging.NullHandler())
+	db_manager = DBManager(db_file = db_file, logger = logger.getChild("DBManager"))
+	file_manager = FileManager(logger = logger.getChild("FileManager"))
+	dir_manager = DirManager(logger = logger.getChild("DirManager"))
+	file_manager.set_DB_manager(db_manager)
+	dir_manager.set_DB_manager(db_manager)
+	_managers = (db_manager, file_manager, dir_manager)
+	return _managers
+
+
+def print_result(name, count, secs):
+	print(f"{name:<40} {count:>10} items {secs:>9.3f}s {count / secs if secs != 0 else 0.0:>12.0f} items/s")
+
+
+def benchmark_inserts(tmp_dir, num_files = 200000):
+	"""rows/sec of FileManager.create called per file vs FileManager.bulk_create"""
+	db_manager, file_manager, dir_manager = init_managers(os.path.join(tmp_dir, "benchmark.db"))
+	now = datetime.datetime.now()
+	file_dicts = [{"full_path": f"/benchmark/dir/file_{i}.raw",
+		"checksum": f"{i:0128x}",
+		"date_added": now,
+		"date_checked": now} for i in range(num_files)]
+
+	dir_per_object = dir_manager.create("/benchmark/per_object", date_added = now, name = "per_object")
+	t_start = time.time()
+	_session = file_manager.get_session()
+	for d in file_dicts:
+		file_manager.create(d["full_path"],
+			checksum = d["checksum"],
+			date_added = d["date_added"],
+			date_checked = d["date_checked"],
+			dir_id = dir_per_object.id,
+			session = _session)
+	file_manager.close_session(_session, commit = True)
+	print_result("inserts: FileManager.create per file", num_files, time.time() - t_start)
+
+	dir_bulk = dir_manager.create("/benchmark/bulk", date_added = now, name = "bulk")
+	BATCH_SIZE = 1000
+	t_start = time.time()
+	for i in range(0, num_files, BATCH_SIZE):
+		file_manager.bulk_create(file_dicts[i:i + BATCH_SIZE], dir_id = dir_bulk.id)
+	print_result(f"inserts: FileManager.bulk_create by {BATCH_SIZE}", num_files, time.time() - t_start)
+
+
+
+def create_files(path_to_dir, num_files, file_size):
+	os.makedirs(path_to_dir, exist_ok = True)
+	for i in range(num_files):
+		with open(os.path.join(path_to_dir, f"file_{i}.raw"), "wb") as f:
+			f.write(os.urandom(file_size))
+	return [os.path.join(path_to_dir, f"file_{i}.raw") for i in range(num_files)]
+
+
+def run_hashing_engine(engine, hash_function, file_list):
+	"""submit all files to engine and wait for all results"""
+	results = queue.Queue()
+	for path in file_list:
+		engine.submit(hash_function, {"full_path": path}, callback = results.put, error_callback = results.put)
+	for path in file_list:
+		r = results.get()
+		if isinstance(r, Exception):
+			raise r
+
+
+def benchmark_engines(tmp_dir, workers = 4):
+	"""files/sec of process, thread and inline hashing engines for many small files and for few large files"""
+	workloads = {"small files (16 KiB)": create_files(os.path.join(tmp_dir, "small"), 4000, 16 * 1024),
+		"large files (64 MiB)": create_files(os.path.join(tmp_dir, "large"), 8, 64 * 1024 * 1024)}
+	for workload_name, file_list in workloads.items():
+		for engine_type in HASHING_ENGINES.keys():
+			engine = create_hashing_engine(engine_type, workers = workers)
+			t_start = time.time()
+			run_hashing_engine(engine, get_file_checksum_sha512, file_list)
+			engine.shutdown()
+			print_result(f"engines: {workload_name}, {engine_type}", len(file_list), time.time() - t_start)
+
+
+def benchmark_rate_limit(tmp_dir, workers = 4, rates = (4 * MIB, 8 * MIB), seconds = 3):
+	"""MB/s of each hashing engine with task and global rate limiters, compared with configured rate.
+	All workers share both limiters, so measured rate should be the lower of two rates, whatever is the number of workers"""
+	for task_rate, global_rate in (rates, rates[::-1]):
+		expected = min(task_rate, global_rate)
+		# one second of rate is read at once (burst of TokenBucket), rest is throttled
+		file_list = create_files(os.path.join(tmp_dir, f"rate_{task_rate}_{global_rate}"), 4 * workers, expected * (seconds + 1) // (4 * workers))
+		total = sum([os.stat(path).st_size for path in file_list])
+		for engine_type in HASHING_ENGINES.keys():
+			engine = create_hashing_engine(engine_type, workers = workers)
+			rate_limiters = [engine.create_rate_limiter(task_rate), engine.create_rate_limiter(global_rate)]
+			t_start = time.time()
+			run_hashing_engine(engine, functools.partial(get_file_checksum, rate_limiters = rate_limiters), file_list)
+			secs = time.time() - t_start
+			engine.shutdown()
+			measured = (total - expected) / secs if secs != 0 else 0.0
+			state = "OK" if abs(measured - expected) <= 0.1 * expected else "FAIL"
+			print(f"rate_limit: {engine_type:<8} task {task_rate / MIB:.1f} MiB/s, global {global_rate / MIB:.1f} MiB/s, {workers} workers: {measured / MIB:>6.2f} MiB/s {state}")
+
+
+def drop_from_page_cache(file_list):
+	"""ask kernel to drop cached pages of files, so next read goes to disk"""
+	for path in file_list:
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		finally:
+			os.close(fd)
+
+
+def create_mixed_tree(path_to_dir, num_dirs = 50, num_files = 1000):
+	"""many dirs with small files (like RAW sidecars) and large files, written in random order,
+	so order of listing differs from order of inodes and from physical order"""
+	sizes = [random.choice([4 * 1024, 16 * 1024, 64 * 1024, 4 * MIB]) for i in range(num_files)]
+	for i in range(num_dirs):
+		os.makedirs(os.path.join(path_to_dir, f"dir_{i}"), exist_ok = True)
+	for i in random.sample(range(num_files), num_files):
+		with open(os.path.join(path_to_dir, f"dir_{i % num_dirs}", f"file_{i}.raw"), "wb") as f:
+			f.write(os.urandom(sizes[i]))
+	os.sync()
+
+
+def benchmark_read_order(tmp_dir):
+	"""MB/s of hashing synthetic tree in order of listing, by inode and by physical offset, with cold page cache"""
+	path_to_tree = os.path.join(tmp_dir, "mixed")
+	create_mixed_tree(path_to_tree)
+	for strategy in READ_ORDER_STRATEGIES:
+		file_dicts = list(scan_dir(path_to_tree, with_stat = True))
+		drop_from_page_cache([d["full_path"] for d in file_dicts])
+		t_start = time.time()
+		order_files(file_dicts, strategy)
+		for d in file_dicts:
+			get_file_checksum(d, checksum_method = "md5")
+		secs = time.time() - t_start
+		total_mb = sum([d["st_size"] for d in file_dicts]) / MIB
+		print(f"read_order: {strategy:<12} {len(file_dicts):>8} files {total_mb:>9.1f} MB {secs:>9.3f}s {total_mb / secs if secs != 0 else 0.0:>9.1f} MB/s")
+
+
+def create_dir_with_files(file_manager, dir_manager, path_to_dir, checksums):
+	now = datetime.datetime.now()
+	new_dir = dir_manager.create(path_to_dir, date_added = now, name = os.path.basename(path_to_dir))
+	BATCH_SIZE = 1000
+	for i in range(0, len(checksums), BATCH_SIZE):
+		file_manager.bulk_create([{"full_path": f"{path_to_dir}/file_{i + j}.raw",
+			"checksum": c,
+			"checksum_algorithm": "sha512",
+			"date_added": now,
+			"date_checked": now} for j, c in enumerate(checksums[i:i + BATCH_SIZE])], dir_id = new_dir.id)
+	return new_dir
+
+
+def benchmark_compare(tmp_dir, sizes = (1000, 10000, 100000, 200000)):
+	"""seconds and peak memory of CompareDirsTask with memory, index and sql engines, for two dirs of each size with half of files in common.
+	Each engine is run twice: time is measured without tracemalloc, as it makes allocations several times slower, then peak memory with it"""
+	db_manager, file_manager, dir_manager = init_managers(os.path.join(tmp_dir, "benchmark.db"))
+	logger = logging.getLogger("benchmark")
+	
+	def compare(dir_a, dir_b, engine):
+		task = CompareDirsTask(dir_a, dir_b, logger = logger, db_manager = db_manager, file_manager = file_manager, dir_manager = dir_manager)
+		_session = db_manager.get_session()
+		task.dir_a = _session.query(Directory).get(dir_a.id)
+		task.dir_b = _session.query(Directory).get(dir_b.id)
+		task.progress = 0.0
+		if engine == "sql":
+			task.compare_in_db(_session)
+		elif engine == "index":
+			task.compare_in_index(_session)
+		else:
+			task.compare_in_memory()
+		db_manager.close_session(_session, commit = False)
+	
+	for size in sizes:
+		dir_a = create_dir_with_files(file_manager, dir_manager, f"/benchmark/compare_{size}_a", [f"{i:0128x}" for i in range(size)])
+		dir_b = create_dir_with_files(file_manager, dir_manager, f"/benchmark/compare_{size}_b", [f"{i:0128x}" for i in range(size // 2, size + size // 2)])
+		for engine in ("memory", "index", "sql"):
+			t_start = time.time()
+			compare(dir_a, dir_b, engine)
+			print_result(f"compare: {engine}, 2 x {size} files", 2 * size, time.time() - t_start)
+			tracemalloc.start()
+			compare(dir_a, dir_b, engine)
+			print(f"{'':<40} peak memory {tracemalloc.get_traced_memory()[1] / MIB:.1f} MiB")
+			tracemalloc.stop()
+
+
+
+BENCHMARKS = {"inserts": benchmark_inserts,
+	"engines": benchmark_engines,
+	"read_order": benchmark_read_order,
+	"compare": benchmark_compare,
+	"rate_limit": benchmark_rate_limit}
+
+
+
+if __name__ == "__main__":
+	names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+	for name in names:
+		if name not in BENCHMARKS:
+			print(f"unknown benchmark {name}, available: {', '.join(BENCHMARKS.keys())}")
+			exit(1)
+	# managers are singletons, so all benchmarks share one temporary dir and DB file
+	tmp_dir = tempfile.mkdtemp(prefix = "duplicate_checker_benchmark_")
+	try:
+		for name in names:
+			BENCHMARKS[name](tmp_dir)
+	finally:
+		shutil.rmtree(tmp_dir)
@@ -72,6 +72,26 @@ class DuplicateChecker(object):
 		self.checksum_algorithm = self._config.get("main", "checksum_algorithm")
 		self.ignore_duplicates = False
 		self.task_autostart = True if self._config.get("main", "task_autostart") == "yes" else False
+		self.max_processes = int(self._config.get("main", "max_processes"))
+		self.hashing_engine_type = self._config.get("main", "hashing_engine", fallback = "process")
+		self.hash_block_size = int(self._config.get("main", "hash_block_size_mib", fallback = "1")) * MIB
+		self.extra_checksum_algorithms = [a.strip() for a in self._config.get("main", "extra_checksum_algorithms", fallback = "").split(",") if len(a.strip()) != 0]
+		self.use_hash_cache = True if self._config.get("main", "hash_cache", fallback = "no") == "yes" else False
+		self.hash_cache_paranoid = True if self._config.get("main", "hash_cache_paranoid", fallback = "no") == "yes" else False
+		self.partial_hash_size = int(self._config.get("main", "partial_hash_kib", fallback = "16")) * 1024
+		self.tree_hash_threshold = int(self._config.get("main", "tree_hash_threshold_mib", fallback = "0")) * MIB
+		self.tree_hash_chunk_size = int(self._config.get("main", "tree_hash_chunk_mib", fallback = "64")) * MIB
+		self.readers_per_hdd = int(self._config.get("main", "readers_per_hdd", fallback = "1"))
+		self.readers_per_ssd = int(self._config.get("main", "readers_per_ssd", fallback = "4"))
+		self.parallel_devices = True if self._config.get("main", "parallel_devices", fallback = "no") == "yes" else False
+		self.read_order = self._config.get("main", "read_order", fallback = "listing")
+		self.use_fadvise = False if self._config.get("main", "hash_fadvise", fallback = "yes") == "no" else True
+		self.rate_limit = int(float(self._config.get("main", "rate_limit_mib_s", fallback = "0")) * MIB)
+		self.task_rate_limit = int(float(self._config.get("main", "task_rate_limit_mib_s", fallback = "0")) * MIB)
+		self.compare_engine = self._config.get("main", "compare_engine", fallback = "auto")
+		self.similarity_threshold = int(self._config.get("main", "similarity_threshold_percent", fallback = "80")) / 100
+		self.use_checksum_filter = True if self._config.get("main", "checksum_filter", fallback = "no") == "yes" else False
+		self.checksum_filter_error_rate = float(self._config.get("main", "checksum_filter_error_percent", fallback = "1")) / 100
 		# set DB file as either relative or absolute
 		if db_file is not None:
 			self.DB_FILE = db_file
@@ -84,10 +104,29 @@ class DuplicateChecker(object):
 		self.db_manager = DBManager(db_file = self.DB_FILE, logger = self._logger.getChild("DBManager"))
 		self.file_manager = FileManager(logger = self._logger.getChild("FileManager"))
 		self.dir_manager = DirManager(logger = self._logger.getChild("DirManager"))
+		self.hash_cache_manager = HashCacheManager(logger = self._logger.getChild("HashCacheManager")) if self.use_hash_cache else None
+		self.duplicate_group_manager = DuplicateGroupManager(logger = self._logger.getChild("DuplicateGroupManager"))
 		self.task_manager = TaskManager(logger = self._logger.getChild("TaskManager"),
 			checksum_algorithm = self.checksum_algorithm,
 			ignore_duplicates = self.ignore_duplicates,
-			task_autostart = self.task_autostart)
+			task_autostart = self.task_autostart,
+			max_processes = self.max_processes,
+			hashing_engine_type = self.hashing_engine_type,
+			hash_block_size = self.hash_block_size,
+			extra_checksum_algorithms = self.extra_checksum_algorithms,
+			hash_cache_paranoid = self.hash_cache_paranoid,
+			partial_hash_size = self.partial_hash_size,
+			tree_hash_threshold = self.tree_hash_threshold,
+			tree_hash_chunk_size = self.tree_hash_chunk_size,
+			readers_per_hdd = self.readers_per_hdd,
+			readers_per_ssd = self.readers_per_ssd,
+			parallel_devices = self.parallel_devices,
+			read_order = self.read_order,
+			use_fadvise = self.use_fadvise,
+			rate_limit = self.rate_limit,
+			task_rate_limit = self.task_rate_limit,
+			compare_engine = self.compare_engine,
+			similarity_threshold = self.similarity_threshold)
 		self.init_object_managers()
 	
 	
@@ -98,6 +137,21 @@ class DuplicateChecker(object):
 		self.task_manager.set_DB_manager(self.db_manager)
 		self.task_manager.set_file_manager(self.file_manager)
 		self.task_manager.set_dir_manager(self.dir_manager)
+		self.duplicate_group_manager.set_DB_manager(self.db_manager)
+		self.task_manager.set_duplicate_group_manager(self.duplicate_group_manager)
+		if self.hash_cache_manager is not None:
+			self.hash_cache_manager.set_DB_manager(self.db_manager)
+			self.task_manager.set_hash_cache_manager(self.hash_cache_manager)
+		if self.use_checksum_filter:
+			# filter of all checksums is kept in file next to DB between runs
+			self.file_manager.init_checksum_filter(self.DB_FILE + ".bloom", error_rate = self.checksum_filter_error_rate)
+	
+	
+	def shutdown(self):
+		"""release resources of managers before exit"""
+		self._logger.info("shutdown: shutting down")
+		self.task_manager.shutdown()
+		self.file_manager.save_checksum_filter()
 	
 	
 	def rotate_logs(self):
@@ -161,7 +215,11 @@ class DuplicateCheckerFlask(DuplicateChecker):
 				if found_file is None:
 					self._logger.error(f"show_file: file with id {file_id} not found!")
 					return render_template("blank_page.html", page_text = f"ERROR file with id {file_id} not found!")
-				duplicates = self.file_manager.get_by_checksum(found_file.checksum)
+				if self.file_manager.may_have_copies(found_file.checksum, found_file.checksum_algorithm):
+					duplicates = self.file_manager.get_by_checksum(found_file.checksum, checksum_algorithm = found_file.checksum_algorithm)
+				else:
+					# file is the only one with its checksum, no need to query DB
+					duplicates = [found_file] if found_file.dir is not None and found_file.dir.enabled else []
 				self._logger.debug(f"show file: will show file {found_file.full_path}, duplicates: {duplicates}")
 				return render_template("show_file.html", file = found_file, duplicates = duplicates)
 		
@@ -169,7 +227,7 @@ class DuplicateCheckerFlask(DuplicateChecker):
 		@web_app.route("/api/get-files-by-checksum", methods = ["GET"])
 		def get_files_by_checksum_api():
 			requested_dir = self.dir_manager.get_by_id(request.args.get("dir_id"))
-			found_files = self.file_manager.get_by_checksum(request.args.get("checksum"), idir = requested_dir)
+			found_files = self.file_manager.get_by_checksum(request.args.get("checksum"), idir = requested_dir, checksum_algorithm = request.args.get("checksum_algorithm") or None)
 			return render_template("show_files.html", files = found_files)
 		
 		
@@ -181,21 +239,22 @@ class DuplicateCheckerFlask(DuplicateChecker):
 				dirs = str(request.form["path_to_dir"]).splitlines()
 				is_etalon = True if request.form.get("is_etalon") is not None else False
 				add_subdirs = True if request.form.get("add_subdirs") is not None else False
-				self._logger.debug(f"add_directory: got input values from form: list of dirs: {dirs}, is etalon: {is_etalon}.")
+				possible_duplicates_only = True if request.form.get("possible_duplicates_only") is not None else False
+				self._logger.debug(f"add_directory: got input values from form: list of dirs: {dirs}, is etalon: {is_etalon}, possible duplicates only: {possible_duplicates_only}.")
 				try:
 					for d in dirs:
 						if not add_subdirs:
 							if not os.path.isdir(d):
 								self._logger.info(f"add_directory: {d} is not a dir, will not add it")
 							else:
-								self.task_manager.add_directory(normalize_path_to_dir(d), is_etalon = is_etalon)
+								self.task_manager.add_directory(normalize_path_to_dir(d), is_etalon = is_etalon, possible_duplicates_only = possible_duplicates_only)
 						else:
 							subdirs = []
 							subdirs = glob.glob(os.path.join(d, "*/"), recursive = False)
 							self._logger.debug(f"add_directory: will add subdirs of directory {d}: {subdirs}")
 							for p in subdirs:
 								if os.path.isdir(p):
-									self.task_manager.add_directory(normalize_path_to_dir(p), is_etalon = is_etalon)
+									self.task_manager.add_directory(normalize_path_to_dir(p), is_etalon = is_etalon, possible_duplicates_only = possible_duplicates_only)
 								else:
 									self._logger.info(f"add_directory: will not add subdir {p} of dir {d} - it is not a dir, ignoring")
 				except Exception as e:
@@ -274,6 +333,19 @@ class DuplicateCheckerFlask(DuplicateChecker):
 			return render_template("blank_page.html", page_text = log_text.replace("\n", "<br>\n"))
 		
 		
+		@web_app.route("/ui/show-checksum-filter", methods = ["GET"])
+		def show_checksum_filter():
+			if self.file_manager.checksum_filter is None:
+				return render_template("blank_page.html", page_text = "Checksum filter is disabled, set checksum_filter = yes in config to enable it")
+			stats = self.file_manager.checksum_filter.get_stats()
+			page_text = f"Files in filter: {stats['files']}, unique checksums: {stats['unique_checksums']}, capacity: {stats['capacity']}<br>\n"
+			page_text += f"Files removed since filter was built: {stats['removed_files']}{', filter is stale and not used' if stats['stale'] else ''}<br>\n"
+			page_text += f"Memory: {stats['memory_bytes'] / MIB:.2f} MiB<br>\n"
+			page_text += f"False positive rate: configured {stats['error_rate'] * 100:.3f}%, estimated now {stats['estimated_error_rate'] * 100:.3f}%<br>\n"
+			page_text += f"Lookups: {stats['lookups']}, answered without DB: {stats['negatives']}<br>\n"
+			return render_template("blank_page.html", page_text = page_text)
+		
+		
 		@web_app.route("/ui/actions", methods = ["GET"])
 		def actions():
 			if request.method == "GET":
@@ -295,11 +367,21 @@ class DuplicateCheckerFlask(DuplicateChecker):
 				return render_template("blank_page.html", page_text = "task CompareDirsTask launched, see all tasks - [<a href='/ui/show-all-tasks' title='show tasks'>show tasks</a>]<br>")
 		
 		
+		@web_app.route("/api/compare-multiple-dirs", methods = ["GET"])
+		def compare_multiple_dirs_api():
+			target_dir_list = get_dir_objects_from_request(request, get_by_id = self.dir_manager.get_by_id)
+			if len(target_dir_list) < 2:
+				return render_template("blank_page.html", page_text = "ERROR at least 2 dirs should be selected for comparison!")
+			self.task_manager.compare_multiple_directories(target_dir_list)
+			return render_template("blank_page.html", page_text = f"task CompareMultipleDirsTask launched for {len(target_dir_list)} dirs: {[d.url_html_code for d in target_dir_list]}, see all tasks - [<a href='/ui/show-all-tasks' title='show tasks'>show tasks</a>]<br>")
+		
+		
 		@web_app.route("/api/check-dirs", methods = ["GET"])
 		def check_dirs_api():
 			target_dir_list = get_dir_objects_from_request(request, get_by_id = self.dir_manager.get_by_id)
+			paranoid = True if request.args.get("paranoid") == "1" else None
 			for dir_obj in target_dir_list:
-				self.task_manager.check_dir(dir_obj)
+				self.task_manager.check_dir(dir_obj, paranoid = paranoid)
 			return render_template("blank_page.html", page_text = f"Added tasks for checking {len(target_dir_list)} dirs: {[d.url_html_code for d in target_dir_list]}")
 		
 		
@@ -311,6 +393,35 @@ class DuplicateCheckerFlask(DuplicateChecker):
 			return render_template("blank_page.html", page_text = f"Added tasks FindCopiesTask for {len(target_dir_list)} dirs: {[d.url_html_code for d in target_dir_list]}")
 		
 		
+		@web_app.route("/api/find-similar-dirs", methods = ["GET"])
+		def find_similar_dirs_api():
+			target_dir_list = get_dir_objects_from_request(request, get_by_id = self.dir_manager.get_by_id)
+			for dir_obj in target_dir_list:
+				self.task_manager.find_similar_dirs(dir_obj)
+			return render_template("blank_page.html", page_text = f"Added tasks FindSimilarDirsTask for {len(target_dir_list)} dirs: {[d.url_html_code for d in target_dir_list]}")
+		
+		
+		@web_app.route("/api/find-all-duplicates", methods = ["GET"])
+		def find_all_duplicates_api():
+			new_task = self.task_manager.find_all_duplicates()
+			return render_template("blank_page.html", page_text = f"Added task {new_task.url_html_code}, see all tasks - [<a href='/ui/show-all-tasks' title='show tasks'>show tasks</a>]<br>")
+		
+		
+		@web_app.route("/ui/show-duplicates/<int:task_id>", methods = ["GET"])
+		def show_duplicates(task_id):
+			PAGE_SIZE = 50
+			page = int(request.args.get("page", 0))
+			groups = self.duplicate_group_manager.get_page(task_id, page = page, page_size = PAGE_SIZE)
+			files_by_id = {f.id: f for f in self.file_manager.get_by_ids([i for g in groups for i in g.file_ids_list])}
+			groups_count = self.duplicate_group_manager.get_count(task_id)
+			return render_template("show_duplicates.html",
+				task_id = task_id,
+				groups = [(g, [files_by_id[i] for i in g.file_ids_list if i in files_by_id]) for g in groups],
+				page = page,
+				pages = (groups_count + PAGE_SIZE - 1) // PAGE_SIZE,
+				groups_count = groups_count)
+		
+		
 		@web_app.route("/ui/shutdown-app", methods = ["GET", "POST"])
 		def shutdown_app():
 			if request.method == "GET":
@@ -319,6 +430,7 @@ class DuplicateCheckerFlask(DuplicateChecker):
 					return render_template("blank_page.html", page_text = "Cannot shutdown, there is running task")
 				else:
 					self._logger.info("shutdown_app: will shutdown")
+					self.shutdown()
 					time.sleep(3)
 					sys.exit(0)
 					return render_template("blank_page.html", page_text = "shutted down") # this will be never returned 
@@ -386,7 +498,8 @@ class DuplicateCheckerFlask(DuplicateChecker):
 		def edit_dir_api():
 			dir_dict = get_dir_dict_from_request(request)
 			target_dir = self.dir_manager.get_by_id(dir_dict["id"])
-			if target_dir.full_path != dir_dict["full_path"]:
+			path_changed = target_dir.full_path != dir_dict["full_path"]
+			if path_changed:
 				self._logger.debug(f"edit_dir_api: got new full_path: {dir_dict['full_path']}")
 				target_dir.full_path = dir_dict["full_path"]
 				new_subpath = dir_dict["full_path"]
@@ -403,6 +516,9 @@ class DuplicateCheckerFlask(DuplicateChecker):
 				self._logger.debug(f"edit_dir_api: got new enabled: {dir_dict['enabled']}")
 				target_dir.enabled = dir_dict["enabled"]
 			self.dir_manager.update(target_dir)
+			if path_changed:
+				# relative paths of files are changed
+				self.dir_manager.compute_fingerprints(target_dir.id)
 			return render_template("blank_page.html")
 		
 		
@@ -420,7 +536,11 @@ class DuplicateCheckerFlask(DuplicateChecker):
 				return render_template("execute_sql_query.html")
 			if request.method == "POST":
 				query_text = request.form["query_text"]
-				result = self.execute_sql_query(query_text)
+				result = self.db_manager.execute_sql_query(query_text)
+				if not query_text.strip().lower().startswith("select"):
+					# files could be changed by query, so filter should be rebuilt
+					self.file_manager.invalidate_checksum_filter()
+					self.file_manager.rebuild_checksum_filter_if_needed()
 				return render_template("execute_sql_query.html", result = str(result))
 		
 		
@@ -512,6 +632,7 @@ class DuplicateCheckerFlask(DuplicateChecker):
 		
 		print("starting web interface...\n")
 		web_app.run(host = self.addr, port = self.port, use_reloader = False)
+		self.shutdown()
 		
 
 	
@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+
+import os
+import time
+import datetime
+import mmap
+import hashlib
+import threading
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.managers
+import traceback
+import collections
+import struct
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+
+
+"""Hashing engines: run hashing jobs (i.e. get_file_checksum) in processes, in threads or inline in calling thread.
+Also low-level reading of files for hashing."""
+
+
+
+MIB = 1024 * 1024
+DEFAULT_BLOCK_SIZE = 1 * MIB
+MIN_BLOCK_SIZE = 1 * MIB
+MAX_BLOCK_SIZE = 16 * MIB
+MMAP_THRESHOLD = 256 * MIB # files of this size and larger are hashed via mmap
+DEFAULT_PARTIAL_SIZE = 16 * 1024 # size of head and of tail of file used for partial checksum
+DEFAULT_TREE_CHUNK_SIZE = 64 * MIB # size of one chunk of tree checksum
+DONTNEED_INTERVAL = 32 * MIB # with fadvise, pages of file are dropped from page cache after each this number of bytes read
+
+_read_buffers = threading.local() # one reusable read buffer for each thread (and so for each process)
+
+# optional, fast non-cryptographic hashes
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+
+# name of algorithm: function that returns new hashlib-like object
+CHECKSUM_ALGORITHMS = {"md5": hashlib.md5,
+	"sha256": hashlib.sha256,
+	"sha512": hashlib.sha512,
+	"blake2b": hashlib.blake2b,
+	"blake2s": hashlib.blake2s}
+if xxhash is not None:
+	CHECKSUM_ALGORITHMS["xxh64"] = xxhash.xxh64
+	CHECKSUM_ALGORITHMS["xxh3_64"] = xxhash.xxh3_64
+	CHECKSUM_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+
+
+def new_hasher(checksum_algorithm):
+	"""returns new hashlib-like object for algorithm name, one of CHECKSUM_ALGORITHMS keys"""
+	if checksum_algorithm not in CHECKSUM_ALGORITHMS:
+		raise ValueError(f"unsupported checksum algorithm {checksum_algorithm}, supported: {', '.join(CHECKSUM_ALGORITHMS.keys())}" + ("" if xxhash is not None else " (install xxhash for xxh64, xxh3_64 and xxh3_128)"))
+	return CHECKSUM_ALGORITHMS[checksum_algorithm]()
+
+
+def format_extra_checksums(extra_checksums):
+	"""convert dict {algorithm: checksum} to string "algorithm:checksum,algorithm:checksum" which is stored in DB"""
+	if extra_checksums is None or len(extra_checksums) == 0:
+		return None
+	return ",".join([f"{algorithm}:{extra_checksums[algorithm]}" for algorithm in sorted(extra_checksums.keys())])
+
+
+def parse_extra_checksums(extra_checksums_str):
+	"""convert string from DB "algorithm:checksum,algorithm:checksum" to dict {algorithm: checksum}"""
+	if extra_checksums_str is None or len(extra_checksums_str) == 0:
+		return {}
+	return dict([item.split(":", 1) for item in extra_checksums_str.split(",")])
+
+
+# before algorithm was stored for each file, only md5 and sha512 were supported, so they can be told apart by length
+LEGACY_CHECKSUM_LENGTHS = {32: "md5", 128: "sha512"}
+
+
+def tree_algorithm_name(checksum_algorithm, chunk_size):
+	"""name of tree checksum algorithm stored in DB, i.e. tree:sha512:64MiB"""
+	return f"tree:{checksum_algorithm}:{chunk_size // MIB}MiB"
+
+
+def parse_tree_algorithm(checksum_algorithm):
+	"""returns tuple (algorithm of chunks, chunk size in bytes) for tree checksum algorithm name, or None for ordinary algorithm"""
+	if checksum_algorithm is None or not checksum_algorithm.startswith("tree:"):
+		return None
+	_, algorithm, chunk_size = checksum_algorithm.split(":")
+	return (algorithm, int(chunk_size[:-len("MiB")]) * MIB)
+
+
+def base_checksum_algorithm(checksum_algorithm):
+	"""algorithm of chunks for tree checksum algorithm, algorithm itself for ordinary algorithm"""
+	tree = parse_tree_algorithm(checksum_algorithm)
+	return checksum_algorithm if tree is None else tree[0]
+
+
+def normalize_block_size(block_size):
+	"""clamp block size to supported range"""
+	return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, int(block_size)))
+
+
+def get_read_buffer(block_size):
+	"""return preallocated buffer of block_size bytes, it is allocated once per thread and reused for all files"""
+	buf = getattr(_read_buffers, "buf", None)
+	if buf is None or len(buf) != block_size:
+		buf = bytearray(block_size)
+		_read_buffers.buf = buf
+	return buf
+
+
+def fadvise(fd, offset, length, advice):
+	"""posix_fadvise, if it is supported. advice is name of constant without prefix, i.e. SEQUENTIAL or DONTNEED"""
+	advice_value = getattr(os, f"POSIX_FADV_{advice}", None)
+	if advice_value is None or not hasattr(os, "posix_fadvise"):
+		return
+	try:
+		os.posix_fadvise(fd, offset, length, advice_value)
+	except OSError:
+		pass
+
+
+def hash_file(path_to_file, hashers, block_size = DEFAULT_BLOCK_SIZE, mmap_threshold = MMAP_THRESHOLD, use_fadvise = True, rate_limiters = ()):
+	"""feed whole content of file to all hashers
+	
+	arguments: path_to_file - string with path to file
+		hashers - list of hashlib-like objects with update() method
+		block_size - size of one read in bytes
+		mmap_threshold - files of this size or larger are read via mmap, 0 disables mmap
+		use_fadvise - file is read with POSIX_FADV_SEQUENTIAL and already hashed pages are dropped with POSIX_FADV_DONTNEED,
+			so hashing does not evict other data from page cache
+		rate_limiters - objects with consume(n) method (TokenBucket or its proxy), each block read waits for all of them
+	returns: number of bytes read
+	"""
+	total = 0
+	with open(path_to_file, "rb", buffering = 0) as f:
+		size = os.fstat(f.fileno()).st_size
+		if use_fadvise:
+			fadvise(f.fileno(), 0, 0, "SEQUENTIAL")
+		if mmap_threshold != 0 and size >= mmap_threshold:
+			with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+				if use_fadvise and hasattr(m, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+					m.madvise(mmap.MADV_SEQUENTIAL)
+				with memoryview(m) as view:
+					for offset in range(0, len(view), block_size):
+						with view[offset:offset + block_size] as chunk:
+							for limiter in rate_limiters:
+								limiter.consume(len(chunk))
+							for h in hashers:
+								h.update(chunk)
+				total = len(m)
+		else:
+			buf = get_read_buffer(block_size)
+			dropped = 0
+			with memoryview(buf) as view:
+				while True:
+					n = f.readinto(buf)
+					if not n:
+						break
+					for limiter in rate_limiters:
+						limiter.consume(n)
+					with view[:n] as chunk:
+						for h in hashers:
+							h.update(chunk)
+					total += n
+					if use_fadvise and total - dropped >= DONTNEED_INTERVAL:
+						fadvise(f.fileno(), dropped, total - dropped, "DONTNEED")
+						dropped = total
+		if use_fadvise:
+			fadvise(f.fileno(), 0, 0, "DONTNEED")
+	return total
+
+
+def hash_file_ends(path_to_file, hashers, partial_size = DEFAULT_PARTIAL_SIZE, use_fadvise = True, rate_limiters = ()):
+	"""feed first and last partial_size bytes of file to all hashers, whole file if it is not larger than 2 * partial_size
+	
+	returns: number of bytes read
+	"""
+	with open(path_to_file, "rb", buffering = 0) as f:
+		size = os.fstat(f.fileno()).st_size
+		if size <= 2 * partial_size:
+			parts = [f.read(size)]
+		else:
+			head = f.read(partial_size)
+			f.seek(size - partial_size)
+			parts = [head, f.read(partial_size)]
+		if use_fadvise:
+			fadvise(f.fileno(), 0, 0, "DONTNEED")
+	for limiter in rate_limiters:
+		limiter.consume(sum(len(part) for part in parts))
+	for part in parts:
+		for h in hashers:
+			h.update(part)
+	return sum(len(part) for part in parts)
+
+
+def hash_file_range(path_to_file, hashers, offset, length, block_size = DEFAULT_BLOCK_SIZE, use_fadvise = True, rate_limiters = ()):
+	"""feed length bytes of file starting from offset to all hashers
+	
+	returns: number of bytes read, less than length if file ends earlier
+	"""
+	total = 0
+	buf = get_read_buffer(block_size)
+	with open(path_to_file, "rb", buffering = 0) as f:
+		f.seek(offset)
+		if use_fadvise:
+			fadvise(f.fileno(), offset, length, "SEQUENTIAL")
+		with memoryview(buf) as view:
+			while total < length:
+				with view[:min(block_size, length - total)] as target:
+					n = f.readinto(target)
+				if not n:
+					break
+				for limiter in rate_limiters:
+					limiter.consume(n)
+				with view[:n] as chunk:
+					for h in hashers:
+						h.update(chunk)
+				total += n
+		if use_fadvise:
+			fadvise(f.fileno(), offset, length, "DONTNEED")
+	return total
+
+
+# FIEMAP ioctl (Linux): physical location of first extent of file
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII") # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII") # fe_logical, fe_physical, fe_length, 2 x reserved, fe_flags, 3 x reserved
+
+
+def get_physical_offset(path_to_file):
+	"""physical offset of first extent of file on device, or None if FIEMAP is not supported or file is empty"""
+	if fcntl is None:
+		return None
+	buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+	FIEMAP_HEADER.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+	try:
+		fd = os.open(path_to_file, os.O_RDONLY)
+		try:
+			fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+		finally:
+			os.close(fd)
+	except OSError:
+		return None
+	if FIEMAP_HEADER.unpack_from(buf, 0)[3] == 0:
+		return None
+	return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
+
+
+# strategies of order in which files are read: in order of listing, by inode number, by physical offset (falls back to inode)
+READ_ORDER_STRATEGIES = ("listing", "inode", "physical")
+
+
+def order_files(file_dicts, strategy = "listing"):
+	"""sort list of dicts from scan_dir (with_stat = True) in place, so files on HDD are read with less seeks"""
+	if strategy not in READ_ORDER_STRATEGIES:
+		raise ValueError(f"unknown read order {strategy}, supported: {', '.join(READ_ORDER_STRATEGIES)}")
+	if strategy == "inode":
+		file_dicts.sort(key = lambda d: (d.get("st_dev", 0), d.get("st_ino", 0)))
+	elif strategy == "physical":
+		for d in file_dicts:
+			if "physical_offset" not in d:
+				d["physical_offset"] = get_physical_offset(d["full_path"])
+		# files without known offset go after others, by inode
+		file_dicts.sort(key = lambda d: (d.get("st_dev", 0), d["physical_offset"] is None, d["physical_offset"] or 0, d.get("st_ino", 0)))
+	return file_dicts
+
+
+
+class TokenBucket(object):
+	"""Token bucket rate limiter: consume(n) waits till n bytes may be read. Thread-safe.
+	rate is in bytes per second, 0 means no limit. Up to burst bytes (default - one second of rate) may be read without waiting"""
+	
+	def __init__(self, rate = 0, burst = None):
+		super(TokenBucket, self).__init__()
+		self.rate = rate
+		self.burst = burst if burst is not None else rate
+		self._tokens = self.burst
+		self._last = time.monotonic()
+		self._lock = threading.Lock()
+	
+	
+	def consume(self, amount):
+		"""take amount of tokens, sleeping if there are not enough. Returns time waited in seconds"""
+		if self.rate == 0 or amount <= 0:
+			return 0.0
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+			self._last = now
+			# tokens may go below zero, then this and next callers wait till debt is repaid
+			self._tokens -= amount
+			wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+		if wait > 0:
+			time.sleep(wait)
+		return wait
+	
+	
+	def __str__(self):
+		return f"{self.__class__.__name__} {self.rate / MIB:.1f} MiB/s" if self.rate != 0 else f"{self.__class__.__name__} without limit"
+
+
+
+class RateLimiterManager(multiprocessing.managers.BaseManager):
+	"""Server process holding TokenBuckets shared by worker processes. Proxy of bucket is picklable and may be passed with job"""
+	pass
+
+RateLimiterManager.register("TokenBucket", TokenBucket)
+
+
+
+class TreeChecksumCollector(object):
+	"""Collects checksums of chunks of one file, hashed in parallel by any hashing engine.
+	When all chunks are ready, root checksum is calculated as checksum of concatenated chunk digests
+	(in order of chunks) and callback is called with target_dict, the same way as for get_file_checksum"""
+	
+	def __init__(self, target_dict, checksum_algorithm, chunk_size, callback = None, error_callback = None):
+		super(TreeChecksumCollector, self).__init__()
+		self.target_dict = target_dict
+		self.checksum_algorithm = checksum_algorithm
+		self.chunk_size = chunk_size
+		self._callback = callback
+		self._error_callback = error_callback
+		size = target_dict["st_size"]
+		self.chunks = [{"full_path": target_dict["full_path"],
+			"chunk_index": i,
+			"chunk_offset": offset,
+			"chunk_length": min(chunk_size, size - offset)} for i, offset in enumerate(range(0, size, chunk_size))]
+		self._digests = [None] * len(self.chunks)
+		self._remaining = len(self.chunks)
+		self._failed = False
+		self._lock = threading.Lock()
+	
+	
+	def on_chunk(self, result):
+		with self._lock:
+			if self._failed:
+				return
+			self._digests[result["chunk_index"]] = bytes.fromhex(result["chunk_checksum"])
+			self._remaining -= 1
+			if self._remaining != 0:
+				return
+		root = new_hasher(self.checksum_algorithm)
+		for digest in self._digests:
+			root.update(digest)
+		self.target_dict["checksum"] = root.hexdigest()
+		self.target_dict["checksum_algorithm"] = tree_algorithm_name(self.checksum_algorithm, self.chunk_size)
+		self.target_dict["extra_checksums"] = {}
+		self.target_dict["date_end"] = datetime.datetime.now()
+		if self._callback is not None:
+			self._callback(self.target_dict)
+	
+	
+	def on_error(self, e):
+		with self._lock:
+			if self._failed:
+				return
+			self._failed = True
+		if self._error_callback is not None:
+			self._error_callback(e)
+
+
+
+class BaseHashingEngine(object):
+	"""Base class for all hashing engines. Engine runs jobs and passes result of each job to callback"""
+
+	def __init__(self, workers = 2, logger = None):
+		super(BaseHashingEngine, self).__init__()
+		self.workers = workers
+		self._logger = logger
+
+
+	def submit(self, func, arg, callback = None, error_callback = None):
+		"""run func(arg) asynchronously, then call callback(result), or error_callback(exception) if func raised"""
+		raise NotImplementedError
+
+
+	def shutdown(self):
+		"""wait till all submitted jobs are complete and release workers"""
+		raise NotImplementedError
+
+
+	def create_rate_limiter(self, rate):
+		"""return TokenBucket for rate (bytes per second), which is shared by all workers of this engine"""
+		return TokenBucket(rate)
+
+
+	def __str__(self):
+		return f"{self.__class__.__name__} with {self.workers} workers"
+
+
+
+class ProcessHashingEngine(BaseHashingEngine):
+	"""Jobs are run in pool of processes. Each job and its result are pickled and sent between processes"""
+
+	def __init__(self, workers = 2, logger = None):
+		super(ProcessHashingEngine, self).__init__(workers = workers, logger = logger)
+		self._pool = self._create_pool()
+		self._manager = None
+		self._manager_lock = threading.Lock()
+
+
+	def _create_pool(self):
+		return multiprocessing.Pool(processes = self.workers)
+
+
+	def submit(self, func, arg, callback = None, error_callback = None):
+		self._pool.apply_async(func, (arg, ), callback = callback, error_callback = error_callback)
+
+
+	def create_rate_limiter(self, rate):
+		"""bucket lives in process of RateLimiterManager, started on first call, workers get its proxy"""
+		with self._manager_lock:
+			if self._manager is None:
+				self._manager = RateLimiterManager()
+				self._manager.start()
+			return self._manager.TokenBucket(rate)
+
+
+	def shutdown(self):
+		self._pool.close()
+		self._pool.join()
+		with self._manager_lock:
+			if self._manager is not None:
+				self._manager.shutdown()
+				self._manager = None
+
+
+
+class ThreadHashingEngine(ProcessHashingEngine):
+	"""Jobs are run in pool of threads of this process. Nothing is pickled, and hashlib releases GIL while hashing large buffers"""
+
+	def _create_pool(self):
+		return multiprocessing.pool.ThreadPool(processes = self.workers)
+
+
+	def create_rate_limiter(self, rate):
+		return TokenBucket(rate)
+
+
+
+class InlineHashingEngine(BaseHashingEngine):
+	"""Jobs are run one by one in calling thread, submit returns when job is complete"""
+
+	def __init__(self, workers = 1, logger = None):
+		super(InlineHashingEngine, self).__init__(workers = 1, logger = logger)
+
+
+	def submit(self, func, arg, callback = None, error_callback = None):
+		try:
+			result = func(arg)
+		except Exception as e:
+			if self._logger is not None:
+				self._logger.error(f"submit: got error {e}, traceback: {traceback.format_exc()}")
+			if error_callback is not None:
+				error_callback(e)
+			return
+		if callback is not None:
+			callback(result)
+
+
+	def shutdown(self):
+		pass
+
+
+
+def is_rotational_device(st_dev):
+	"""True for HDD, False for SSD or NVMe, None if unknown (not Linux, network or virtual filesystem)"""
+	path_to_dev = os.path.realpath(f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}")
+	# partition has no queue, it is in parent device
+	for p in (path_to_dev, os.path.dirname(path_to_dev)):
+		try:
+			with open(os.path.join(p, "queue", "rotational"), "r") as f:
+				return f.read().strip() == "1"
+		except OSError:
+			continue
+	return None
+
+
+
+class DeviceScheduler(object):
+	"""Submits jobs to hashing engine, but not more than readers_per_hdd (or readers_per_ssd) jobs for one device at once.
+	Jobs for busy device wait in queue of this device, so jobs for other devices go to engine without waiting and all devices are busy"""
+	
+	def __init__(self, engine, readers_per_hdd = 1, readers_per_ssd = 4, logger = None):
+		super(DeviceScheduler, self).__init__()
+		self.engine = engine
+		self.readers_per_hdd = readers_per_hdd
+		self.readers_per_ssd = readers_per_ssd # also for devices of unknown type, 0 means no limit
+		self._logger = logger
+		self._lock = threading.Lock()
+		self._waiting = {} # device: deque of jobs
+		self._running = {} # device: number of jobs submitted to engine
+		self._limits = {} # device: max number of jobs, cached
+	
+	
+	def get_limit(self, device):
+		if device not in self._limits:
+			rotational = is_rotational_device(device)
+			self._limits[device] = self.readers_per_hdd if rotational else self.readers_per_ssd
+			if self._logger is not None:
+				self._logger.info(f"get_limit: device {os.major(device)}:{os.minor(device)} is {'HDD' if rotational else 'SSD' if rotational is not None else 'of unknown type'}, readers: {self._limits[device]}")
+		return self._limits[device]
+	
+	
+	def submit(self, func, arg, callback = None, error_callback = None, device = None):
+		"""like engine.submit, device is st_dev of file. If device is None, job is submitted to engine at once"""
+		if device is None:
+			self.engine.submit(func, arg, callback = callback, error_callback = error_callback)
+			return
+		with self._lock:
+			self._waiting.setdefault(device, collections.deque()).append((func, arg, callback, error_callback))
+		self._dispatch(device)
+	
+	
+	def _dispatch(self, device):
+		limit = self.get_limit(device)
+		while True:
+			with self._lock:
+				if len(self._waiting[device]) == 0 or (limit != 0 and self._running.get(device, 0) >= limit):
+					return
+				func, arg, callback, error_callback = self._waiting[device].popleft()
+				self._running[device] = self._running.get(device, 0) + 1
+			self.engine.submit(func, arg,
+				callback = self._wrap_callback(device, callback),
+				error_callback = self._wrap_callback(device, error_callback))
+	
+	
+	def _wrap_callback(self, device, callback):
+		def wrapped(result):
+			with self._lock:
+				self._running[device] -= 1
+			try:
+				if callback is not None:
+					callback(result)
+			finally:
+				self._dispatch(device)
+		return wrapped
+	
+	
+	def shutdown(self):
+		self.engine.shutdown()
+	
+	
+	def __str__(self):
+		return f"{self.__class__.__name__} over {self.engine}, readers per HDD: {self.readers_per_hdd}, per SSD: {self.readers_per_ssd}"
+
+
+
+HASHING_ENGINES = {"process": ProcessHashingEngine,
+	"thread": ThreadHashingEngine,
+	"inline": InlineHashingEngine}
+
+
+def create_hashing_engine(engine_type = "process", workers = 2, logger = None):
+	"""create hashing engine by its name, one of HASHING_ENGINES keys"""
+	if engine_type not in HASHING_ENGINES:
+		raise ValueError(f"unknown hashing engine {engine_type}, supported: {', '.join(HASHING_ENGINES.keys())}")
+	return HASHING_ENGINES[engine_type](workers = workers, logger = logger)
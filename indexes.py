@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""In-memory indexes over catalog: fingerprints and MinHash signatures of dirs and LSH index over them, to find similar dirs without comparing all files,
+Bloom filters of checksums of all files, to skip DB queries for files without copies, and compact index of files for comparisons"""
+
+
+import os
+import hashlib
+import random
+import math
+import json
+import threading
+from array import array
+
+
+
+FINGERPRINT_BITS = 256 # size of fingerprint of dir, sum of hashes of its files
+MINHASH_SIZE = 64 # number of hash functions in signature
+LSH_BANDS = 16 # signature is split to LSH_BANDS bands of MINHASH_SIZE // LSH_BANDS values, dirs with at least one equal band are candidates
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# hash functions are (a * x + b) mod prime, they should be the same for all signatures, so they are generated from fixed seed
+_rng = random.Random(20240917)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for i in range(MINHASH_SIZE)]
+
+
+
+def checksum_key(checksum, checksum_algorithm):
+	"""bytes of (checksum_algorithm, checksum) of file. Files without checksum get different key for each algorithm"""
+	if checksum is None:
+		return f"{checksum_algorithm or ''}\1".encode("utf-8", "surrogateescape")
+	return f"{checksum_algorithm or ''}\0{checksum}".encode("utf-8", "surrogateescape")
+
+
+def minhash_item(*parts):
+	"""int hash of one element of set, i.e. (checksum_algorithm, checksum) of file"""
+	data = "\0".join(["" if p is None else str(p) for p in parts]).encode("utf-8", "surrogateescape")
+	return int.from_bytes(hashlib.blake2b(data, digest_size = 8).digest(), "big")
+
+
+def parse_minhash(signature):
+	"""returns list of ints from hex string, or None"""
+	if signature is None:
+		return None
+	return [int(signature[i:i + 8], 16) for i in range(0, len(signature), 8)]
+
+
+def format_minhash(values):
+	return "".join([f"{v:08x}" for v in values])
+
+
+def update_minhash(signature, items):
+	"""MinHash signature of set of items: for each hash function, minimum of its values over all items.
+	New items are added to signature without other items, but signature can not be updated when items are removed
+
+	arguments: signature - hex string, or None for empty set
+		items - list of tuples, each tuple is one element of set
+	returns: hex string of MINHASH_SIZE values, or None if there are no items at all
+	"""
+	if signature is None and len(items) == 0:
+		return None
+	values = parse_minhash(signature) if signature is not None else [_MAX_HASH] * MINHASH_SIZE
+	for item in items:
+		x = minhash_item(*item)
+		for i, (a, b) in enumerate(_PERMUTATIONS):
+			h = ((a * x + b) % _MERSENNE_PRIME) & _MAX_HASH
+			if h < values[i]:
+				values[i] = h
+	return format_minhash(values)
+
+
+def estimate_jaccard(values_a, values_b):
+	"""share of equal values of two signatures, estimates |A & B| / |A | B|"""
+	return sum([1 for a, b in zip(values_a, values_b) if a == b]) / MINHASH_SIZE
+
+
+def fingerprint_item(*parts):
+	"""int hash of one item of fingerprint, i.e. (relpath, checksum_algorithm, checksum) of file"""
+	data = "\0".join(["" if p is None else str(p) for p in parts]).encode("utf-8", "surrogateescape")
+	return int.from_bytes(hashlib.blake2b(data, digest_size = FINGERPRINT_BITS // 8).digest(), "big")
+
+
+def update_fingerprint(fingerprint, added_items = (), removed_items = ()):
+	"""fingerprint of multiset of items: sum of hashes of items modulo 2**256, as hex string, None for empty multiset.
+	Sum does not depend on order of items, so it equals to fingerprint of sorted items, and items can be added and removed
+	without hashing all items again
+	
+	arguments: fingerprint - current fingerprint or None
+		added_items, removed_items - lists of tuples, each tuple is one item
+	"""
+	value = int(fingerprint, 16) if fingerprint is not None else 0
+	for item in added_items:
+		value += fingerprint_item(*item)
+	for item in removed_items:
+		value -= fingerprint_item(*item)
+	value %= 1 << FINGERPRINT_BITS
+	if value == 0:
+		# dir without files, such dirs are not copies of each other
+		return None
+	return f"{value:0{FINGERPRINT_BITS // 4}x}"
+
+
+
+class LSHIndex(object):
+	"""Locality-sensitive hashing over MinHash signatures: signatures with equal band are put to the same bucket.
+	With 16 bands of 4 values, sets with Jaccard similarity 0.8 are candidates with probability 0.9998, and with 0.3 - 0.12"""
+
+	def __init__(self, bands = LSH_BANDS):
+		self.bands = bands
+		self.rows = MINHASH_SIZE // bands
+		self._buckets = [{} for i in range(bands)] # for each band: tuple of band values: list of keys
+		self._signatures = {} # key: list of values
+
+
+	def __len__(self):
+		return len(self._signatures)
+
+
+	def _band_keys(self, values):
+		return [tuple(values[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+
+	def add(self, key, values):
+		self._signatures[key] = values
+		for i, band_key in enumerate(self._band_keys(values)):
+			self._buckets[i].setdefault(band_key, []).append(key)
+
+
+	def get(self, key):
+		return self._signatures.get(key)
+
+
+	def candidates(self, values):
+		"""keys of signatures with at least one equal band"""
+		res = set()
+		for i, band_key in enumerate(self._band_keys(values)):
+			res.update(self._buckets[i].get(band_key, []))
+		return res
+
+
+	def query(self, values, threshold = 0.0):
+		"""returns list of tuples (key, estimated jaccard) for candidates with estimation not less than threshold, most similar first"""
+		res = [(key, estimate_jaccard(values, self._signatures[key])) for key in self.candidates(values)]
+		res = [r for r in res if r[1] >= threshold]
+		res.sort(key = lambda r: r[1], reverse = True)
+		return res
+
+
+
+class BloomFilter(object):
+	"""Bloom filter of byte strings: no false negatives, false positives with probability about error_rate
+	while not more than capacity items are added"""
+	
+	def __init__(self, capacity, error_rate = 0.01, num_bits = None, num_hashes = None, bits = None, count = 0):
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.num_bits = num_bits if num_bits is not None else max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+		self.num_hashes = num_hashes if num_hashes is not None else max(1, round(self.num_bits / capacity * math.log(2)))
+		self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+		self.count = count
+	
+	
+	def _positions(self, item):
+		# double hashing: i-th position is h1 + i * h2
+		digest = hashlib.blake2b(item, digest_size = 16).digest()
+		h1 = int.from_bytes(digest[:8], "big")
+		h2 = int.from_bytes(digest[8:], "big") | 1
+		return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+	
+	
+	def add(self, item):
+		for p in self._positions(item):
+			self.bits[p >> 3] |= 1 << (p & 7)
+		self.count += 1
+	
+	
+	def __contains__(self, item):
+		for p in self._positions(item):
+			if not self.bits[p >> 3] & (1 << (p & 7)):
+				return False
+		return True
+	
+	
+	@property
+	def memory_bytes(self):
+		return len(self.bits)
+	
+	
+	@property
+	def estimated_error_rate(self):
+		"""probability of false positive for count items added"""
+		return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+
+class ChecksumFilter(object):
+	"""Bloom filters over (checksum_algorithm, checksum) of all files in DB: seen has every checksum, multi has checksums added more than once.
+	If checksum is not in multi, there is only one file with it in DB, so its copies need not be searched.
+	Items can not be removed from Bloom filter, so removed files only make false positives more likely, until filter is rebuilt"""
+	
+	MIN_CAPACITY = 10000
+	REBUILD_REMOVED_SHARE = 0.25 # filter should be rebuilt when this share of added files was removed
+	FILE_SIGNATURE = b"DCBLOOM1\n"
+	
+	def __init__(self, capacity, error_rate = 0.01):
+		self.capacity = max(self.MIN_CAPACITY, capacity)
+		self.error_rate = error_rate
+		self.seen = BloomFilter(self.capacity, error_rate = error_rate)
+		self.multi = BloomFilter(self.capacity, error_rate = error_rate)
+		self.removed = 0
+		self.stale = False # if True, filter may miss checksums and can not be used till rebuilt
+		self.lookups = 0
+		self.negatives = 0
+		self._lock = threading.Lock()
+	
+	
+	def add(self, checksum, checksum_algorithm):
+		if checksum is None:
+			return
+		key = checksum_key(checksum, checksum_algorithm)
+		with self._lock:
+			if key in self.seen:
+				self.multi.add(key)
+			else:
+				self.seen.add(key)
+	
+	
+	def remove(self, count = 1):
+		with self._lock:
+			self.removed += count
+	
+	
+	def may_have_copies(self, checksum, checksum_algorithm):
+		"""False if there is not more than one file with this checksum and algorithm in DB, True if there may be more"""
+		if self.stale or checksum is None:
+			return True
+		self.lookups += 1
+		if checksum_key(checksum, checksum_algorithm) in self.multi:
+			return True
+		self.negatives += 1
+		return False
+	
+	
+	@property
+	def count(self):
+		return self.seen.count + self.multi.count
+	
+	
+	@property
+	def needs_rebuild(self):
+		return self.stale or self.seen.count > self.capacity or self.removed > self.count * self.REBUILD_REMOVED_SHARE
+	
+	
+	def get_stats(self):
+		return {"files": self.count,
+			"unique_checksums": self.seen.count,
+			"capacity": self.capacity,
+			"removed_files": self.removed,
+			"stale": self.stale,
+			"memory_bytes": self.seen.memory_bytes + self.multi.memory_bytes,
+			"error_rate": self.error_rate,
+			# unique checksum is reported as possible copy if it was found in seen by mistake when added, or is found in multi by mistake
+			"estimated_error_rate": min(1.0, self.seen.estimated_error_rate + self.multi.estimated_error_rate),
+			"lookups": self.lookups,
+			"negatives": self.negatives}
+	
+	
+	def save(self, path_to_file, state = None):
+		"""save filter to file: signature, one line of JSON header with sizes and state, then bits of both filters
+		
+		arguments: state - dict saved in header, i.e. to check that filter matches DB when it is loaded
+		"""
+		header = {"capacity": self.capacity,
+			"error_rate": self.error_rate,
+			"num_bits": self.seen.num_bits,
+			"num_hashes": self.seen.num_hashes,
+			"seen_count": self.seen.count,
+			"multi_count": self.multi.count,
+			"removed": self.removed,
+			"state": state}
+		with self._lock:
+			with open(path_to_file + ".tmp", "wb") as f:
+				f.write(self.FILE_SIGNATURE)
+				f.write(json.dumps(header).encode("utf-8") + b"\n")
+				f.write(self.seen.bits)
+				f.write(self.multi.bits)
+			os.replace(path_to_file + ".tmp", path_to_file)
+	
+	
+	@classmethod
+	def load(cls, path_to_file):
+		"""returns tuple (filter, state saved with it)"""
+		with open(path_to_file, "rb") as f:
+			if f.readline() != cls.FILE_SIGNATURE:
+				raise ValueError(f"{path_to_file} is not a checksum filter file")
+			header = json.loads(f.readline().decode("utf-8"))
+			num_bytes = (header["num_bits"] + 7) // 8
+			seen_bits = bytearray(f.read(num_bytes))
+			multi_bits = bytearray(f.read(num_bytes))
+		if len(seen_bits) != num_bytes or len(multi_bits) != num_bytes:
+			raise ValueError(f"{path_to_file} is truncated")
+		res = cls(header["capacity"], error_rate = header["error_rate"])
+		res.seen = BloomFilter(res.capacity, error_rate = res.error_rate, num_bits = header["num_bits"], num_hashes = header["num_hashes"], bits = seen_bits, count = header["seen_count"])
+		res.multi = BloomFilter(res.capacity, error_rate = res.error_rate, num_bits = header["num_bits"], num_hashes = header["num_hashes"], bits = multi_bits, count = header["multi_count"])
+		res.removed = header["removed"]
+		return res, header["state"]
+	
+
+
+
+class FileIndex(object):
+	"""Read-only compact index of files for set operations by checksum: digests of (checksum_algorithm, checksum) of all files
+	are stored in one bytes object, file ids and dir ids in parallel int arrays, ordered as rows they were loaded from.
+	It takes about 33 bytes per file, File objects with their dicts take kilobytes"""
+	
+	DIGEST_SIZE = 16
+	
+	def __init__(self, ids, dir_ids, digests, has_checksum):
+		self.ids = ids
+		self.dir_ids = dir_ids
+		self.digests = digests
+		self.has_checksum = has_checksum # 1 for files with checksum, files without checksum never match other files
+	
+	
+	@classmethod
+	def from_rows(cls, rows):
+		"""arguments: rows - iterable of tuples (file id, dir id, checksum, checksum_algorithm), i.e. rows streamed from cursor.
+		Each row is packed into arrays as it is read, rows are not kept"""
+		ids = array("q")
+		dir_ids = array("q")
+		digests = bytearray()
+		has_checksum = bytearray()
+		for file_id, dir_id, checksum, checksum_algorithm in rows:
+			ids.append(file_id)
+			dir_ids.append(dir_id if dir_id is not None else -1)
+			digests += hashlib.blake2b(checksum_key(checksum, checksum_algorithm), digest_size = cls.DIGEST_SIZE).digest()
+			has_checksum.append(1 if checksum is not None else 0)
+		return cls(ids, dir_ids, bytes(digests), bytes(has_checksum))
+	
+	
+	def __len__(self):
+		return len(self.ids)
+	
+	
+	def digest(self, i):
+		return self.digests[i * self.DIGEST_SIZE:(i + 1) * self.DIGEST_SIZE]
+	
+	
+	def iter_digests(self):
+		"""yields tuples (position, digest) of files with checksum"""
+		for i in range(len(self.ids)):
+			if self.has_checksum[i]:
+				yield i, self.digest(i)
+	
+	
+	def digest_set(self):
+		return {d for i, d in self.iter_digests()}
+	
+	
+	def matched(self, digests):
+		"""returns bytearray with 1 for each file whose checksum is in digests, 0 for others"""
+		res = bytearray(len(self.ids))
+		for i, d in self.iter_digests():
+			if d in digests:
+				res[i] = 1
+		return res
+	
+	
+	def first_by_digest(self):
+		"""positions of first file with each checksum, files without checksum are grouped by algorithm"""
+		seen = set()
+		res = []
+		for i in range(len(self.ids)):
+			d = self.digest(i)
+			if d not in seen:
+				seen.add(d)
+				res.append(i)
+		return res
+	
+	
+	@property
+	def memory_bytes(self):
+		return len(self.digests) + len(self.has_checksum) + self.ids.itemsize * len(self.ids) + self.dir_ids.itemsize * len(self.dir_ids)
+	
@@ -15,16 +15,18 @@ import logging
 import logging.handlers
 
 
-from sqlalchemy_declarative import DeclarativeBase, File, Directory
-from sqlalchemy import create_engine, select, Index, inspect
-from sqlalchemy.orm import joinedload
+from sqlalchemy_declarative import DeclarativeBase, File, Directory, HashCacheRecord, DuplicateGroup
+from sqlalchemy import create_engine, select, Index, inspect, text, func, case, and_
+from sqlalchemy.orm import joinedload, aliased, contains_eager
 
 sys.path.append("./")
 from base import *
 from tasks import *
+from indexes import ChecksumFilter, FileIndex
+from hashing import create_hashing_engine, DeviceScheduler, normalize_block_size, format_extra_checksums, parse_extra_checksums, parse_tree_algorithm, LEGACY_CHECKSUM_LENGTHS, DEFAULT_BLOCK_SIZE, DEFAULT_PARTIAL_SIZE, DEFAULT_TREE_CHUNK_SIZE, MIB
 		
 
-"""All managers: BaseManager, FileManager, DirManager, TaskManager, DBManager
+"""All managers: BaseManager, FileManager, DirManager, HashCacheManager, DuplicateGroupManager, TaskManager, DBManager
 """
 
 
@@ -112,7 +114,11 @@ class FileManager(BaseManager):
 	
 	def __init__(self, logger = None):
 		super(FileManager, self).__init__(logger = logger)
-		pass
+		self.checksum_filter = None # ChecksumFilter of all files in DB, None if disabled
+		self.checksum_filter_file = None
+		self.checksum_filter_error_rate = 0.01
+		self._checksum_filter_lock = threading.Lock()
+		self._checksum_filter_pending = [] # one list for each running rebuild: changes made while filter is built, replayed after it is built
 	
 	
 	def get_by_id(self, _id, session = None):
@@ -127,15 +133,18 @@ class FileManager(BaseManager):
 		return res
 	
 	
-	def get_by_checksum(self, checksum, idir = None, session = None):
+	def get_by_checksum(self, checksum, idir = None, session = None, checksum_algorithm = None):
+		"""get files with checksum, only from enabled dirs. If checksum_algorithm is set, only files with this algorithm are returned"""
 		if session is None:
 			_session = self.get_session(nonblocking = True)
 		else:
 			_session = session
-		if idir is None:
-			res = _session.query(File).options(joinedload(File.dir)).filter(File.checksum == checksum, File.dir.has(Directory.enabled == True)).all()
-		else:
-			res = _session.query(File).options(joinedload(File.dir)).filter(File.checksum == checksum, File.dir_id == idir.id, File.dir.has(Directory.enabled == True)).all()
+		query = _session.query(File).options(joinedload(File.dir)).filter(File.checksum == checksum, File.dir.has(Directory.enabled == True))
+		if idir is not None:
+			query = query.filter(File.dir_id == idir.id)
+		if checksum_algorithm is not None:
+			query = query.filter(File.checksum_algorithm == checksum_algorithm)
+		res = query.all()
 		if session is None:
 			self.close_session(_session, commit = False)
 		return res
@@ -155,20 +164,36 @@ class FileManager(BaseManager):
 	def create(self,
 		path_to_file,
 		checksum = "",
+		checksum_algorithm = None,
+		extra_checksums = None,
 		date_added = None,
 		date_checked = None,
 		is_etalon = False,
 		comment = "",
+		st_size = None,
+		st_mtime_ns = None,
+		st_ino = None,
+		st_dev = None,
 		_dir = None,
+		dir_id = None,
 		save_disabled = False,
 		session = None):
 		new_file = File(full_path = path_to_file,
 			checksum = checksum,
-			dir = _dir,
+			checksum_algorithm = checksum_algorithm,
+			extra_checksums = format_extra_checksums(extra_checksums),
 			date_added = date_added,
 			date_checked = date_checked,
 			is_etalon = is_etalon,
-			comment = comment)
+			comment = comment,
+			st_size = st_size,
+			st_mtime_ns = st_mtime_ns,
+			st_ino = st_ino,
+			st_dev = st_dev)
+		if _dir is not None:
+			new_file.dir = _dir
+		else:
+			new_file.dir_id = dir_id
 		if save_disabled:
 			return new_file
 		if session is None:
@@ -176,26 +201,383 @@ class FileManager(BaseManager):
 		else:
 			_session = session
 		_session.add(new_file)
+		_session.flush()
+		self.update_dir_fingerprints(new_file.dir_id, added = [(new_file.full_path, new_file.checksum_algorithm, new_file.checksum)], session = _session)
+		self.add_to_checksum_filter([(new_file.checksum, new_file.checksum_algorithm)])
+		self.rebuild_checksum_filter_if_needed(session = _session)
 		if session is None:
 			self.close_session(_session, commit = True)
 		return new_file
 	
 	
+	def bulk_create(self, file_dicts, dir_id = None, is_etalon = False, session = None):
+		"""insert many files at once using SQLAlchemy Core executemany, without creating ORM objects
+		
+		arguments: file_dicts - list of dicts with keys full_path, checksum, checksum_algorithm, extra_checksums (dict), date_added, date_checked,
+				and optionally st_size, st_mtime_ns, st_ino, st_dev
+			dir_id - id of already saved dir which will contain files
+		returns: number of inserted files
+		"""
+		if len(file_dicts) == 0:
+			return 0
+		rows = [{"full_path": d["full_path"],
+			"checksum": d["checksum"],
+			"checksum_algorithm": d.get("checksum_algorithm"),
+			"extra_checksums": format_extra_checksums(d.get("extra_checksums")),
+			"date_added": d.get("date_added"),
+			"date_checked": d.get("date_checked"),
+			"is_etalon": d.get("is_etalon", is_etalon),
+			"comment": d.get("comment", ""),
+			"st_size": d.get("st_size"),
+			"st_mtime_ns": d.get("st_mtime_ns"),
+			"st_ino": d.get("st_ino"),
+			"st_dev": d.get("st_dev"),
+			"dir_id": dir_id} for d in file_dicts]
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		_session.execute(File.__table__.insert(), rows)
+		self.update_dir_fingerprints(dir_id, added = [(r["full_path"], r["checksum_algorithm"], r["checksum"]) for r in rows], session = _session)
+		self.add_to_checksum_filter([(r["checksum"], r["checksum_algorithm"]) for r in rows])
+		self.rebuild_checksum_filter_if_needed(session = _session)
+		if session is None:
+			self.close_session(_session, commit = True)
+		self._logger.debug(f"bulk_create: inserted {len(rows)} files into dir {dir_id}")
+		return len(rows)
+	
+	
+	def delete(self, obj, session = None):
+		removed = [(obj.full_path, obj.checksum_algorithm, obj.checksum)]
+		dir_id = obj.dir_id
+		if not super(FileManager, self).delete(obj, session = session):
+			return False
+		self.update_dir_fingerprints(dir_id, removed = removed, session = session)
+		if self.checksum_filter is not None:
+			self.checksum_filter.remove()
+			if session is None:
+				self.rebuild_checksum_filter_if_needed()
+		return True
+	
+	
+	def delete_many(self, files, session = None):
+		"""delete files in one session with one commit, fingerprints of each dir are updated once. Returns number of deleted files.
+		Checksum filter is not rebuilt here, caller calls rebuild_checksum_filter_if_needed once after all files are deleted"""
+		if len(files) == 0:
+			return 0
+		removed_by_dir = {}
+		for f in files:
+			removed_by_dir.setdefault(f.dir_id, []).append((f.full_path, f.checksum_algorithm, f.checksum))
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		try:
+			for f in files:
+				_session.delete(f)
+			_session.flush()
+			for dir_id, removed in removed_by_dir.items():
+				self.update_dir_fingerprints(dir_id, removed = removed, session = _session)
+		except Exception as e:
+			self._logger.error(f"delete_many: got error while deleting {len(files)} files: {e}, traceback: {traceback.format_exc()}")
+			_session.rollback()
+			if session is None:
+				self.close_session(_session, commit = False)
+			raise
+		if session is None:
+			self.close_session(_session, commit = True)
+		if self.checksum_filter is not None:
+			self.checksum_filter.remove(len(files))
+		self._logger.debug(f"delete_many: deleted {len(files)} files")
+		return len(files)
+	
+	
+	def delete_by_dir(self, dir_id, session = None):
+		"""delete all files of dir by one query, without loading them. Returns number of deleted files"""
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		res = _session.execute(File.__table__.delete().where(File.__table__.c.dir_id == dir_id)).rowcount
+		if session is None:
+			self.close_session(_session, commit = True)
+		if self.checksum_filter is not None:
+			self.checksum_filter.remove(res)
+		self._logger.debug(f"delete_by_dir: deleted {res} files of dir {dir_id}")
+		return res
+	
+	
+	def get_files_state(self, session = None):
+		"""number of files and max id of file in DB, to check that saved checksum filter matches DB"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		files_count, max_id = _session.query(func.count(File.id), func.max(File.id)).one()
+		if session is None:
+			self.close_session(_session, commit = False)
+		return {"files_count": files_count, "max_id": max_id}
+	
+	
+	def init_checksum_filter(self, path_to_file, error_rate = 0.01):
+		"""load checksum filter from file, saved on previous shutdown. If there is no file or DB was changed after it was saved,
+		filter is built from all files in DB"""
+		self.checksum_filter_file = path_to_file
+		self.checksum_filter_error_rate = error_rate
+		try:
+			if os.path.isfile(path_to_file):
+				loaded_filter, state = ChecksumFilter.load(path_to_file)
+				saved_mtime = os.stat(path_to_file).st_mtime_ns
+				db_changed = [p for p in (self._db_manager.DB_FILE, self._db_manager.DB_FILE + "-journal", self._db_manager.DB_FILE + "-wal") if os.path.isfile(p) and os.stat(p).st_mtime_ns > saved_mtime]
+				if len(db_changed) == 0 and state == self.get_files_state() and loaded_filter.error_rate == error_rate:
+					self.checksum_filter = loaded_filter
+					self._logger.info(f"init_checksum_filter: filter loaded from {path_to_file}, stats: {self.checksum_filter.get_stats()}")
+					return
+				self._logger.info(f"init_checksum_filter: filter in {path_to_file} does not match DB, will rebuild it")
+		except Exception as e:
+			self._logger.error(f"init_checksum_filter: could not load filter from {path_to_file}: {e}, will rebuild it")
+		self.build_checksum_filter()
+	
+	
+	def add_to_checksum_filter(self, items):
+		"""add (checksum, checksum_algorithm) of new files to filter. If filter is being rebuilt, items are also recorded
+		and added to new filter after it is built, as they may be missing from files it was built from"""
+		with self._checksum_filter_lock:
+			if self.checksum_filter is not None:
+				for checksum, checksum_algorithm in items:
+					self.checksum_filter.add(checksum, checksum_algorithm)
+			for pending in self._checksum_filter_pending:
+				pending.extend(items)
+	
+	
+	def build_checksum_filter(self, session = None):
+		"""build new checksum filter from checksums of all files in DB, twice as large as needed now, and replace current one.
+		Files added while filter is built are added to it before it replaces current one"""
+		pending = []
+		with self._checksum_filter_lock:
+			self._checksum_filter_pending.append(pending)
+		try:
+			if session is None:
+				_session = self.get_session()
+			else:
+				_session = session
+			t_start = time.time()
+			files_count = _session.query(func.count(File.id)).scalar()
+			new_filter = ChecksumFilter(2 * files_count, error_rate = self.checksum_filter_error_rate)
+			for checksum, checksum_algorithm in _session.query(File.checksum, File.checksum_algorithm).filter(File.checksum != None).yield_per(10000):
+				new_filter.add(checksum, checksum_algorithm)
+			if session is None:
+				self.close_session(_session, commit = False)
+			with self._checksum_filter_lock:
+				# file added while filter was built and also read from DB is added twice, so it is only reported as possible copy
+				for item in pending:
+					if item is None:
+						new_filter.stale = True
+					else:
+						new_filter.add(*item)
+				self.checksum_filter = new_filter
+		finally:
+			with self._checksum_filter_lock:
+				self._checksum_filter_pending.remove(pending)
+		self._logger.info(f"build_checksum_filter: filter built in {time.time() - t_start:.3f}s, stats: {new_filter.get_stats()}")
+	
+	
+	def rebuild_checksum_filter_if_needed(self, session = None):
+		"""rebuild filter when it is full, stale, or many files were removed from DB after it was built"""
+		if self.checksum_filter is not None and self.checksum_filter.needs_rebuild:
+			self.build_checksum_filter(session = session)
+	
+	
+	def invalidate_checksum_filter(self):
+		"""filter can not be used after DB is changed bypassing managers, till it is rebuilt"""
+		with self._checksum_filter_lock:
+			if self.checksum_filter is not None:
+				self.checksum_filter.stale = True
+			# filter being rebuilt now may also miss these changes
+			for pending in self._checksum_filter_pending:
+				pending.append(None)
+	
+	
+	def save_checksum_filter(self):
+		if self.checksum_filter is None or self.checksum_filter_file is None:
+			return
+		if self.checksum_filter.stale:
+			if os.path.isfile(self.checksum_filter_file):
+				os.unlink(self.checksum_filter_file)
+			return
+		try:
+			self.checksum_filter.save(self.checksum_filter_file, state = self.get_files_state())
+			self._logger.info(f"save_checksum_filter: filter saved to {self.checksum_filter_file}")
+		except Exception as e:
+			self._logger.error(f"save_checksum_filter: could not save filter to {self.checksum_filter_file}: {e}")
+	
+	
+	def may_have_copies(self, checksum, checksum_algorithm):
+		"""False if DB definitely has no other file with this checksum and algorithm, so DB need not be queried. Without filter always True"""
+		if self.checksum_filter is None:
+			return True
+		return self.checksum_filter.may_have_copies(checksum, checksum_algorithm)
+	
+	
+	def update_dir_fingerprints(self, dir_id, added = (), removed = (), session = None):
+		"""update fingerprints of dir incrementally, when its files are added or removed
+		
+		arguments: added, removed - lists of tuples (full_path, checksum_algorithm, checksum) of files
+		"""
+		if dir_id is None:
+			return
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		target_dir = _session.query(Directory).get(dir_id)
+		if target_dir is not None:
+			update_dir_fingerprints(target_dir, added_files = added, removed_files = removed)
+		if session is None:
+			self.close_session(_session, commit = True)
+	
+	
+	def get_count(self, dir_id, session = None):
+		"""number of files in dir, without loading them"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		res = _session.query(func.count(File.id)).filter(File.dir_id == dir_id).scalar()
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def compare_dirs(self, dir_a_id, dir_b_id, session, batch_size = 10000):
+		"""compare two saved dirs in DB by one query: files of both dirs joined to their checksums grouped by dir
+		
+		returns: generator of rows (id, dir_id, matched, full_path, checksum, checksum_algorithm), ordered by file id. matched is True
+			if there is a file with the same checksum and checksum_algorithm in other dir. Enabled state of dirs is not checked here.
+			Rows are read from cursor by batch_size while generator is consumed, so session should stay open and File objects are not created
+		"""
+		files = File.__table__
+		groups = select(files.c.checksum,
+			files.c.checksum_algorithm,
+			func.sum(case((files.c.dir_id == dir_a_id, 1), else_ = 0)).label("in_a"),
+			func.sum(case((files.c.dir_id == dir_b_id, 1), else_ = 0)).label("in_b")).where(files.c.dir_id.in_([dir_a_id, dir_b_id]), files.c.checksum != None).group_by(files.c.checksum, files.c.checksum_algorithm).subquery()
+		matched = and_(groups.c.in_a > 0, groups.c.in_b > 0).label("matched")
+		query = select(files.c.id, files.c.dir_id, matched, files.c.full_path, files.c.checksum, files.c.checksum_algorithm).select_from(files.outerjoin(groups, and_(files.c.checksum == groups.c.checksum, files.c.checksum_algorithm.is_(groups.c.checksum_algorithm)))).where(files.c.dir_id.in_([dir_a_id, dir_b_id])).order_by(files.c.id)
+		count = 0
+		for rows in session.execute(query.execution_options(stream_results = True)).partitions(batch_size):
+			count += len(rows)
+			yield from rows
+		self._logger.debug(f"compare_dirs: got {count} files of dirs {dir_a_id} and {dir_b_id}")
+	
+	
+	def get_file_rows(self, ids, session = None):
+		"""rows (id, dir_id, full_path, checksum, checksum_algorithm) of files with given ids, ordered by id, without loading File objects"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		files = File.__table__
+		CHUNK_SIZE = 500
+		res = []
+		for i in range(0, len(ids), CHUNK_SIZE):
+			res += _session.execute(select(files.c.id, files.c.dir_id, files.c.full_path, files.c.checksum, files.c.checksum_algorithm).where(files.c.id.in_(ids[i:i + CHUNK_SIZE]))).all()
+		res.sort(key = lambda r: r.id)
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def find_equal_names_diff_checksums(self, dir_a, dir_b, session, batch_size = 10000):
+		"""files of two saved dirs with the same path relative to their dir, hashed with the same algorithm, with different checksums
+		
+		returns: generator of tuples (row of A, row of B), ordered by relative path. Rows have id, dir_id, full_path, checksum, checksum_algorithm.
+			Files of both dirs are read by one query sorted by relative path, file of A before file of B, so files with the same path
+			are adjacent and pairs are found while rows are read from cursor, nothing is accumulated in memory.
+			Files without checksum (i.e. files that do not exist) are skipped
+		"""
+		files = File.__table__
+		# all files of dir are under it, so path relative to dir is the rest of full path after "dir/"
+		relpath = func.substr(files.c.full_path, case((files.c.dir_id == dir_a.id, len(dir_a.full_path) + 2), else_ = len(dir_b.full_path) + 2)).label("relpath")
+		query = select(files.c.id, files.c.dir_id, files.c.full_path, files.c.checksum, files.c.checksum_algorithm, relpath).where(files.c.dir_id.in_([dir_a.id, dir_b.id]), files.c.checksum != None).order_by(relpath, files.c.dir_id == dir_b.id)
+		previous = None
+		count = 0
+		for rows in session.execute(query.execution_options(stream_results = True)).partitions(batch_size):
+			for r in rows:
+				if previous is not None and previous.dir_id == dir_a.id and r.dir_id == dir_b.id and previous.relpath == r.relpath and previous.checksum_algorithm == r.checksum_algorithm and previous.checksum != r.checksum:
+					count += 1
+					yield previous, r
+				previous = r
+		self._logger.debug(f"find_equal_names_diff_checksums: found {count} pairs in dirs {dir_a.id} and {dir_b.id}")
+	
+	
+	def get_file_index(self, dir_ids, session = None, enabled_only = False, batch_size = 10000):
+		"""compact FileIndex of files of dirs, ordered by file id. Rows are streamed from cursor by batch_size into arrays of index,
+		File objects are not created and rows are not accumulated"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		files = File.__table__
+		query = select(files.c.id, files.c.dir_id, files.c.checksum, files.c.checksum_algorithm).where(files.c.dir_id.in_(dir_ids))
+		if enabled_only:
+			query = query.where(files.c.dir_id.in_(select(Directory.__table__.c.id).where(Directory.__table__.c.enabled == True)))
+		result = _session.execute(query.order_by(files.c.id).execution_options(stream_results = True))
+		res = FileIndex.from_rows(r for rows in result.partitions(batch_size) for r in rows)
+		if session is None:
+			self.close_session(_session, commit = False)
+		self._logger.debug(f"get_file_index: got {len(res)} files of dirs {dir_ids}, {res.memory_bytes} bytes")
+		return res
+	
+	
+	def get_by_ids(self, ids, session = None):
+		"""files with given ids, ordered by id. Files are queried by chunks, to not exceed SQLite variables limit"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		CHUNK_SIZE = 500
+		res = []
+		for i in range(0, len(ids), CHUNK_SIZE):
+			res += _session.query(File).filter(File.id.in_(ids[i:i + CHUNK_SIZE])).all()
+		res.sort(key = lambda f: f.id)
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
 	def find_copies(self, _file, session = None, ignore_same_fullpath = True):
 		if session is None:
 			_session = self.get_session()
 		else:
 			_session = session
 		if ignore_same_fullpath:
-			res = _session.query(File).filter(File.checksum == _file.checksum, File.full_path != _file.full_path, File.dir.has(Directory.enabled == True)).all()
+			res = _session.query(File).filter(File.checksum == _file.checksum, File.checksum_algorithm == _file.checksum_algorithm, File.full_path != _file.full_path, File.dir.has(Directory.enabled == True)).all()
 		else:
-			res = _session.query(File).filter(File.checksum == _file.checksum, File.dir.has(Directory.enabled == True)).all()
+			res = _session.query(File).filter(File.checksum == _file.checksum, File.checksum_algorithm == _file.checksum_algorithm, File.dir.has(Directory.enabled == True)).all()
 		if session is None:
 			self.close_session(_session, commit = False)
 		self._logger.debug(f"find_copies: searched for copies of file {_file.full_path}, found: {len(res)}")
 		return res
 	
 	
+	def find_copies_of_dir(self, dir_id, session, ignore_same_fullpath = True, batch_size = 1000):
+		"""find copies of all files of dir by one query: files of dir are joined with files of enabled dirs by checksum and checksum_algorithm
+		
+		returns: generator of tuples (id of original file, copy), ordered by original id, then by copy id.
+			Rows are fetched from DB by batch_size, so session should stay open while generator is consumed.
+			Files of dir without checksum have no copies. Copies are not filtered by dir, dir itself is not excluded
+		"""
+		original = aliased(File)
+		query = session.query(original.id, File).join(File, and_(File.checksum == original.checksum, File.checksum_algorithm.is_(original.checksum_algorithm))).join(File.dir).filter(original.dir_id == dir_id, original.checksum != None, Directory.enabled == True).options(contains_eager(File.dir))
+		if ignore_same_fullpath:
+			query = query.filter(File.full_path != original.full_path)
+		count = 0
+		for original_id, _copy in query.order_by(original.id, File.id).yield_per(batch_size):
+			count += 1
+			yield original_id, _copy
+		self._logger.debug(f"find_copies_of_dir: searched for copies of files of dir {dir_id}, found: {count}")
+	
+	
 
 class DirManager(BaseManager):
 	"""Responsible for all directory operations (CRUD and other)"""
@@ -270,6 +652,64 @@ class DirManager(BaseManager):
 		return new_dir
 	
 	
+	def get_by_fingerprint(self, fingerprint, content_only = False, session = None):
+		"""dirs with the same fingerprint, i.e. exact copies of dir. With content_only dirs are matched by content_fingerprint, so names of files can differ.
+		Dir without files has no fingerprint and has no copies"""
+		if fingerprint is None:
+			return []
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		column = Directory.content_fingerprint if content_only else Directory.fingerprint
+		res = _session.query(Directory).filter(column == fingerprint).order_by(Directory.id).all()
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def get_minhash_list(self, session = None):
+		"""tuples (id, minhash) of enabled dirs which have MinHash signature"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		res = _session.query(Directory.id, Directory.minhash).filter(Directory.enabled == True, Directory.minhash != None).all()
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def get_ids_without_minhash(self, session = None):
+		"""ids of dirs with files, whose MinHash signature should be computed again because files were removed.
+		Dirs without any checksum have no signature at all and are not returned"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		has_checksums = _session.query(File.id).filter(File.dir_id == Directory.id, File.checksum != None).exists()
+		res = [r.id for r in _session.query(Directory.id).filter(Directory.minhash == None, Directory.fingerprint != None, has_checksums).all()]
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def compute_fingerprints(self, dir_id, session = None):
+		"""compute fingerprints and MinHash signature of dir from all its files, i.e. when paths of files are changed or files were removed"""
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		target_dir = _session.query(Directory).get(dir_id)
+		target_dir.fingerprint = None
+		target_dir.content_fingerprint = None
+		target_dir.minhash = None
+		update_dir_fingerprints(target_dir, added_files = _session.query(File.full_path, File.checksum_algorithm, File.checksum).filter(File.dir_id == dir_id).all())
+		self._logger.debug(f"compute_fingerprints: dir {dir_id} fingerprint: {target_dir.fingerprint}, content fingerprint: {target_dir.content_fingerprint}")
+		if session is None:
+			self.close_session(_session, commit = True)
+	
+	
 	def directory_exist(self, path_to_dir):
 		res = self.get_by_path(path_to_dir)
 		if (type(res) == type(list()) and len(res) != 0):
@@ -279,6 +719,199 @@ class DirManager(BaseManager):
 		
 
 
+class HashCacheManager(BaseManager):
+	"""Checksums of files keyed by (st_dev, st_ino, st_size, st_mtime_ns), so unchanged files are not hashed again"""
+	
+	def __init__(self, logger = None):
+		super(HashCacheManager, self).__init__(logger = logger)
+		self.LOOKUP_CHUNK_SIZE = 500 # not more than this number of inodes in one query
+	
+	
+	def lookup(self, file_dicts, checksum_algorithm, extra_checksum_algorithms = (), session = None):
+		"""set cached checksums for files that did not change since they were hashed
+		
+		arguments: file_dicts - list of dicts with keys full_path, st_dev, st_ino, st_size, st_mtime_ns (as from scan_dir with_stat = True)
+			checksum_algorithm - algorithm of main checksum, if file dict has no own checksum_algorithm key
+			extra_checksum_algorithms - cached record is used only if it has all these extra checksums (not for tree checksums)
+		returns: file_dicts, found files have checksum, checksum_algorithm, extra_checksums, date_start, date_end set and from_hash_cache = True
+		"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		found = 0
+		for i in range(0, len(file_dicts), self.LOOKUP_CHUNK_SIZE):
+			chunk = [d for d in file_dicts[i:i + self.LOOKUP_CHUNK_SIZE] if "st_ino" in d]
+			if len(chunk) == 0:
+				continue
+			algorithms = set([d.get("checksum_algorithm", checksum_algorithm) for d in chunk])
+			records = {}
+			for rec in _session.query(HashCacheRecord).filter(HashCacheRecord.st_ino.in_([d["st_ino"] for d in chunk]), HashCacheRecord.checksum_algorithm.in_(algorithms)).all():
+				records[(rec.st_dev, rec.st_ino, rec.checksum_algorithm)] = rec
+			now = datetime.datetime.now()
+			for d in chunk:
+				algorithm = d.get("checksum_algorithm", checksum_algorithm)
+				rec = records.get((d["st_dev"], d["st_ino"], algorithm))
+				if rec is None or rec.st_size != d["st_size"] or rec.st_mtime_ns != d["st_mtime_ns"]:
+					continue
+				required_extra_algorithms = [a for a in extra_checksum_algorithms if a != algorithm] if parse_tree_algorithm(algorithm) is None else []
+				extra_checksums = parse_extra_checksums(rec.extra_checksums)
+				if not all(a in extra_checksums for a in required_extra_algorithms):
+					continue
+				d["checksum"] = rec.checksum
+				d["checksum_algorithm"] = rec.checksum_algorithm
+				d["extra_checksums"] = {a: extra_checksums[a] for a in required_extra_algorithms}
+				d["date_start"] = now
+				d["date_end"] = now
+				d["from_hash_cache"] = True
+				found += 1
+		if session is None:
+			self.close_session(_session, commit = False)
+		self._logger.debug(f"lookup: found {found} of {len(file_dicts)} files in hash cache")
+		return file_dicts
+	
+	
+	def store(self, file_dicts, session = None):
+		"""save checksums of hashed files, replacing old records for the same inodes
+		
+		arguments: file_dicts - list of results of get_file_checksum for dicts from scan_dir with_stat = True
+		returns: number of saved records
+		"""
+		rows = [{"st_dev": d["st_dev"],
+			"st_ino": d["st_ino"],
+			"st_size": d["st_size"],
+			"st_mtime_ns": d["st_mtime_ns"],
+			"checksum_algorithm": d["checksum_algorithm"],
+			"checksum": d["checksum"],
+			"extra_checksums": format_extra_checksums(d.get("extra_checksums")),
+			"date_checked": d.get("date_end")} for d in file_dicts if "st_ino" in d and d.get("checksum") is not None]
+		if len(rows) == 0:
+			return 0
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		_session.execute(HashCacheRecord.__table__.insert().prefix_with("OR REPLACE"), rows)
+		if session is None:
+			self.close_session(_session, commit = True)
+		self._logger.debug(f"store: saved {len(rows)} records to hash cache")
+		return len(rows)
+	
+	
+	def clear(self, session = None):
+		"""delete all records from hash cache"""
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		_session.execute(HashCacheRecord.__table__.delete())
+		if session is None:
+			self.close_session(_session, commit = True)
+		self._logger.info("clear: hash cache cleared")
+	
+	
+
+class DuplicateGroupManager(BaseManager):
+	"""Results of FindAllDuplicatesTask: groups of files with the same checksum, stored for each task"""
+	
+	def __init__(self, logger = None):
+		super(DuplicateGroupManager, self).__init__(logger = logger)
+		self.MAX_FILE_IDS = 100 # ids of not more than this number of files are stored for each group, files_count is number of all files
+		self.CHUNK_SIZE = 500 # checksums in one query of file ids, to not exceed SQLite variables limit
+	
+	
+	def find_groups(self, session, batch_size = 1000):
+		"""scan all files once, grouped by checksum and checksum_algorithm, using index on them
+		
+		returns: generator of lists of dicts (not more than batch_size in each list) with keys checksum, checksum_algorithm, files_count,
+			file_size, wasted_bytes, file_ids - for each checksum that has more than one path in enabled dirs.
+			Rows are read from cursor while generator is consumed, so session should stay open
+		"""
+		files = File.__table__
+		# dir_id + 0 is not indexed, so SQLite reads files in order of index on checksums and returns groups one by one, without sorting all files first
+		enabled_dirs = select(Directory.__table__.c.id).where(Directory.__table__.c.enabled == True)
+		query = select(files.c.checksum,
+			files.c.checksum_algorithm,
+			func.count(files.c.full_path.distinct()).label("files_count"),
+			func.max(files.c.st_size).label("file_size")).where(files.c.checksum != None, (files.c.dir_id + 0).in_(enabled_dirs)).group_by(files.c.checksum, files.c.checksum_algorithm).having(func.count(files.c.full_path.distinct()) > 1)
+		result = session.execute(query.execution_options(stream_results = True))
+		for rows in result.partitions(batch_size):
+			groups = [{"checksum": r.checksum,
+				"checksum_algorithm": r.checksum_algorithm,
+				"files_count": r.files_count,
+				"file_size": r.file_size,
+				"wasted_bytes": r.file_size * (r.files_count - 1) if r.file_size is not None else 0} for r in rows]
+			self.fill_file_ids(groups, session)
+			yield groups
+	
+	
+	def fill_file_ids(self, groups, session):
+		"""set file_ids of groups ("id,id,id", lowest ids first) by second query keyed by checksums of groups.
+		Ids are not concatenated in SQL, so group of many files (i.e. of empty files) does not make one huge string,
+		not more than MAX_FILE_IDS ids are kept for each group"""
+		files = File.__table__
+		enabled_dirs = select(Directory.__table__.c.id).where(Directory.__table__.c.enabled == True)
+		ids = {(g["checksum"], g["checksum_algorithm"]): [] for g in groups}
+		checksums = sorted(set([g["checksum"] for g in groups]))
+		for i in range(0, len(checksums), self.CHUNK_SIZE):
+			query = select(files.c.id, files.c.checksum, files.c.checksum_algorithm).where(files.c.checksum.in_(checksums[i:i + self.CHUNK_SIZE]), (files.c.dir_id + 0).in_(enabled_dirs)).order_by(files.c.id)
+			for r in session.execute(query):
+				group_ids = ids.get((r.checksum, r.checksum_algorithm))
+				if group_ids is not None and len(group_ids) < self.MAX_FILE_IDS:
+					group_ids.append(r.id)
+		for g in groups:
+			g["file_ids"] = ",".join([str(i) for i in ids[(g["checksum"], g["checksum_algorithm"])]])
+		return groups
+	
+	
+	def store(self, task_id, groups, session = None):
+		"""save groups of one task, groups are dicts as from find_groups"""
+		if len(groups) == 0:
+			return 0
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		_session.execute(DuplicateGroup.__table__.insert(), [dict(g, task_id = task_id) for g in groups])
+		if session is None:
+			self.close_session(_session, commit = True)
+		return len(groups)
+	
+	
+	def get_count(self, task_id, session = None):
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		res = _session.query(func.count(DuplicateGroup.id)).filter(DuplicateGroup.task_id == task_id).scalar()
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def get_page(self, task_id, page = 0, page_size = 50, session = None):
+		"""groups of task sorted by wasted bytes, largest first"""
+		if session is None:
+			_session = self.get_session(nonblocking = True)
+		else:
+			_session = session
+		res = _session.query(DuplicateGroup).filter(DuplicateGroup.task_id == task_id).order_by(DuplicateGroup.wasted_bytes.desc(), DuplicateGroup.id).offset(page * page_size).limit(page_size).all()
+		if session is None:
+			self.close_session(_session, commit = False)
+		return res
+	
+	
+	def delete_by_task(self, task_id, session = None):
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		_session.execute(DuplicateGroup.__table__.delete().where(DuplicateGroup.__table__.c.task_id == task_id))
+		if session is None:
+			self.close_session(_session, commit = True)
+	
+
+
 class TaskManager(BaseManager):
 	"""Create, run and manage tasks"""
 	
@@ -288,11 +921,53 @@ class TaskManager(BaseManager):
 		dir_manager = None,
 		checksum_algorithm = "md5",
 		ignore_duplicates = False,
-		task_autostart = False):
+		task_autostart = False,
+		max_processes = 2,
+		hashing_engine_type = "process",
+		hash_block_size = DEFAULT_BLOCK_SIZE,
+		extra_checksum_algorithms = (),
+		hash_cache_manager = None,
+		hash_cache_paranoid = False,
+		partial_hash_size = DEFAULT_PARTIAL_SIZE,
+		tree_hash_threshold = 0,
+		tree_hash_chunk_size = DEFAULT_TREE_CHUNK_SIZE,
+		readers_per_hdd = 1,
+		readers_per_ssd = 4,
+		parallel_devices = False,
+		read_order = "listing",
+		use_fadvise = True,
+		rate_limit = 0,
+		task_rate_limit = 0,
+		compare_engine = "auto",
+		similarity_threshold = 0.8):
 		super(TaskManager, self).__init__(logger = logger)
 		self._file_manager = file_manager
 		self._dir_manager = dir_manager
+		self._hash_cache_manager = hash_cache_manager # if None, hash cache is not used
+		self._duplicate_group_manager = None
+		self.hash_cache_paranoid = hash_cache_paranoid # if True, CheckDirTask always hashes files, ignoring hash cache
+		self.partial_hash_size = partial_hash_size # size of head and of tail of file for AddPossibleDuplicatesTask
+		self.tree_hash_threshold = tree_hash_threshold # files of this size and larger get tree checksum, 0 disables
+		self.tree_hash_chunk_size = tree_hash_chunk_size
 		self.checksum_algorithm = checksum_algorithm
+		self.max_processes = max_processes
+		self.hashing_engine_type = hashing_engine_type
+		self.hash_block_size = normalize_block_size(hash_block_size)
+		self.extra_checksum_algorithms = list(extra_checksum_algorithms)
+		self.readers_per_hdd = readers_per_hdd # max number of files read at once from one HDD
+		self.readers_per_ssd = readers_per_ssd # the same for SSD, NVMe and devices of unknown type, 0 - no limit
+		self.parallel_devices = parallel_devices # if True, autostart runs add dir tasks for different devices at once
+		self.read_order = read_order # order of reading files, one of hashing.READ_ORDER_STRATEGIES
+		self.use_fadvise = use_fadvise # drop hashed files from page cache
+		self.rate_limit = rate_limit # bytes per second read by all tasks together, 0 - no limit
+		self.task_rate_limit = task_rate_limit # bytes per second read by one task, 0 - no limit
+		self.compare_engine = compare_engine # engine of CompareDirsTask: memory, index, sql or auto
+		self.similarity_threshold = similarity_threshold # minimal estimated share of the same files for FindSimilarDirsTask
+		self._hashing_engine = None
+		self._hashing_scheduler = None
+		self._rate_limiter = None
+		self._rate_limiter_key = None
+		self._hashing_engine_lock = threading.Lock()
 		self.ignore_duplicates = ignore_duplicates
 		self.current_tasks = [] # only tasks from this session
 		self.autostart_enabled = task_autostart
@@ -350,6 +1025,60 @@ class TaskManager(BaseManager):
 		return False if self.current_running_task is None else True
 	
 	
+	@property
+	def hashing_engine(self):
+		"""long-lived hashing engine (pool of processes or threads), shared by all tasks. Created on first use"""
+		with self._hashing_engine_lock:
+			if self._hashing_engine is None:
+				self._hashing_engine = create_hashing_engine(self.hashing_engine_type,
+					workers = self.max_processes,
+					logger = self._logger.getChild("HashingEngine"))
+				self._logger.info(f"hashing_engine: created {self._hashing_engine}")
+			return self._hashing_engine
+	
+	
+	@property
+	def hashing_scheduler(self):
+		"""DeviceScheduler over hashing_engine, limits number of readers for each device. Shared by all tasks"""
+		engine = self.hashing_engine
+		with self._hashing_engine_lock:
+			if self._hashing_scheduler is None or self._hashing_scheduler.engine is not engine:
+				self._hashing_scheduler = DeviceScheduler(engine,
+					readers_per_hdd = self.readers_per_hdd,
+					readers_per_ssd = self.readers_per_ssd,
+					logger = self._logger.getChild("DeviceScheduler"))
+				self._logger.info(f"hashing_scheduler: created {self._hashing_scheduler}")
+			return self._hashing_scheduler
+	
+	
+	@property
+	def rate_limiter(self):
+		"""TokenBucket of rate_limit, shared by all workers of hashing_engine and by all tasks, None if there is no limit"""
+		if self.rate_limit == 0:
+			return None
+		engine = self.hashing_engine
+		with self._hashing_engine_lock:
+			if self._rate_limiter is None or self._rate_limiter_key != (engine, self.rate_limit):
+				self._rate_limiter = engine.create_rate_limiter(self.rate_limit)
+				self._rate_limiter_key = (engine, self.rate_limit)
+				self._logger.info(f"rate_limiter: created for {self.rate_limit} bytes per second")
+			return self._rate_limiter
+	
+	
+	def shutdown(self):
+		"""stop autostart and wait till all hashing jobs already submitted to engine are complete"""
+		self.autostart_enabled = False
+		with self._hashing_engine_lock:
+			if self._hashing_engine is not None:
+				self._logger.info(f"shutdown: shutting down {self._hashing_engine}, waiting for submitted jobs")
+				self._hashing_engine.shutdown()
+				self._hashing_engine = None
+				self._hashing_scheduler = None
+				self._rate_limiter = None
+				self._rate_limiter_key = None
+		self._logger.info("shutdown: complete")
+	
+	
 	def set_file_manager(self, file_manager):
 		self._file_manager = file_manager
 	
@@ -358,6 +1087,14 @@ class TaskManager(BaseManager):
 		self._dir_manager = dir_manager
 	
 	
+	def set_hash_cache_manager(self, hash_cache_manager):
+		self._hash_cache_manager = hash_cache_manager
+	
+	
+	def set_duplicate_group_manager(self, duplicate_group_manager):
+		self._duplicate_group_manager = duplicate_group_manager
+	
+	
 	def add_task(self, task = None, session = None):
 		if task is None: return None
 		if session is None:
@@ -392,6 +1129,8 @@ class TaskManager(BaseManager):
 			new_task = self.add_directory(task.target_dir_full_path, is_etalon = False)
 		elif task._type == "CompareDirsTask":
 			pass
+		elif task._type == "CompareMultipleDirsTask":
+			pass
 		elif task._type == "FindCopiesTask":
 			pass
 		elif task._type == "CheckDirTask":
@@ -408,8 +1147,21 @@ class TaskManager(BaseManager):
 		if current_obj is not False:
 			self.current_tasks.remove(current_obj)
 			self._logger.debug(f"delete: removed object from current_tasks: {current_obj}")
+		task_id, task_type = obj.id, obj._type
 		BaseManager.delete(self, obj, session = session)
-		pass
+		if task_type == "FindAllDuplicatesTask" and self._duplicate_group_manager is not None:
+			# results of task are deleted with task
+			self._duplicate_group_manager.delete_by_task(task_id, session = session)
+	
+	
+	def get_task_device(self, task):
+		"""st_dev of dir which is read by add dir task, or None for other tasks"""
+		if not isinstance(task, AddDirTask):
+			return None
+		try:
+			return os.stat(task.target_dir_full_path).st_dev
+		except OSError:
+			return None
 	
 	
 	def start_autostart_thread(self):
@@ -417,6 +1169,16 @@ class TaskManager(BaseManager):
 			while task.running:
 				time.sleep(self.SLEEP_BETWEEN_CHECKS)
 				task.save_task()
+		
+		def wait_till_all_tasks_complete():
+			for task in self.current_tasks:
+				wait_till_task_completes(task)
+		
+		def device_is_busy(device):
+			for t in self.current_tasks:
+				if t.running and self.get_task_device(t) == device:
+					return True
+			return False
 			
 		def autostart_thread():
 			time.sleep(self.SLEEP_BETWEEN_CHECKS)
@@ -428,10 +1190,20 @@ class TaskManager(BaseManager):
 					if task.running or task.pending is False:
 						# ignore task
 						pass
+					elif self.parallel_devices and self.get_task_device(task) is not None:
+						# add dir tasks for different devices run at once, each device is read by one task
+						if device_is_busy(self.get_task_device(task)):
+							continue
+						self.start_task(task)
+						time.sleep(self.SLEEP_BETWEEN_CHECKS)
 					else:
+						wait_till_all_tasks_complete()
 						self.start_task(task)
 						time.sleep(self.SLEEP_BETWEEN_CHECKS)
 						wait_till_task_completes(task)
+				for task in self.current_tasks:
+					if task.running:
+						task.save_task()
 				time.sleep(self.SLEEP_BETWEEN_TASKS)
 			self._logger.info(f"start_autostart_thread: complete on user request")
 		
@@ -444,7 +1216,8 @@ class TaskManager(BaseManager):
 		self._logger.info(f"start_autostart_thread: thread started")
 		
 	
-	def add_directory(self, path_to_dir, is_etalon = False):
+	def add_directory(self, path_to_dir, is_etalon = False, possible_duplicates_only = False):
+		"""possible_duplicates_only - add only files that may have duplicates in dir, using AddPossibleDuplicatesTask"""
 		if not os.path.isdir(path_to_dir):
 			self._logger.info(f"add_directory: will not add dir {path_to_dir} - it is not a dir or does not exist")
 			return None
@@ -453,14 +1226,41 @@ class TaskManager(BaseManager):
 			return None
 		# adding dir
 		self._logger.info(f"add_directory: adding directory {path_to_dir}")
-		new_task = AddDirTask(path_to_dir,
-			logger = self._logger.getChild("AddDirTask_" + str(path_to_dir.split(os.sep)[-1])),
-			db_manager = self._db_manager,
-			file_manager = self._file_manager,
-			dir_manager = self._dir_manager,
-			task_manager = self,
-			is_etalon = is_etalon,
-			checksum_algorithm = self.checksum_algorithm)
+		if possible_duplicates_only:
+			new_task = AddPossibleDuplicatesTask(path_to_dir,
+				logger = self._logger.getChild("AddPossibleDuplicatesTask_" + str(path_to_dir.split(os.sep)[-1])),
+				db_manager = self._db_manager,
+				file_manager = self._file_manager,
+				dir_manager = self._dir_manager,
+				task_manager = self,
+				is_etalon = is_etalon,
+				checksum_algorithm = self.checksum_algorithm,
+				block_size = self.hash_block_size,
+				extra_checksum_algorithms = self.extra_checksum_algorithms,
+				hash_cache_manager = self._hash_cache_manager,
+				tree_threshold = self.tree_hash_threshold,
+				tree_chunk_size = self.tree_hash_chunk_size,
+				read_order = self.read_order,
+				use_fadvise = self.use_fadvise,
+				rate_limit = self.task_rate_limit,
+				partial_size = self.partial_hash_size)
+		else:
+			new_task = AddDirTask(path_to_dir,
+				logger = self._logger.getChild("AddDirTask_" + str(path_to_dir.split(os.sep)[-1])),
+				db_manager = self._db_manager,
+				file_manager = self._file_manager,
+				dir_manager = self._dir_manager,
+				task_manager = self,
+				is_etalon = is_etalon,
+				checksum_algorithm = self.checksum_algorithm,
+				block_size = self.hash_block_size,
+				extra_checksum_algorithms = self.extra_checksum_algorithms,
+				hash_cache_manager = self._hash_cache_manager,
+				tree_threshold = self.tree_hash_threshold,
+				tree_chunk_size = self.tree_hash_chunk_size,
+				read_order = self.read_order,
+				use_fadvise = self.use_fadvise,
+				rate_limit = self.task_rate_limit)
 		self.add_task(new_task)
 		self._logger.debug(f"add_directory: complete for {path_to_dir}")
 		return new_task
@@ -483,6 +1283,18 @@ class TaskManager(BaseManager):
 			db_manager = self._db_manager,
 			file_manager = self._file_manager,
 			dir_manager = self._dir_manager,
+			task_manager = self,
+			engine = self.compare_engine)
+		self.add_task(new_task)
+		return new_task
+	
+	
+	def compare_multiple_directories(self, dir_list):
+		new_task = CompareMultipleDirsTask(dir_list,
+			logger = self._logger.getChild(f"CompareMultipleDirsTask_{'_'.join([str(d.id) for d in dir_list])}"),
+			db_manager = self._db_manager,
+			file_manager = self._file_manager,
+			dir_manager = self._dir_manager,
 			task_manager = self)
 		self.add_task(new_task)
 		return new_task
@@ -499,14 +1311,46 @@ class TaskManager(BaseManager):
 		return new_task
 		
 	
-	def check_dir(self, target_dir):
+	def find_similar_dirs(self, target_dir):
+		new_task = FindSimilarDirsTask(target_dir,
+			logger = self._logger.getChild(f"FindSimilarDirsTask_{target_dir.id}"),
+			db_manager = self._db_manager,
+			file_manager = self._file_manager,
+			dir_manager = self._dir_manager,
+			task_manager = self,
+			threshold = self.similarity_threshold)
+		self.add_task(new_task)
+		return new_task
+	
+	
+	def find_all_duplicates(self):
+		new_task = FindAllDuplicatesTask(logger = self._logger.getChild("FindAllDuplicatesTask"),
+			db_manager = self._db_manager,
+			file_manager = self._file_manager,
+			dir_manager = self._dir_manager,
+			task_manager = self,
+			duplicate_group_manager = self._duplicate_group_manager)
+		self.add_task(new_task)
+		return new_task
+	
+	
+	def check_dir(self, target_dir, paranoid = None):
+		"""paranoid - if True, all files are hashed ignoring hash cache. If None, hash_cache_paranoid setting is used"""
 		new_task = CheckDirTask(target_dir,
 			logger = self._logger.getChild(f"CheckDirTask_{target_dir.id}"),
 			db_manager = self._db_manager,
 			file_manager = self._file_manager,
 			dir_manager = self._dir_manager,
 			task_manager = self,
-			checksum_algorithm = self.checksum_algorithm)
+			checksum_algorithm = self.checksum_algorithm,
+			block_size = self.hash_block_size,
+			hash_cache_manager = self._hash_cache_manager,
+			paranoid = self.hash_cache_paranoid if paranoid is None else paranoid,
+			tree_threshold = self.tree_hash_threshold,
+			tree_chunk_size = self.tree_hash_chunk_size,
+			read_order = self.read_order,
+			use_fadvise = self.use_fadvise,
+			rate_limit = self.task_rate_limit)
 		self.add_task(new_task)
 		return new_task
 	
@@ -556,13 +1400,14 @@ class DBManager(object, metaclass = MetaSingleton):
 		self._logger = logger
 		self.DB_FILE = db_file
 		self._engine = None
-		self.session_in_use = False
-		self.WAIT_LOCK_DELAY = 2.0
+		self._session_lock = threading.RLock() # held by blocking session, so only one thread writes to DB at once
+		self._locked_sessions = set() # blocking sessions, which hold _session_lock
+		self._sessions = []
 		# sub-init
 		self.init_DB_ORM()
 		self.create_DB_schema()
+		self.update_DB_schema()
 		self.get_current_schema()
-		self._sessions = []
 	
 	
 	
@@ -582,6 +1427,8 @@ class DBManager(object, metaclass = MetaSingleton):
 			File.__table__.create(bind = self._engine, checkfirst = True)
 			Directory.__table__.create(bind = self._engine, checkfirst = True)
 			TaskRecord.__table__.create(bind = self._engine, checkfirst = True)
+			HashCacheRecord.__table__.create(bind = self._engine, checkfirst = True)
+			DuplicateGroup.__table__.create(bind = self._engine, checkfirst = True)
 			ind = Index("ix_checksum", File.__table__.c.checksum) # should be not there
 		except Exception as e:
 			self._logger.error(f"create_DB_schema: got error while creating db: {e}, traceback: {traceback.format_exc()}")
@@ -590,6 +1437,67 @@ class DBManager(object, metaclass = MetaSingleton):
 		return True
 	
 	
+	def update_DB_schema(self):
+		"""add columns and indexes that were added to models after DB file was created, and fill them for existing rows"""
+		self._logger.debug("update_DB_schema: starting")
+		added_columns = []
+		try:
+			inspector = inspect(self._engine)
+			existing_tables = inspector.get_table_names()
+			for table in DeclarativeBase.metadata.sorted_tables:
+				if table.name not in existing_tables:
+					continue
+				existing_columns = [c["name"] for c in inspector.get_columns(table.name)]
+				for column in table.columns:
+					if column.name in existing_columns:
+						continue
+					column_type = column.type.compile(dialect = self._engine.dialect)
+					with self._engine.begin() as connection:
+						connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+					added_columns.append(f"{table.name}.{column.name}")
+					self._logger.info(f"update_DB_schema: added column {column.name} {column_type} to table {table.name}")
+				for index in table.indexes:
+					index.create(bind = self._engine, checkfirst = True)
+			if "files.checksum_algorithm" in added_columns:
+				self.fill_checksum_algorithm()
+			if "dirs.fingerprint" in added_columns or "dirs.minhash" in added_columns:
+				self.fill_dir_fingerprints()
+			else:
+				# signatures lost when files were removed are computed once here, not on first search
+				self.fill_dir_fingerprints(without_minhash_only = True)
+		except Exception as e:
+			self._logger.error(f"update_DB_schema: got error while updating db: {e}, traceback: {traceback.format_exc()}")
+			return False
+		self._logger.debug(f"update_DB_schema: complete, added columns: {added_columns}")
+		return True
+	
+	
+	def fill_checksum_algorithm(self):
+		"""set checksum_algorithm for files saved before it was stored, guessing it by checksum length"""
+		with self._engine.begin() as connection:
+			for length, algorithm in LEGACY_CHECKSUM_LENGTHS.items():
+				connection.execute(File.__table__.update().where(File.__table__.c.checksum_algorithm == None, func.length(File.__table__.c.checksum) == length).values(checksum_algorithm = algorithm))
+		self._logger.info("fill_checksum_algorithm: checksum_algorithm set for existing files")
+	
+	
+	def fill_dir_fingerprints(self, without_minhash_only = False):
+		"""compute fingerprints and MinHash signatures of dirs saved before they were stored,
+		or only of dirs with files which have no MinHash signature, if without_minhash_only is True"""
+		_session = self.get_session()
+		query = _session.query(Directory)
+		if without_minhash_only:
+			has_checksums = _session.query(File.id).filter(File.dir_id == Directory.id, File.checksum != None).exists()
+			query = query.filter(Directory.minhash == None, Directory.fingerprint != None, has_checksums)
+		target_dirs = query.all()
+		for target_dir in target_dirs:
+			target_dir.fingerprint = None
+			target_dir.content_fingerprint = None
+			target_dir.minhash = None
+			update_dir_fingerprints(target_dir, added_files = _session.query(File.full_path, File.checksum_algorithm, File.checksum).filter(File.dir_id == target_dir.id).all())
+		self.close_session(_session, commit = True)
+		self._logger.info(f"fill_dir_fingerprints: fingerprints computed for {len(target_dirs)} dirs")
+	
+	
 	def init_DB_ORM(self):
 		self._logger.debug(f"init_DB_ORM: starting, will use db file {self.DB_FILE}")
 		self._engine = create_engine(f"sqlite:///{self.DB_FILE}", connect_args = {"check_same_thread": False})
@@ -600,10 +1508,9 @@ class DBManager(object, metaclass = MetaSingleton):
 	def get_session(self, expire_on_commit = True, nonblocking = False):
 		from sqlalchemy.orm import sessionmaker
 		if not nonblocking:
-			while self.session_in_use:
+			if not self._session_lock.acquire(blocking = False):
 				self._logger.debug(f"get_session: waiting for lock on DB session... sessions: {self._sessions}")
-				time.sleep(self.WAIT_LOCK_DELAY)
-			self.session_in_use = True
+				self._session_lock.acquire()
 		if expire_on_commit is False:
 			DBSession = sessionmaker(bind = self._engine, autocommit = False, autoflush = False, expire_on_commit = False)
 			self._logger.debug(f"get_session: session inited WITH expire_on_commit = False")
@@ -613,6 +1520,8 @@ class DBManager(object, metaclass = MetaSingleton):
 		_session = DBSession()
 		_session.begin()
 		self._sessions.append(_session)
+		if not nonblocking:
+			self._locked_sessions.add(_session)
 		self._logger.debug(f"get_session: session started: {_session}, sessions: {self._sessions}")
 		return _session
 	
@@ -620,18 +1529,25 @@ class DBManager(object, metaclass = MetaSingleton):
 	def close_session(self, _session, commit = True):
 		if commit is False:
 			_session.close()
-			self.session_in_use = False
 			self._sessions.remove(_session)
+			self._release_session_lock(_session)
 			self._logger.debug(f"close_session: session closed: {_session}, NOT commited, sessions: {self._sessions}")
 			return
 		_session.commit()
 		_session.flush()
 		_session.close()
 		self._sessions.remove(_session)
-		self.session_in_use = False
+		self._release_session_lock(_session)
 		self._logger.debug(f"close_session: session closed: {_session}, commited, sessions: {self._sessions}")
 	
 	
+	def _release_session_lock(self, _session):
+		# nonblocking sessions do not hold the lock
+		if _session in self._locked_sessions:
+			self._locked_sessions.remove(_session)
+			self._session_lock.release()
+	
+	
 	def add_to_session(self, _session, obj):
 		_session.add(obj)
 		self._logger.debug(f"add_to_session: added to session obj {obj}")
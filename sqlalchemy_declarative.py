@@ -8,12 +8,13 @@ import datetime
 import time
 
 # SQLAlchemy
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Boolean, Float
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Boolean, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
 
 from base import secs_to_hrf, datetime_to_str
+from hashing import parse_extra_checksums
 
 
 
@@ -36,6 +37,10 @@ class Directory(DeclarativeBase):
 	enabled = Column(Boolean, nullable = False, default = True)
 	drive = Column(String, nullable = True)
 	host = Column(String, nullable = True)
+	# multiset hashes of files, see base.update_dir_fingerprints: by (relpath, checksum_algorithm, checksum) and by (checksum_algorithm, checksum)
+	fingerprint = Column(String, nullable = True, index = True)
+	content_fingerprint = Column(String, nullable = True, index = True)
+	minhash = Column(String, nullable = True) # MinHash signature of checksums of files, see indexes.py. None if dir has no files or signature should be computed again
 	files = relationship("File", back_populates = "dir")
 	_str = f"id: {id} - {full_path}"
 	
@@ -65,6 +70,9 @@ class Directory(DeclarativeBase):
 		"comment": self.comment,
 		"drive": self.drive,
 		"host": self.host,
+		"fingerprint": self.fingerprint,
+		"content_fingerprint": self.content_fingerprint,
+		"minhash": self.minhash,
 		"files_ids": [f.id for f in self.files],
 		"is_etalon": self.is_etalon}
 		
@@ -74,6 +82,7 @@ class File(DeclarativeBase):
 	"""File class"""
 	
 	__tablename__ = "files"
+	__table_args__ = (Index("ix_files_dir_id_checksum", "dir_id", "checksum"), Index("ix_files_checksum", "checksum", "checksum_algorithm"))
 	id = Column(Integer, primary_key = True)
 	is_etalon = Column(Boolean, nullable = False)
 	date_added = Column(DateTime, nullable = True)
@@ -81,6 +90,14 @@ class File(DeclarativeBase):
 	# name = Column(String(250), nullable = False)
 	full_path = Column(String, nullable = False)
 	checksum = Column(String, nullable = True)
+	checksum_algorithm = Column(String, nullable = True) # files are compared only if their checksums have the same algorithm
+	extra_checksums = Column(String, nullable = True, default = None) # other algorithms, calculated in the same read: "md5:checksum,sha256:checksum"
+	# stat of file when it was hashed, None for files added before they were stored. Only size is indexed, for lookups of files by size,
+	# files are never searched by other stat fields and their indexes would only slow down inserts
+	st_size = Column(Integer, nullable = True, index = True)
+	st_mtime_ns = Column(Integer, nullable = True)
+	st_ino = Column(Integer, nullable = True)
+	st_dev = Column(Integer, nullable = True)
 	comment = Column(String, nullable = True)
 	deleted = Column(Boolean, nullable = False, default = False)
 	enabled = Column(Boolean, nullable = False, default = True)
@@ -98,6 +115,11 @@ class File(DeclarativeBase):
 		return self._str
 	
 	
+	@property
+	def extra_checksums_dict(self):
+		return parse_extra_checksums(self.extra_checksums)
+	
+	
 	@property
 	def url(self):
 		return f"/ui/show-file/{self.id}"
@@ -116,11 +138,63 @@ class File(DeclarativeBase):
 		"date_checked": str(self.date_checked),
 		"full_path": self.full_path,
 		"checksum": self.checksum,
+		"checksum_algorithm": self.checksum_algorithm,
+		"extra_checksums": self.extra_checksums_dict,
+		"st_size": self.st_size,
+		"st_mtime_ns": self.st_mtime_ns,
+		"st_ino": self.st_ino,
+		"st_dev": self.st_dev,
 		"comment": self.comment,
 		"dir_id": self.dir.id}
 	
 
 
+class HashCacheRecord(DeclarativeBase):
+	"""Checksum of file, valid while device, inode, size and mtime of file are the same"""
+	
+	__tablename__ = "hash_cache"
+	__table_args__ = (Index("ix_hash_cache_key", "st_ino", "st_dev", "checksum_algorithm", unique = True), )
+	id = Column(Integer, primary_key = True)
+	st_dev = Column(Integer, nullable = False)
+	st_ino = Column(Integer, nullable = False)
+	st_size = Column(Integer, nullable = False)
+	st_mtime_ns = Column(Integer, nullable = False)
+	checksum_algorithm = Column(String, nullable = False)
+	checksum = Column(String, nullable = False)
+	extra_checksums = Column(String, nullable = True, default = None)
+	date_checked = Column(DateTime, nullable = True)
+	
+	
+	def __str__(self):
+		return f"dev {self.st_dev} ino {self.st_ino} size {self.st_size} mtime_ns {self.st_mtime_ns} - {self.checksum_algorithm}: {self.checksum}"
+	
+
+
+class DuplicateGroup(DeclarativeBase):
+	"""Files with the same checksum in enabled dirs, one of results of FindAllDuplicatesTask"""
+	
+	__tablename__ = "duplicate_groups"
+	__table_args__ = (Index("ix_duplicate_groups_task_wasted", "task_id", "wasted_bytes"), )
+	id = Column(Integer, primary_key = True)
+	task_id = Column(Integer, ForeignKey("tasks.id"), nullable = False)
+	checksum = Column(String, nullable = False)
+	checksum_algorithm = Column(String, nullable = True)
+	files_count = Column(Integer, nullable = False) # number of different paths with this checksum
+	file_size = Column(Integer, nullable = True) # None if size of files is unknown, i.e. files were added before stat was stored
+	wasted_bytes = Column(Integer, nullable = False, default = 0) # file_size * (files_count - 1)
+	file_ids = Column(String, nullable = False) # "id,id,id"
+	
+	
+	@property
+	def file_ids_list(self):
+		return [int(i) for i in self.file_ids.split(",")]
+	
+	
+	def __str__(self):
+		return f"{self.checksum_algorithm}: {self.checksum} - {self.files_count} files, {self.wasted_bytes} bytes wasted"
+	
+
+
 class TaskRecord(DeclarativeBase):
 	"""TaskRecord"""
 	
@@ -21,6 +21,19 @@ function compare_dirs() {
 }
 
 
+function compare_multiple_dirs() {
+	var selected_dirs_list = [];
+	selected_dirs_list = get_selected_dirs();
+	if (selected_dirs_list.length < 2) {
+		alert("At least 2 dirs should be selected for this action");
+	}
+	else {
+		var arg_str = selected_dirs_to_args();
+		document.location.href = "/api/compare-multiple-dirs?" + arg_str;
+	}
+}
+
+
 function delete_dirs() {
 	var arg_str = selected_dirs_to_args();
 	if (confirm("Delete selected dirs?")) {
@@ -38,12 +51,24 @@ function check_dirs() {
 }
 
 
+function check_dirs_paranoid() {
+	var arg_str = selected_dirs_to_args();
+	document.location.href = "/api/check-dirs?paranoid=1&" + arg_str;
+}
+
+
 function find_copies() {
 	var arg_str = selected_dirs_to_args();
 	document.location.href = "/api/find-copies?" + arg_str;
 }
 
 
+function find_similar_dirs() {
+	var arg_str = selected_dirs_to_args();
+	document.location.href = "/api/find-similar-dirs?" + arg_str;
+}
+
+
 function split_dirs() {
 	var arg_str = selected_dirs_to_args();
 	document.location.href = "/api/split-dirs?" + arg_str;
@@ -9,6 +9,9 @@ import glob
 
 import multiprocessing
 import threading
+import queue
+import functools
+import itertools
 # import sqlite3
 
 # logging
@@ -22,7 +25,9 @@ from sqlalchemy import create_engine, select
 
 sys.path.append("./")
 from base import *
+from hashing import create_hashing_engine, DeviceScheduler, order_files, tree_algorithm_name, parse_tree_algorithm, base_checksum_algorithm, TreeChecksumCollector, DEFAULT_BLOCK_SIZE, DEFAULT_PARTIAL_SIZE, DEFAULT_TREE_CHUNK_SIZE, MIB
 from sqlalchemy_declarative import TaskRecord
+from indexes import LSHIndex, parse_minhash
 
 
 """All tasks are in this file"""
@@ -163,16 +168,36 @@ class BaseTask(TaskRecord):
 class AddDirTask(BaseTask):
 	"""Task to add new dir. Dir existance will be checked"""
 	
-	def __init__(self, target_dir, logger = None, db_manager = None, file_manager = None, dir_manager = None, task_manager = None, is_etalon = True, checksum_algorithm = "md5"):
+	def __init__(self, target_dir, logger = None, db_manager = None, file_manager = None, dir_manager = None, task_manager = None, is_etalon = True, checksum_algorithm = "md5", block_size = DEFAULT_BLOCK_SIZE, extra_checksum_algorithms = (), hash_cache_manager = None, paranoid = False, tree_threshold = 0, tree_chunk_size = DEFAULT_TREE_CHUNK_SIZE, read_order = "listing", use_fadvise = True, rate_limit = 0):
 		super(AddDirTask, self).__init__(logger = logger, db_manager = db_manager, file_manager = file_manager, dir_manager = dir_manager, task_manager = task_manager)
 		self.target_dir_full_path = target_dir
 		self.file_list = []
+		self._files_total = None
+		self._files_hashed = 0
+		self._files_added = 0
+		self.BATCH_SIZE = 1000 # files are commited to DB in batches of this size
+		self.MAX_FILES_IN_QUEUE = 256 # not more than this number of files are waiting for hashing
 		self.is_etalon = is_etalon
-		self._sleep_delay = 1
 		self.dir = None
 		self.checksum_algorithm = checksum_algorithm # default is md5, but sha512 also is supported
+		self.block_size = block_size # size of one read while hashing
+		self.extra_checksum_algorithms = list(extra_checksum_algorithms) # calculated in the same read as main checksum
+		self._hash_cache_manager = hash_cache_manager # if set, checksums of unchanged files are taken from hash cache
+		self.paranoid = paranoid # if True, all files are hashed, hash cache is only updated
+		self.tree_threshold = tree_threshold # files of this size and larger get tree checksum, chunks are hashed in parallel. 0 disables
+		self.tree_chunk_size = tree_chunk_size
+		self.stored_algorithms = None # full_path: checksum_algorithm of saved files, if set files are hashed the same way (tree or not) as they were saved
+		self.read_order = read_order # one of hashing.READ_ORDER_STRATEGIES
+		self.READ_ORDER_WINDOW = 4096 # files are sorted for reading by windows of this size
+		self.use_fadvise = use_fadvise # keep page cache for other data while hashing
+		self.rate_limit = rate_limit # bytes per second for this task, 0 - no limit
+		self._rate_limiter = None # TokenBucket of this task
+		self._rate_limiter_engine = None # hashing engine, which created _rate_limiter
+		self.OWN_ENGINE_WORKERS = 2 # workers of hashing engine, if task is run without TaskManager
+		self._files_from_hash_cache = 0
+		self.dir_comment = ""
 		self.__thread = None
-		self.__pool = None
+		self._own_engine = False
 		self.descr = f"{self._type} for ../{os.path.split(self.target_dir_full_path)[-1]}"
 		
 		if self._logger is not None:
@@ -184,102 +209,286 @@ class AddDirTask(BaseTask):
 	
 	
 	def get_dir_listing(self, path_to_dir):
-		glob_str = os.path.join(path_to_dir, "**")
-		file_list = glob.glob(glob_str, recursive = True)
-		self._logger.debug(f"get_dir_listing: got {len(file_list)} elements in list {file_list} for glob pattern {glob_str}")
-		return file_list
-	
-	
-	def _create_input_list(self):
-		# compile list of dicts
-		dict_list = []
-		dict_length = 0
-		for f in self.file_list:
-			if os.path.isdir(f):
-				continue
-			dict_list.append({"full_path": f})
-		dict_length = len(dict_list)
-		self._logger.debug(f"_create_input_list: created dict_list: {dict_list}, total {dict_length} items")
-		return dict_list
-	
-	
-	def _create_multiprocessing_pool(self, dict_list):
-		# create and start Pool
-		self.__pool = multiprocessing.Pool(processes = 2)
-		if self.checksum_algorithm == "sha512":
-			result = self.__pool.imap_unordered(get_file_checksum_sha512, dict_list)
-		else:
-			result = self.__pool.imap_unordered(get_file_checksum, dict_list)
-		self.__pool.close()
-		self._logger.debug("create_multiprocessing_pool: pool created and closed")
-		return result
-	
-	
-	def _wait_till_complete(self, result, dict_list):
-		dict_length = len(dict_list)
-		complete = result._index
-		while complete != dict_length:
-			self._logger.debug(f"_wait_till_complete: waiting for pool, complete: {complete} of {dict_length}...")
-			time.sleep(self._sleep_delay)
-			complete = result._index
-			self.progress = complete / dict_length
-		self._logger.debug(f"_wait_till_complete: pool results ready: {result}")
-		return
-	
-	
-	def _create_directory_and_files(self, result, save_disabled = False, session = None):
+		"""returns generator of dicts for all files of dir, listing is done lazily while files are hashed"""
+		self._logger.debug(f"get_dir_listing: will scan dir {path_to_dir}")
+		return scan_dir(path_to_dir, with_stat = True)
+	
+	
+	def _count_files(self, dict_iter):
+		"""yields dicts from dict_iter and counts them, so total number of files is known when listing is complete,
+		without second walk of dir. Progress is shown after that"""
+		self._files_total = None
+		files_found = 0
+		for d in dict_iter:
+			files_found += 1
+			yield d
+		self._files_total = files_found
+		self._logger.debug(f"_count_files: total {self._files_total} files in dir")
+	
+	
+	def _get_hashing_engine(self):
+		"""returns DeviceScheduler over hashing engine, jobs are submitted with st_dev of file"""
+		# use long-lived engine of TaskManager, so pool is not started again for each task
+		if self._task_manager is not None:
+			self._own_engine = False
+			self._logger.debug("_get_hashing_engine: using hashing engine of TaskManager")
+			return self._task_manager.hashing_scheduler
+		self._own_engine = True
+		self._logger.debug("_get_hashing_engine: creating own hashing engine")
+		return DeviceScheduler(create_hashing_engine("process", workers = self.OWN_ENGINE_WORKERS), logger = self._logger.getChild("DeviceScheduler"))
+	
+	
+	def _get_hash_function(self):
+		"""returns picklable function which is submitted to hashing engine for each file"""
+		return functools.partial(get_file_checksum,
+			checksum_method = self.checksum_algorithm,
+			block_size = self.block_size,
+			extra_checksum_methods = self.extra_checksum_algorithms,
+			use_fadvise = self.use_fadvise)
+	
+	
+	def _get_rate_limiters(self, engine):
+		"""rate limiters shared by all workers of engine: TokenBucket of this task and TokenBucket of all tasks of TaskManager.
+		Workers wait for each of them block by block while reading, so reads are throttled as they happen"""
+		limiters = []
+		if self.rate_limit != 0:
+			if self._rate_limiter is None or self._rate_limiter_engine is not engine:
+				self._rate_limiter = engine.create_rate_limiter(self.rate_limit)
+				self._rate_limiter_engine = engine
+			limiters.append(self._rate_limiter)
+		if self._task_manager is not None and self._task_manager.rate_limiter is not None:
+			limiters.append(self._task_manager.rate_limiter)
+		return limiters
+	
+	
+	def _hash_files(self, dict_iter, hash_function = None):
+		"""hash files from dict_iter using hashing engine, yield results as they are ready
+		
+		Not more than self.MAX_FILES_IN_QUEUE files are submitted to engine at once, so neither listing nor results
+		are accumulated in memory, whatever is the size of dir.
+		If hash_function is set, it is used instead of full checksum and hash cache is not used."""
+		full_checksum = hash_function is None
+		if hash_function is None:
+			hash_function = self._get_hash_function()
+		engine = self._get_hashing_engine()
+		rate_limiters = self._get_rate_limiters(engine.engine)
+		if len(rate_limiters) != 0:
+			hash_function = functools.partial(hash_function, rate_limiters = rate_limiters)
+		results = queue.Queue()
+		in_queue = 0
+		to_hash_cache = [] if full_checksum else None
+		try:
+			dict_iter = self._order_files(dict_iter)
+			for d in (self._lookup_hash_cache(dict_iter) if full_checksum else dict_iter):
+				while in_queue >= self.MAX_FILES_IN_QUEUE:
+					yield self._get_hash_result(results, to_hash_cache)
+					in_queue -= 1
+				if d.get("from_hash_cache"):
+					results.put(d)
+				elif full_checksum and self._use_tree_checksum(d):
+					self._submit_tree_checksum(engine, d, results)
+				else:
+					engine.submit(hash_function, d, callback = results.put, error_callback = results.put, device = d.get("st_dev"))
+				in_queue += 1
+			while in_queue != 0:
+				yield self._get_hash_result(results, to_hash_cache)
+				in_queue -= 1
+			if full_checksum:
+				self._store_hash_cache(to_hash_cache)
+		finally:
+			if self._own_engine:
+				engine.shutdown()
+		self._logger.debug(f"_hash_files: all files hashed, {self._files_from_hash_cache} taken from hash cache")
+	
+	
+	def _order_files(self, dict_iter):
+		"""yields dicts from dict_iter sorted by read_order strategy within windows of READ_ORDER_WINDOW files"""
+		if self.read_order == "listing":
+			yield from dict_iter
+			return
+		window = []
+		for d in dict_iter:
+			window.append(d)
+			if len(window) >= self.READ_ORDER_WINDOW:
+				yield from order_files(window, self.read_order)
+				window = []
+		yield from order_files(window, self.read_order)
+	
+	
+	def _get_tree_chunk_size(self, d):
+		"""chunk size of tree checksum for file, or None if file gets ordinary checksum. Saved files are hashed as they were saved,
+		even if tree_threshold was changed after that"""
+		if self.stored_algorithms is not None and d["full_path"] in self.stored_algorithms:
+			tree = parse_tree_algorithm(self.stored_algorithms[d["full_path"]])
+			return tree[1] if tree is not None else None
+		if self.tree_threshold != 0 and d.get("st_size") is not None and d["st_size"] >= self.tree_threshold:
+			return self.tree_chunk_size
+		return None
+	
+	
+	def _use_tree_checksum(self, d):
+		return self._get_tree_chunk_size(d) is not None
+	
+	
+	def _submit_tree_checksum(self, engine, d, results):
+		"""split large file into chunks and submit them to engine, so chunks are hashed in parallel.
+		Combined result is put to results when all chunks are hashed"""
+		d["date_start"] = datetime.datetime.now()
+		collector = TreeChecksumCollector(d, self.checksum_algorithm, self._get_tree_chunk_size(d), callback = results.put, error_callback = results.put)
+		chunk_function = functools.partial(get_file_chunk_checksum,
+			checksum_method = self.checksum_algorithm,
+			block_size = self.block_size,
+			use_fadvise = self.use_fadvise,
+			rate_limiters = self._get_rate_limiters(engine.engine))
+		self._logger.debug(f"_submit_tree_checksum: file {d['full_path']} of {d['st_size']} bytes, {len(collector.chunks)} chunks")
+		for chunk in collector.chunks:
+			engine.submit(chunk_function, chunk, callback = collector.on_chunk, error_callback = collector.on_error, device = d.get("st_dev"))
+	
+	
+	def _lookup_hash_cache(self, dict_iter):
+		"""yields dicts from dict_iter, dicts of unchanged files have checksum already set from hash cache"""
+		if self._hash_cache_manager is None or self.paranoid:
+			yield from dict_iter
+			return
+		chunk = []
+		for d in dict_iter:
+			# cached checksum is used only if it has the same algorithm as file would be hashed with now
+			d["checksum_algorithm"] = tree_algorithm_name(self.checksum_algorithm, self._get_tree_chunk_size(d)) if self._use_tree_checksum(d) else self.checksum_algorithm
+			chunk.append(d)
+			if len(chunk) >= self.MAX_FILES_IN_QUEUE:
+				yield from self._hash_cache_manager.lookup(chunk, self.checksum_algorithm, self.extra_checksum_algorithms)
+				chunk = []
+		yield from self._hash_cache_manager.lookup(chunk, self.checksum_algorithm, self.extra_checksum_algorithms)
+	
+	
+	def _store_hash_cache(self, to_hash_cache):
+		if self._hash_cache_manager is None or len(to_hash_cache) == 0:
+			return
+		self._hash_cache_manager.store(to_hash_cache)
+		to_hash_cache.clear()
+	
+	
+	def _get_hash_result(self, results, to_hash_cache = None):
+		r = results.get()
+		if isinstance(r, Exception):
+			raise r
+		if r.get("from_hash_cache"):
+			self._files_from_hash_cache += 1
+		elif to_hash_cache is not None and self._hash_cache_manager is not None:
+			# freshly hashed files are saved to hash cache by batches
+			to_hash_cache.append(r)
+			if len(to_hash_cache) >= self.BATCH_SIZE:
+				self._store_hash_cache(to_hash_cache)
+		self._files_hashed += 1
+		if self._files_total is not None and self._files_total != 0:
+			self.progress = min(self._files_hashed / self._files_total, 1.0)
+		return r
+	
+	
+	def _create_directory_and_files(self, result, save_disabled = False):
 		now = datetime.datetime.now()
-		if session is None:
-			_session = self.get_session()
-		else:
-			_session = session
 		new_dir = self._dir_manager.create(self.target_dir_full_path,
 			is_etalon = self.is_etalon,
 			date_added = now,
 			date_checked = now,
+			comment = self.dir_comment,
 			save_disabled = save_disabled,
-			name = os.path.basename(self.target_dir_full_path),
-			session = _session)
+			name = os.path.basename(self.target_dir_full_path))
 		self._logger.debug(f"_create_directory_and_files: new empty dir created: {new_dir}")
-		files = []
-		for r in result:
-			files.append(self._file_manager.create(r['full_path'],
-				checksum = r['checksum'],
-				_dir = new_dir,
-				date_added = r["date_end"],
-				date_checked = r["date_end"],
-				is_etalon = self.is_etalon,
-				save_disabled = save_disabled,
-				session = _session))
-		self._logger.debug(f"_create_directory_and_files: created files in already created dir")
-		files_appended_tmp = [f.full_path for f in new_dir.files] if len(new_dir.files) <= self._MAX_FILES_SHOWN else f"{new_dir.files[0].full_path} and more"
-		self._logger.info(f"_create_directory_and_files: created dir {new_dir.full_path} with {len(new_dir.files)} files appended: {files_appended_tmp}")
 		self.dir = new_dir
 		self.target_dir_id = self.dir.id
-		if session is None:
-			self.close_session(_session)
+		if save_disabled:
+			# dir is only kept in memory, i.e. for comparison in CheckDirTask
+			for r in result:
+				self._file_manager.create(r["full_path"],
+					checksum = r["checksum"],
+					checksum_algorithm = r["checksum_algorithm"],
+					extra_checksums = r["extra_checksums"],
+					_dir = new_dir,
+					date_added = r["date_end"],
+					date_checked = r["date_end"],
+					is_etalon = self.is_etalon,
+					st_size = r.get("st_size"),
+					st_mtime_ns = r.get("st_mtime_ns"),
+					st_ino = r.get("st_ino"),
+					st_dev = r.get("st_dev"),
+					save_disabled = True)
+			self._files_added = len(new_dir.files)
+		else:
+			batch = []
+			for r in result:
+				batch.append(r)
+				if len(batch) >= self.BATCH_SIZE:
+					self._save_files_batch(batch)
+					batch = []
+			self._save_files_batch(batch)
+		self._logger.info(f"_create_directory_and_files: created dir {new_dir.full_path} with {self._files_added} files")
 		return new_dir
 	
 	
+	def _save_files_batch(self, batch):
+		"""save batch of hashed files to DB in one transaction"""
+		if len(batch) == 0:
+			return
+		self._file_manager.bulk_create([{"full_path": r["full_path"],
+			"checksum": r["checksum"],
+			"checksum_algorithm": r["checksum_algorithm"],
+			"extra_checksums": r["extra_checksums"],
+			"date_added": r["date_end"],
+			"date_checked": r["date_end"],
+			"st_size": r.get("st_size"),
+			"st_mtime_ns": r.get("st_mtime_ns"),
+			"st_ino": r.get("st_ino"),
+			"st_dev": r.get("st_dev")} for r in batch],
+			dir_id = self.dir.id,
+			is_etalon = self.is_etalon)
+		self._files_added += len(batch)
+		self._logger.debug(f"_save_files_batch: saved {len(batch)} files, total saved: {self._files_added}")
+	
+	
 	def save_result(self, session = None):
-		"""save task results to DB"""
-		self._dir_manager.update(self.dir, session = session)
+		"""save task results to DB. Files are already saved by batches, so only dir itself is updated"""
+		if session is None:
+			_session = self.get_session()
+		else:
+			_session = session
+		saved_dir = _session.query(Directory).get(self.dir.id)
+		saved_dir.date_checked = datetime.datetime.now()
+		if session is None:
+			self.close_session(_session, commit = True)
 		self._logger.debug(f"save_result: commited")
 		
 	
+	def _remove_incomplete_dir(self):
+		"""files are saved by batches while they are hashed, so on error dir and its already saved files are removed from DB,
+		and dir is either added completely or not at all"""
+		if self.save_disabled or self.dir is None:
+			return
+		try:
+			files_removed = self._file_manager.delete_by_dir(self.target_dir_id)
+			_session = self.get_session()
+			saved_dir = _session.query(Directory).get(self.target_dir_id)
+			if saved_dir is not None:
+				_session.delete(saved_dir)
+			self.close_session(_session, commit = True)
+			self._logger.info(f"_remove_incomplete_dir: removed dir {self.target_dir_id} and its {files_removed} files")
+			self.dir = None
+		except Exception as e:
+			self._logger.error(f"_remove_incomplete_dir: could not remove dir {self.target_dir_id}: {e}, traceback: {traceback.format_exc()}")
+	
+	
 	def run(self):
 		self._logger.info(f"run: starting, target_dir_full_path: {self.target_dir_full_path}")
 		# self.mark_task_start()
 		try:
-			self.file_list = self.get_dir_listing(self.target_dir_full_path)
-			self._logger.debug(f"run: got file list: {self.file_list}")
-			dict_list = self._create_input_list()
-			result = self._create_multiprocessing_pool(dict_list)
-			self._wait_till_complete(result, dict_list)
-			
-			# now all slow processes are complete
-			self._logger.debug("run: will create new files and dir")
-			new_dir = self._create_directory_and_files(result)
+			self._files_hashed = 0
+			self._files_added = 0
+			self._files_from_hash_cache = 0
+			self.file_list = self._count_files(self.get_dir_listing(self.target_dir_full_path))
+			result = self._hash_files(self.file_list)
+			# files are saved while they are being hashed
+			self._logger.debug("run: will create new dir and files")
+			new_dir = self._create_directory_and_files(result, save_disabled = self.save_disabled)
 			if not self.save_disabled:
 				self.save_result()	
 			else:
@@ -293,6 +502,7 @@ class AddDirTask(BaseTask):
 			return new_dir
 		except Exception as e:
 			self._logger.error(f"run: got error {e}, traceback: {traceback.format_exc()}")
+			self._remove_incomplete_dir()
 			self.mark_task_FAIL()
 			self.mark_result_failure()
 			self.mark_task_end()
@@ -301,20 +511,111 @@ class AddDirTask(BaseTask):
 	
 	
 	def generate_report(self):
-		_session = self.get_session()
-		_session.add(self.dir)
 		self.report = f"AddDirTask for {self.target_dir_full_path}, status: {self.state}" + "\n"
-		self.report += f"{len(self.dir.files)} files added:" + "\n\n"
-		if len(self.dir.files) > self._MAX_FILES_SHOWN:
-			for f in self.dir.files[0:self._MAX_FILES_SHOWN]:
-				self.report += f"{f.id}: {f.full_path} - {f.checksum}" + "\n"
-			self.report += f"and other, total: {len(self.dir.files)} files" + "\n"
+		self.report += f"{self._files_added} files added:" + "\n"
+		if self._hash_cache_manager is not None:
+			self.report += f"{self._files_from_hash_cache} checksums taken from hash cache" + (", paranoid mode: all files hashed" if self.paranoid else "") + "\n"
+		self.report += "\n"
+		if self.save_disabled:
+			shown_files = self.dir.files[0:self._MAX_FILES_SHOWN]
 		else:
-			for f in self.dir.files:
-				self.report += f"{f.id}: {f.full_path} - {f.checksum}" + "\n"
+			_session = self.get_session()
+			shown_files = _session.query(File).filter(File.dir_id == self.dir.id).order_by(File.id).limit(self._MAX_FILES_SHOWN).all()
+		for f in shown_files:
+			self.report += f"{f.id}: {f.full_path} - {f.checksum}" + "\n"
+		if self._files_added > self._MAX_FILES_SHOWN:
+			self.report += f"and other, total: {self._files_added} files" + "\n"
+		if not self.save_disabled:
+			self.close_session(_session, commit = False)
 		self.report += "\n\n" + f"Task took: {self.duration}s"
 		self._logger.debug(f"generate_report: report ready")
-		self.close_session(_session)
+		return self.report
+
+
+
+class AddPossibleDuplicatesTask(AddDirTask):
+	"""Task to add only files of dir that may have duplicates within it, i.e. for dedupe of large archive.
+	
+	Files are hashed by stages: files with unique size are skipped, then files with unique partial checksum
+	(of first and last partial_size bytes) are skipped, and only remaining files are fully hashed and saved"""
+	
+	def __init__(self, target_dir, logger = None, db_manager = None, file_manager = None, dir_manager = None, task_manager = None, is_etalon = True, checksum_algorithm = "md5", block_size = DEFAULT_BLOCK_SIZE, extra_checksum_algorithms = (), hash_cache_manager = None, paranoid = False, tree_threshold = 0, tree_chunk_size = DEFAULT_TREE_CHUNK_SIZE, read_order = "listing", use_fadvise = True, rate_limit = 0, partial_size = DEFAULT_PARTIAL_SIZE):
+		super(AddPossibleDuplicatesTask, self).__init__(target_dir,
+			logger = logger,
+			db_manager = db_manager,
+			file_manager = file_manager,
+			dir_manager = dir_manager,
+			task_manager = task_manager,
+			is_etalon = is_etalon,
+			checksum_algorithm = checksum_algorithm,
+			block_size = block_size,
+			extra_checksum_algorithms = extra_checksum_algorithms,
+			hash_cache_manager = hash_cache_manager,
+			paranoid = paranoid,
+			tree_threshold = tree_threshold,
+			tree_chunk_size = tree_chunk_size,
+			read_order = read_order,
+			use_fadvise = use_fadvise,
+			rate_limit = rate_limit)
+		self.partial_size = partial_size
+		self.files_scanned = 0
+		self.files_unique_size = 0
+		self.files_unique_partial = 0
+		self.bytes_scanned = 0
+		self.bytes_fully_hashed = 0
+		self.dir_comment = "only files that may have duplicates in this dir, files with unique size or unique partial checksum were skipped"
+	
+	
+	def _count_files(self, dict_iter):
+		# files are counted while they are grouped by size
+		return dict_iter
+	
+	
+	def _get_partial_hash_function(self):
+		return functools.partial(get_file_partial_checksum,
+			checksum_method = self.checksum_algorithm,
+			partial_size = self.partial_size,
+			use_fadvise = self.use_fadvise)
+	
+	
+	def _hash_files(self, dict_iter, hash_function = None):
+		# stage 1: group by size, file with unique size has no duplicates
+		size_groups = {}
+		for d in dict_iter:
+			size_groups.setdefault(d["st_size"], []).append(d)
+		self.files_scanned = sum([len(g) for g in size_groups.values()])
+		self.bytes_scanned = sum([size * len(g) for size, g in size_groups.items()])
+		candidates = [d for g in size_groups.values() if len(g) > 1 for d in g]
+		self.files_unique_size = self.files_scanned - len(candidates)
+		self._logger.debug(f"_hash_files: {self.files_scanned} files, {len(candidates)} have size equal to other files")
+		
+		# stage 2: group large files by size and partial checksum, small files are fully read by partial checksum anyway
+		survivors = [d for d in candidates if d["st_size"] <= 2 * self.partial_size]
+		large_candidates = [d for d in candidates if d["st_size"] > 2 * self.partial_size]
+		self._files_total = len(survivors) + 2 * len(large_candidates)
+		partial_groups = {}
+		for r in super(AddPossibleDuplicatesTask, self)._hash_files(large_candidates, hash_function = self._get_partial_hash_function()):
+			if r["partial_checksum"] is not None:
+				partial_groups.setdefault((r["st_size"], r["partial_checksum"]), []).append(r)
+		large_survivors = [r for g in partial_groups.values() if len(g) > 1 for r in g]
+		self.files_unique_partial = len(large_candidates) - len(large_survivors)
+		survivors.extend(large_survivors)
+		self._logger.debug(f"_hash_files: {len(large_survivors)} of {len(large_candidates)} large files have partial checksum equal to other files")
+		
+		# stage 3: full checksums, results are saved as usual
+		self._files_total = self._files_hashed + len(survivors)
+		self.bytes_fully_hashed = 0
+		for r in super(AddPossibleDuplicatesTask, self)._hash_files(survivors):
+			# checksums taken from hash cache were not read
+			if not r.get("from_hash_cache"):
+				self.bytes_fully_hashed += r["st_size"]
+			yield r
+	
+	
+	def generate_report(self):
+		super(AddPossibleDuplicatesTask, self).generate_report()
+		self.report += "\n" + f"Files in dir: {self.files_scanned}, skipped as unique by size: {self.files_unique_size}, skipped as unique by partial checksum: {self.files_unique_partial}" + "\n"
+		self.report += f"Fully hashed: {self.bytes_fully_hashed} of {self.bytes_scanned} bytes" + "\n"
 		return self.report
 
 
@@ -329,7 +630,8 @@ class CompareDirsTask(BaseTask):
 		db_manager = None,
 		file_manager = None,
 		dir_manager = None,
-		task_manager = None):
+		task_manager = None,
+		engine = "auto"):
 		super(CompareDirsTask, self).__init__(logger = logger,
 			db_manager = db_manager,
 			file_manager = file_manager,
@@ -343,8 +645,12 @@ class CompareDirsTask(BaseTask):
 		self.files_b_on_a = []
 		self.files_only_on_a = []
 		self.files_only_on_b = []
-		self.equal_names_diff_checsums = []
+		self.equal_names_diff_checsums = [] # tuples (file of A, file of B) with the same path relative to dir and different checksums
 		self.dirs_are_equal = None
+		self.engine = engine # memory, index, sql or auto - sql for saved dirs with at least SQL_ENGINE_MIN_FILES files together, memory for others
+		self.SQL_ENGINE_MIN_FILES = 1000 # by benchmark.py compare sql is faster than memory from 2 x 500 files, and takes half of its memory
+		self._files_a_count = None
+		self._files_b_count = None
 		self.descr = f"{self._type} for dir A {self.dir_a} and dir B {self.dir_b}"
 	
 	
@@ -354,95 +660,197 @@ class CompareDirsTask(BaseTask):
 		pass
 	
 	
+	@property
+	def files_a_count(self):
+		return self._files_a_count if self._files_a_count is not None else len(self.dir_a.files)
+	
+	
+	@property
+	def files_b_count(self):
+		return self._files_b_count if self._files_b_count is not None else len(self.dir_b.files)
+	
+	
 	@property
 	def a_is_subset_of_b(self):
-		return True if len(self.files_a_on_b) == len(self.dir_a.files) else False
+		return True if len(self.files_a_on_b) == self.files_a_count else False
 	
 	
 	@property
 	def b_is_subset_of_a(self):
-		return True if len(self.files_b_on_a) == len(self.dir_b.files) else False
+		return True if len(self.files_b_on_a) == self.files_b_count else False
 		
 	
+	def _index_files_by_checksum(self, idir):
+		"""returns dict (checksum, checksum_algorithm): list of files of dir, in order of dir.files.
+		Files of dir can be found as copies only if dir is enabled, the same as in FileManager.get_by_checksum"""
+		index = {}
+		if idir.enabled is not True:
+			return index
+		for f in idir.files:
+			if f.checksum is None:
+				continue
+			index.setdefault((f.checksum, f.checksum_algorithm), []).append(f)
+		return index
+	
+	
+	def _index_files_by_relpath(self, idir, files):
+		"""returns dict path relative to dir: file. files can be File objects or rows with the same attributes"""
+		return {relative_path(f.full_path, idir.full_path): f for f in files}
+	
+	
+	def _find_equal_names_diff_checksums(self, files_a, files_b):
+		"""returns list of tuples (file of A, file of B) with the same relative path, hashed with the same algorithm, with different checksums.
+		Files without checksum (i.e. files that do not exist) are skipped"""
+		index_a = self._index_files_by_relpath(self.dir_a, files_a)
+		res = []
+		for relpath, fb in sorted(self._index_files_by_relpath(self.dir_b, files_b).items()):
+			fa = index_a.get(relpath)
+			if fa is None or fa.checksum is None or fb.checksum is None:
+				continue
+			if fa.checksum_algorithm == fb.checksum_algorithm and fa.checksum != fb.checksum:
+				res.append((fa, fb))
+		return res
+	
+	
+	def compare_in_memory(self):
+		"""compare dirs using dicts and sets, in linear time. Each dir is indexed once by (checksum, checksum_algorithm)"""
+		len_all_files = len(self.dir_a.files) + len(self.dir_b.files)
+		progress_increment = 0.25 / len_all_files if len_all_files != 0 else 0.0
+		index_a = self._index_files_by_checksum(self.dir_a)
+		index_b = self._index_files_by_checksum(self.dir_b)
+		on_both = set()
+		for fa in self.dir_a.files:
+			self.progress += progress_increment
+			candidates = index_b.get((fa.checksum, fa.checksum_algorithm), [])
+			if len(candidates) == 0:
+				continue
+			if fa not in on_both:
+				on_both.add(fa)
+				self.files_on_both.append(fa)
+				self.files_a_on_b.append(fa)
+			for c in candidates:
+				if c not in on_both:
+					on_both.add(c)
+					self.files_on_both.append(c)
+					self.files_b_on_a.append(c)
+		for fb in self.dir_b.files:
+			self.progress += progress_increment
+			candidates = index_a.get((fb.checksum, fb.checksum_algorithm), [])
+			if len(candidates) == 0:
+				continue
+			if fb not in on_both:
+				on_both.add(fb)
+				self.files_on_both.append(fb)
+				self.files_b_on_a.append(fb)
+			for c in candidates:
+				if c not in on_both:
+					on_both.add(c)
+					self.files_on_both.append(c)
+					self.files_a_on_b.append(c)
+		self._logger.debug("compare_in_memory: checking files only on A and B")
+		for fa in self.dir_a.files:
+			self.progress += progress_increment
+			if fa not in on_both:
+				self.files_only_on_a.append(fa)
+		for fb in self.dir_b.files:
+			self.progress += progress_increment
+			if fb not in on_both:
+				self.files_only_on_b.append(fb)
+		self.equal_names_diff_checsums = self._find_equal_names_diff_checksums(self.dir_a.files, self.dir_b.files)
+	
+	
+	def compare_in_db(self, session):
+		"""compare dirs by one grouped join in DB, see FileManager.compare_dirs. Only for saved dirs.
+		Rows are streamed from DB, files that are only on one dir are kept as rows with paths and checksums, and files_on_both,
+		files_a_on_b and files_b_on_a contain ids of files, they are only counted in report. File objects are not loaded"""
+		rows = self._file_manager.compare_dirs(self.dir_a.id, self.dir_b.id, session)
+		self._collect_results(((r.id, r.dir_id, r.matched, r) for r in rows), session)
+	
+	
+	def compare_in_index(self, session):
+		"""compare saved dirs using compact FileIndex of each dir, checksums are matched as digests in sets.
+		Results are the same as in compare_in_db"""
+		index_a = self._file_manager.get_file_index([self.dir_a.id], session = session)
+		index_b = self._file_manager.get_file_index([self.dir_b.id], session = session)
+		self.progress = 0.25
+		matched_a = index_a.matched(index_b.digest_set())
+		matched_b = index_b.matched({index_a.digest(i) for i in range(len(index_a)) if matched_a[i]})
+		rows = itertools.chain(((index_a.ids[i], self.dir_a.id, matched_a[i] == 1, None) for i in range(len(index_a))),
+			((index_b.ids[i], self.dir_b.id, matched_b[i] == 1, None) for i in range(len(index_b))))
+		self._collect_results(rows, session)
+	
+	
+	def _collect_results(self, rows, session):
+		"""fill results from rows (file_id, dir_id, matched, file), see compare_in_db. file is row with id, full_path and checksum
+		of file, or None, then files that are only on one dir are read by their ids"""
+		# files are matched if there is a copy in other dir and at least one of dirs is enabled, as in compare_in_memory
+		can_match = self.dir_a.enabled is True or self.dir_b.enabled is True
+		self._files_a_count = 0
+		self._files_b_count = 0
+		only_on_a = []
+		only_on_b = []
+		for file_id, dir_id, matched, f in rows:
+			if dir_id == self.dir_a.id:
+				self._files_a_count += 1
+				if matched and can_match:
+					self.files_a_on_b.append(file_id)
+				else:
+					only_on_a.append(f if f is not None else file_id)
+			else:
+				self._files_b_count += 1
+				if matched and can_match:
+					self.files_b_on_a.append(file_id)
+				else:
+					only_on_b.append(f if f is not None else file_id)
+		self.progress = 0.5
+		self.files_on_both = self.files_a_on_b + self.files_b_on_a
+		self.files_only_on_a = self._get_file_rows(only_on_a, session)
+		self.files_only_on_b = self._get_file_rows(only_on_b, session)
+		# pairs are found by one sorted query in DB, paths of all files are not loaded
+		self.equal_names_diff_checsums = list(self._file_manager.find_equal_names_diff_checksums(self.dir_a, self.dir_b, session))
+		self.progress = 1.0
+	
+	
+	def _get_file_rows(self, files, session):
+		"""items of files are rows or ids of files, ids are replaced by rows read from DB"""
+		ids = [f for f in files if isinstance(f, int)]
+		if len(ids) == 0:
+			return files
+		rows_by_id = {r.id: r for r in self._file_manager.get_file_rows(ids, session = session)}
+		return [rows_by_id[f] if isinstance(f, int) else f for f in files if not isinstance(f, int) or f in rows_by_id]
+	
+	
+	def select_engine(self, session):
+		"""returns memory, index or sql"""
+		if not self._can_compare_in_db():
+			return "memory"
+		if self.engine in ("memory", "index", "sql"):
+			return self.engine
+		num_files = self._file_manager.get_count(self.dir_a.id, session = session) + self._file_manager.get_count(self.dir_b.id, session = session)
+		# index is not faster than sql on any size by benchmark.py compare, and smaller dirs are compared in milliseconds by any engine
+		return "sql" if num_files >= self.SQL_ENGINE_MIN_FILES else "memory"
+	
+	
+	def _can_compare_in_db(self):
+		# dir that is not saved (i.e. actual state of dir in CheckDirTask) has files only in memory
+		return self.dir_a.id is not None and self.dir_b.id is not None and self.dir_a.id != self.dir_b.id
+	
+	
 	def run(self):
-		def sub_compare():
-			pass
 		self.mark_task_start()
 		self._logger.debug("run: checking files on both A and B")
 		try:
 			_session = self.get_session()
 			_session.add(self.dir_a)
 			_session.add(self.dir_b)
-			
-			len_dir_a_files = len(self.dir_a.files)
-			len_dir_b_files = len(self.dir_b.files)
-			len_all_files = len_dir_a_files + len_dir_b_files
-			
-			for fa in self.dir_a.files:
-				self.progress += 0.25 / len_all_files
-				self._logger.debug(f"run: checking for both A and B file {fa.full_path} - {fa.checksum}")
-				candidates = self._file_manager.get_by_checksum(fa.checksum, idir = self.dir_b, session = _session)
-				tmp_c_str = "input_checksum is " + fa.checksum + "; "
-				for c in candidates:
-					tmp_c_str += c.full_path + " - " + c.checksum + ", "
-				self._logger.debug(f"got candidates: {tmp_c_str}")
-				for c in candidates:
-					if c.dir is None:
-						self._logger.error(f"run: error dir is None!")
-						continue
-					self._logger.debug(f"c {c.checksum} d {c.dir.id}")
-					if c.dir.id == self.dir_b.id:
-						if c.dir != self.dir_b:
-							self._logger.error(f"run: dirs are not equal!")
-						if fa not in self.files_on_both:
-							self._logger.debug(f"run: added to files_on_both fa: {fa.full_path} because {fa.checksum} == {c.checksum}, candidate: {c.full_path}")
-							self.files_on_both.append(fa)
-							self.files_a_on_b.append(fa)
-						if c not in self.files_on_both:
-							self._logger.debug(f"run: added to files_on_both c: {c.full_path} because {c.checksum} == {fa.checksum}, fa: {fa.full_path}")
-							self.files_on_both.append(c)
-							self.files_b_on_a.append(c)
-						if fa in self.files_on_both and c in self.files_on_both:
-							self._logger.debug(f"run: did not added candidate {c.full_path} and file {fa.full_path}")
-					else:
-						self._logger.debug(f"run: candidate {c.full_path} for {fa.full_path} is from wrong dir")
-			for fb in self.dir_b.files:
-				self.progress += 0.25 / len_all_files
-				self._logger.debug(f"run: checking for both A and B file {fb.full_path} - {fb.checksum}")
-				candidates = self._file_manager.get_by_checksum(fb.checksum, idir = self.dir_a, session = _session)
-				# fb_has_copy = False
-				tmp_c_str = "input_checksum is " + fb.checksum + "; "
-				for c in candidates:
-					tmp_c_str += c.full_path + " - " + c.checksum + ", "
-				self._logger.debug(f"got candidates: {tmp_c_str}")
-				for c in candidates:
-					if c.dir is None:
-						self._logger.error(f"run: error dir is None!")
-						continue
-					if c.dir.id == self.dir_a.id:
-						if c.dir != self.dir_a:
-							self._logger.error(f"run: dirs are not equal!")
-						if fb not in self.files_on_both:
-							self._logger.debug(f"run: added to files_on_both fb: {fb.full_path} because {fb.checksum} == {c.checksum}, candidate: {c.full_path}")
-							self.files_on_both.append(fb)
-							self.files_b_on_a.append(fb)
-						if c not in self.files_on_both:
-							self._logger.debug(f"run: added to files_on_both c: {c.full_path} because {c.checksum} == {fb.checksum}, fa: {fb.full_path}")
-							self.files_on_both.append(c)
-							self.files_a_on_b.append(c)
-			self._logger.debug("run: checking files only on A and B")
-			for fa in self.dir_a.files:
-				self.progress += 0.25 / len_all_files
-				self._logger.debug(f"run: checking for only on A and B file {fa.full_path} - {fa.checksum}")
-				if fa not in self.files_on_both:
-					self._logger.debug(f"run: adding to files_only_on_a: {fa.full_path}")
-					self.files_only_on_a.append(fa)
-			for fb in self.dir_b.files:
-				self.progress += 0.25 / len_all_files
-				self._logger.debug(f"run: checking for only on A and B file {fb.full_path} - {fb.checksum}")
-				if fb not in self.files_on_both:
-					self._logger.debug(f"run: adding to files_only_on_b: {fb.full_path}")
-					self.files_only_on_b.append(fb)
+			engine = self.select_engine(_session)
+			self._logger.debug(f"run: will compare using {engine} engine")
+			if engine == "sql":
+				self.compare_in_db(_session)
+			elif engine == "index":
+				self.compare_in_index(_session)
+			else:
+				self.compare_in_memory()
 			self.check_dirs_equal()
 			self._logger.info(f"run: Totals: files_on_both: {len(self.files_on_both)}, files_a_on_b: {len(self.files_a_on_b)}, files_b_on_a: {len(self.files_b_on_a)}, files_only_on_a: {len(self.files_only_on_a)}, files_only_on_b: {len(self.files_only_on_b)}")
 			self._logger.debug("run: complete")
@@ -457,7 +865,7 @@ class CompareDirsTask(BaseTask):
 	
 	
 	def check_dirs_equal(self):
-		if len(self.files_on_both) == (len(self.dir_a.files) + len(self.dir_b.files)) and len(self.files_only_on_a) == 0 and len(self.files_only_on_b) == 0:
+		if len(self.files_on_both) == (self.files_a_count + self.files_b_count) and len(self.files_only_on_a) == 0 and len(self.files_only_on_b) == 0:
 			self._logger.info("run: dir A equal dir B")
 			self.dirs_are_equal = True
 			self.mark_result_OK()
@@ -473,8 +881,8 @@ class CompareDirsTask(BaseTask):
 			# return f"Task result is not ready. Current task status: {self.state}"
 		# self.report = f"{self.descr}" + "\n"
 		self.report = f"Directory comparation status: {self.state}" + ".\n"
-		self.report += f"Directory A: {self.dir_a.full_path}, {len(self.dir_a.files)} files." + "\n"
-		self.report += f"Directory B: {self.dir_b.full_path}, {len(self.dir_b.files)} files." + "\n"
+		self.report += f"Directory A: {self.dir_a.full_path}, {self.files_a_count} files." + "\n"
+		self.report += f"Directory B: {self.dir_b.full_path}, {self.files_b_count} files." + "\n"
 		self.report += "\n\n"
 		if self.dirs_are_equal:
 			self.report += "<span style=\"color: green;\">DIRS ARE EQUAL.</span>\n\n"
@@ -506,8 +914,9 @@ class CompareDirsTask(BaseTask):
 			self.report += f"f: {f.full_path} - {f.checksum}" + "\n"
 		self.report += "\n\n"
 		self.report += f"Files with equal names but different checsums: {len(self.equal_names_diff_checsums)}" + "\n"
-		for f in self.equal_names_diff_checsums:
-			self.report += f"f: {f.full_path} - {f.checksum}" + "\n"
+		for fa, fb in self.equal_names_diff_checsums:
+			self.report += f"f: {fa.full_path} - {fa.checksum}" + "\n"
+			self.report += f"   {fb.full_path} - {fb.checksum}" + "\n"
 		self.report += "\n\n"
 		self.report += f"Task took: {self.duration}s"
 		self.report += "\n\n"
@@ -516,6 +925,165 @@ class CompareDirsTask(BaseTask):
 	
 	
 	
+class CompareMultipleDirsTask(BaseTask):
+	"""Task to compare N dirs at once, i.e. original (first dir) and its copies. Files of each dir are loaded once,
+	all pairs of dirs are compared using one index of all checksums"""
+	
+	def __init__(self, input_dir_list,
+		target_freeform = None,
+		logger = None,
+		db_manager = None,
+		file_manager = None,
+		dir_manager = None,
+		task_manager = None):
+		super(CompareMultipleDirsTask, self).__init__(logger = logger,
+			db_manager = db_manager,
+			file_manager = file_manager,
+			dir_manager = dir_manager,
+			task_manager = task_manager)
+		self.input_dirs = input_dir_list
+		self.target_freeform = target_freeform if target_freeform is not None else ";".join([str(d.id) for d in self.input_dirs])
+		self.coverage = {} # digest of (checksum, checksum_algorithm), see FileIndex: bitmask of dirs with this checksum, bit i is set for input_dirs[i]
+		self.files_count = [] # number of files of each dir
+		self.files_on = {} # (i, j): number of files of dir i that exist in dir j
+		self.files_not_on_all = [] # tuples (file id, bitmask) for files which are not in all dirs, one file for each checksum
+		self.shown_files_not_on_all = [] # tuples (file, bitmask) for first _MAX_FILES_SHOWN of files_not_on_all
+		self.descr = f"{self._type} for {len(self.input_dirs)} dirs: {[d.id for d in self.input_dirs]}"
+	
+	
+	def reinit(self):
+		self.input_dirs = [self._dir_manager.get_by_id(int(dir_id)) for dir_id in self.target_freeform.split(";")]
+	
+	
+	@property
+	def all_dirs_mask(self):
+		return (1 << len(self.input_dirs)) - 1
+	
+	
+	def is_subset(self, i, j):
+		"""True if all files of dir i exist in dir j"""
+		return self.files_on.get((i, j), 0) == self.files_count[i]
+	
+	
+	def are_equal(self, i, j):
+		return self.is_subset(i, j) and self.is_subset(j, i)
+	
+	
+	def compare(self, session):
+		"""one pass over files of all dirs: build coverage of checksums, then count files of each dir by coverage mask,
+		so number of files of dir i on dir j is sum of counts for masks with bit j"""
+		self.coverage = {}
+		self.files_count = []
+		self.files_on = {}
+		self.files_not_on_all = []
+		self.shown_files_not_on_all = []
+		indexes = []
+		for i, idir in enumerate(self.input_dirs):
+			# files are loaded as compact index, without File objects
+			index = self._file_manager.get_file_index([idir.id], session = session)
+			indexes.append(index)
+			self.files_count.append(len(index))
+			for j, digest in index.iter_digests():
+				self.coverage[digest] = self.coverage.get(digest, 0) | (1 << i)
+			self.progress = 0.5 * (i + 1) / len(self.input_dirs)
+		masks_count = []
+		reported = set()
+		for i, index in enumerate(indexes):
+			counts = {}
+			for j in range(len(index)):
+				digest = index.digest(j)
+				mask = self.coverage.get(digest, 0) if index.has_checksum[j] else 0
+				counts[mask] = counts.get(mask, 0) + 1
+				if mask != self.all_dirs_mask and digest not in reported:
+					reported.add(digest)
+					self.files_not_on_all.append((index.ids[j], mask))
+			masks_count.append(counts)
+		shown = self.files_not_on_all[0:self._MAX_FILES_SHOWN]
+		files_by_id = {f.id: f for f in self._file_manager.get_by_ids([file_id for file_id, mask in shown], session = session)}
+		self.shown_files_not_on_all = [(files_by_id[file_id], mask) for file_id, mask in shown]
+		for i, idir_a in enumerate(self.input_dirs):
+			for j, idir_b in enumerate(self.input_dirs):
+				# files are matched if at least one of dirs is enabled, as in CompareDirsTask
+				if i == j or (idir_a.enabled is not True and idir_b.enabled is not True):
+					self.files_on[(i, j)] = self.files_count[i] if i == j else 0
+					continue
+				self.files_on[(i, j)] = sum([count for mask, count in masks_count[i].items() if mask & (1 << j)])
+		self.progress = 1.0
+	
+	
+	def run(self):
+		self.mark_task_start()
+		_session = None
+		try:
+			_session = self.get_session()
+			for d in self.input_dirs:
+				_session.add(d)
+			self.compare(_session)
+			# first dir is original, result is OK if each copy contains all its files
+			if all([self.is_subset(0, j) for j in range(1, len(self.input_dirs))]):
+				self.mark_result_OK()
+			else:
+				self.mark_result_failure()
+			self._logger.info(f"run: compared {len(self.input_dirs)} dirs, {len(self.coverage)} unique checksums, {len(self.files_not_on_all)} of them are not in all dirs")
+			self.mark_task_OK()
+		except Exception as e:
+			self._logger.error(f"run: got error while running: {e}, traceback: {traceback.format_exc()}")
+			self.mark_task_FAIL()
+		self.mark_task_end()
+		self.generate_report()
+		if _session is not None:
+			self.close_session(_session)
+		self.save_task()
+	
+	
+	def _mask_to_str(self, mask):
+		return " ".join(["X" if mask & (1 << i) else "-" for i in range(len(self.input_dirs))])
+	
+	
+	def generate_report(self):
+		self.report = f"Multiple directories comparation status: {self.state}" + ".\n"
+		for i, idir in enumerate(self.input_dirs):
+			self.report += f"Dir {i}: {idir.url_html_code}, {self.files_count[i] if i < len(self.files_count) else 0} files." + "\n"
+		self.report += "\n\n"
+		if not self.complete:
+			# comparison failed, files_on may be filled only for some dirs
+			self.report += "<span style=\"color: red;\">Comparison failed, see log for details.</span>\n\n"
+			self.report += f"Task took: {self.duration}s"
+			self.report += "\n\n"
+			return self.report
+		if self.result_OK:
+			self.report += "<span style=\"color: green;\">ALL COPIES CONTAIN ALL FILES OF DIR 0.</span>\n\n"
+		else:
+			self.report += "<span style=\"color: red;\">Not all copies contain all files of dir 0.</span>\n\n"
+		self.report += "Files of dir (row) that exist in dir (column), = - dirs are equal, < - row is subset of column:" + "\n"
+		self.report += "dir | " + " | ".join([f"{j:>10}" for j in range(len(self.input_dirs))]) + "\n"
+		for i in range(len(self.files_count)):
+			cells = []
+			for j in range(len(self.files_count)):
+				flag = "=" if self.are_equal(i, j) else ("<" if self.is_subset(i, j) else " ")
+				cells.append(f"{self.files_on[(i, j)]:>9}{flag}")
+			self.report += f"{i:>3} | " + " | ".join(cells) + "\n"
+		self.report += "\n\n"
+		self.report += f"Unique checksums: {len(self.coverage)}, by dirs that contain them:" + "\n"
+		patterns = {}
+		for mask in self.coverage.values():
+			patterns[mask] = patterns.get(mask, 0) + 1
+		for mask, count in sorted(patterns.items(), key = lambda item: item[1], reverse = True):
+			self.report += f"{self._mask_to_str(mask)}: {count}" + "\n"
+		self.report += "\n\n"
+		self.report += f"Files that are not in all dirs: {len(self.files_not_on_all)}" + "\n"
+		for f, mask in self.shown_files_not_on_all:
+			self.report += f"{self._mask_to_str(mask)}: {f.full_path} - {f.checksum}" + "\n"
+		if len(self.files_not_on_all) > self._MAX_FILES_SHOWN:
+			self.report += f"... and {len(self.files_not_on_all) - self._MAX_FILES_SHOWN} more" + "\n"
+		self.report += "\n\n"
+		self.report += f"Task took: {self.duration}s"
+		self.report += "\n\n"
+		self._logger.debug(f"generate_report: report ready")
+		return self.report
+	
+
+
 class FindCopiesTask(BaseTask):
 	"""Task to find copies of all files of one dir. All other dirs will be searched for copies."""
 	
@@ -563,24 +1131,32 @@ class FindCopiesTask(BaseTask):
 			self.mark_result_failure()
 			self.mark_task_OK()
 			self.generate_report()
+			self.close_session(_session)
 			self.save_task()
 			return
 		try:
-			progress_increment = (1 / total_files) if total_files != 0 else 1.0
-			for f in self.dir.files:
-				self._logger.debug(f"run: checking copies of file {f.full_path}... progress: {self.progress}")
-				candidates = self._file_manager.find_copies(f, session = _session, ignore_same_fullpath = self.ignore_same_fullpath)
-				if len(candidates) == 0:
-					self._logger.debug(f"run: got no candidates for file {f}")
-				self.progress += progress_increment
-				for c in candidates:
-					if c.dir == self.dir or (c.dir.full_path == self.dir.full_path and self.ignore_same_fullpath is True):
-						self._logger.debug(f"run: ignoring candidate {c.id} - {c.full_path} because it has the same dir {c.dir.full_path}. progress: {self.progress}")
-						continue
-					if f.name == c.name:
-						self.file_dict[f].append(c)
-					else:
-						self._logger.info(f"run: should add file {c.full_path} as copy, but it has different name. original name is {f.name}. So did not add. progress: {self.progress}")
+			files_by_id = {f.id: f for f in self.dir.files}
+			checked_files = set()
+			if any([self._file_manager.may_have_copies(f.checksum, f.checksum_algorithm) for f in self.dir.files]):
+				# copies of all files are found by one query and read as stream, ordered by original file
+				copies = self._file_manager.find_copies_of_dir(self.dir.id, _session, ignore_same_fullpath = self.ignore_same_fullpath)
+			else:
+				self._logger.debug(f"run: checksums of all files are unique, DB will not be queried")
+				copies = []
+			for f_id, c in copies:
+				f = files_by_id[f_id]
+				if f_id not in checked_files:
+					checked_files.add(f_id)
+					self.progress = len(checked_files) / total_files
+					self._logger.debug(f"run: checking copies of file {f.full_path}... progress: {self.progress}")
+				if c.dir == self.dir or (c.dir.full_path == self.dir.full_path and self.ignore_same_fullpath is True):
+					self._logger.debug(f"run: ignoring candidate {c.id} - {c.full_path} because it has the same dir {c.dir.full_path}. progress: {self.progress}")
+					continue
+				if f.name == c.name:
+					self.file_dict[f].append(c)
+				else:
+					self._logger.info(f"run: should add file {c.full_path} as copy, but it has different name. original name is {f.name}. So did not add. progress: {self.progress}")
+			self._logger.debug(f"run: got candidates for {len(checked_files)} files of {total_files}")
 			self._logger.debug("run: file checking complete, file_dict filled.")
 			self._logger.debug("run: run complete.")
 			self.mark_task_OK()
@@ -630,16 +1206,19 @@ class FindCopiesTask(BaseTask):
 		self._logger.debug("generate_report: stage 2 complete")
 		self.report += "Copies:\n"
 		
+		# will generate sets for readability, sets of original are the same for all copies
+		set_path_origin = set([f.full_path for f in self.dir.files])
+		set_checksum_origin = set([f.checksum for f in self.dir.files])
 		for d in self.copies_dict.keys():
-			# will generate sets for readability 
-			set_path_origin = set([f.full_path for f in self.dir.files])
-			set_checksum_origin = set([f.checksum for f in self.dir.files])
-			set_path_copy = set([f.full_path for f in self.copies_dict[d]])
-			set_checksum_copy = set([f.checksum for f in self.copies_dict[d]])
-			set_path_copy_dir = set([f.full_path for f in d.files])
-			set_checksum_copy_dir = set([f.checksum for f in d.files])
+			# dir with the same fingerprint has the same relative paths and checksums of files, so it is exact copy without comparing sets
+			same_fingerprint = self.dir.fingerprint is not None and d.fingerprint == self.dir.fingerprint
+			if not same_fingerprint:
+				set_path_copy = set([f.full_path for f in self.copies_dict[d]])
+				set_checksum_copy = set([f.checksum for f in self.copies_dict[d]])
+				set_path_copy_dir = set([f.full_path for f in d.files])
+				set_checksum_copy_dir = set([f.checksum for f in d.files])
 			# and use these sets
-			if set_path_copy == set_path_origin and set_checksum_copy_dir == set_checksum_origin:
+			if same_fingerprint or (set_path_copy == set_path_origin and set_checksum_copy_dir == set_checksum_origin):
 				# exact full copy
 				self.dir_has_full_copy = True
 				self.full_copies_list.append(d)
@@ -660,6 +1239,17 @@ class FindCopiesTask(BaseTask):
 				self.report += f"Copy: {d.full_path} - [<a href='{d.url}' title='show dir'>show dir</a>] -- <span style=\"color: red;\">ERROR!</span> -- copy has {len(self.copies_dict[d])} files out of original {len(self.dir.files)} files, copy dir has {len(d.files)} files total" + "\n"
 		
 		self.report += "\n\n"
+		# dir without files has no fingerprint, empty dirs are not reported as copies of each other
+		if self.dir.fingerprint is not None:
+			self.report += "Exact copies in all dirs (found by fingerprint):\n"
+			for d in self._dir_manager.get_by_fingerprint(self.dir.fingerprint):
+				if d.id != self.dir.id and d.enabled is True:
+					self.report += f"Copy: {d.url_html_code}" + "\n"
+			self.report += "Copies with the same files, names of files may differ (found by content fingerprint):\n"
+			for d in self._dir_manager.get_by_fingerprint(self.dir.content_fingerprint, content_only = True):
+				if d.id != self.dir.id and d.enabled is True and d.fingerprint != self.dir.fingerprint:
+					self.report += f"Copy: {d.url_html_code}" + "\n"
+		self.report += "\n\n"
 		self._logger.debug("generate_report: stage 3 complete")
 		self.report += "All files:\n"
 		if len(self.file_dict.keys()) > 2 * self._MAX_FILES_SHOWN:
@@ -672,6 +1262,93 @@ class FindCopiesTask(BaseTask):
 		
 
 
+class FindSimilarDirsTask(BaseTask):
+	"""Task to find dirs with mostly the same files as target dir, i.e. partial backups. Dirs are compared by MinHash signatures
+	of checksums of their files, candidates are found with LSH index over signatures of all enabled dirs"""
+	
+	def __init__(self, target_dir,
+		target_dir_id = None,
+		logger = None,
+		db_manager = None,
+		file_manager = None,
+		dir_manager = None,
+		task_manager = None,
+		threshold = 0.8):
+		super(FindSimilarDirsTask, self).__init__(logger = logger,
+			db_manager = db_manager,
+			file_manager = file_manager,
+			dir_manager = dir_manager,
+			task_manager = task_manager)
+		self.dir = target_dir
+		self.target_dir_id = target_dir.id
+		self.threshold = threshold # minimal estimated Jaccard similarity of sets of checksums
+		self.similar_dirs = [] # tuples (dir, estimated similarity), most similar first
+		self.dirs_indexed = 0
+		self.lookup_duration = 0.0
+		self.descr = f"{self._type} for dir {self.dir.id} - ../{os.path.split(self.dir.full_path)[-1]}"
+	
+	
+	def reinit(self):
+		self.dir = self._dir_manager.get_by_id(int(self.target_dir_id), full = False)
+	
+	
+	def update_signatures(self):
+		"""compute signatures of dirs that lost them when their files were removed"""
+		dir_ids = self._dir_manager.get_ids_without_minhash()
+		for dir_id in dir_ids:
+			self._dir_manager.compute_fingerprints(dir_id)
+		self._logger.debug(f"update_signatures: computed signatures of {len(dir_ids)} dirs")
+	
+	
+	def run(self):
+		self._logger.info(f"run: starting with dir {self.dir.full_path}")
+		self.mark_task_start()
+		try:
+			self.update_signatures()
+			self.progress = 0.5
+			t_start = time.time()
+			index = LSHIndex()
+			for dir_id, minhash in self._dir_manager.get_minhash_list():
+				index.add(dir_id, parse_minhash(minhash))
+			self.dirs_indexed = len(index)
+			target_values = index.get(self.dir.id)
+			if target_values is None:
+				# disabled dir is not in index
+				target_values = parse_minhash(self._dir_manager.get_by_id(self.dir.id, full = False).minhash)
+			if target_values is not None:
+				for dir_id, similarity in index.query(target_values, threshold = self.threshold):
+					if dir_id != self.dir.id:
+						self.similar_dirs.append((self._dir_manager.get_by_id(dir_id, full = False), similarity))
+			self.lookup_duration = time.time() - t_start
+			self._logger.info(f"run: found {len(self.similar_dirs)} similar dirs among {self.dirs_indexed} dirs in {self.lookup_duration:.3f}s")
+			if len(self.similar_dirs) != 0:
+				self.mark_result_OK()
+			else:
+				self.mark_result_failure()
+			self.mark_task_OK()
+		except Exception as e:
+			self._logger.error(f"run: got error {e}, traceback: {traceback.format_exc()}")
+			self.mark_task_FAIL()
+		self.mark_task_end()
+		self.generate_report()
+		self.save_task()
+	
+	
+	def generate_report(self):
+		self.report = f"{self.descr}" + "\n"
+		self.report += f"Status: {self.state}" + "\n\n"
+		self.report += f"Dir: {self.dir.url_html_code}" + "\n"
+		self.report += f"Dirs with at least {self.threshold * 100:.0f}% of the same files (estimated Jaccard similarity of checksums): {len(self.similar_dirs)}" + "\n"
+		for d, similarity in self.similar_dirs:
+			self.report += f"{similarity * 100:.0f}% - {d.url_html_code}" + "\n"
+		self.report += "\n\n"
+		self.report += f"Searched in {self.dirs_indexed} dirs in {self.lookup_duration:.3f}s" + "\n"
+		self.report += f"Task took: {self.duration}s"
+		self._logger.debug(f"generate_report: report ready")
+		return self.report
+	
+
+
 class CheckDirTask(BaseTask):
 	"""CheckDirTask - task to check if dir in DB is actual (each file has really the save checksum as stated in DB)"""
 	
@@ -681,7 +1358,15 @@ class CheckDirTask(BaseTask):
 		file_manager = None,
 		dir_manager = None,
 		task_manager = None,
-		checksum_algorithm = "md5"):
+		checksum_algorithm = "md5",
+		block_size = DEFAULT_BLOCK_SIZE,
+		hash_cache_manager = None,
+		paranoid = False,
+		tree_threshold = 0,
+		tree_chunk_size = DEFAULT_TREE_CHUNK_SIZE,
+		read_order = "listing",
+		use_fadvise = True,
+		rate_limit = 0):
 		super(CheckDirTask, self).__init__(logger = logger,
 			db_manager = db_manager,
 			file_manager = file_manager,
@@ -693,6 +1378,14 @@ class CheckDirTask(BaseTask):
 		self.subtask_add = None
 		self.subtask_compare = None
 		self.checksum_algorithm = checksum_algorithm
+		self.block_size = block_size
+		self._hash_cache_manager = hash_cache_manager
+		self.paranoid = paranoid # hash all files ignoring hash cache, i.e. to detect bit rot
+		self.tree_threshold = tree_threshold
+		self.tree_chunk_size = tree_chunk_size
+		self.read_order = read_order
+		self.use_fadvise = use_fadvise
+		self.rate_limit = rate_limit
 		self.descr = f"{self._type} for dir {self.dir.id} - ../{os.path.split(self.dir.full_path)[-1]}"
 		
 	
@@ -715,6 +1408,11 @@ class CheckDirTask(BaseTask):
 	
 	
 	def init_subtask_add(self):
+		# actual checksums should be calculated with the same algorithm as the saved ones
+		# (large files can have tree checksum with the same algorithm of chunks)
+		dir_algorithms = set([base_checksum_algorithm(f.checksum_algorithm) for f in self.dir.files if f.checksum_algorithm is not None])
+		if len(dir_algorithms) == 1:
+			self.checksum_algorithm = dir_algorithms.pop()
 		self.subtask_add = AddDirTask(self.dir.full_path,
 			logger = self._logger.getChild("SubTask_AddDirTask_"),
 			db_manager = self._db_manager,
@@ -722,8 +1420,18 @@ class CheckDirTask(BaseTask):
 			dir_manager = self._dir_manager,
 			task_manager = self._task_manager,
 			is_etalon = self.dir.is_etalon,
-			checksum_algorithm = self.checksum_algorithm)
+			checksum_algorithm = self.checksum_algorithm,
+			block_size = self.block_size,
+			hash_cache_manager = self._hash_cache_manager,
+			paranoid = self.paranoid,
+			tree_threshold = self.tree_threshold,
+			tree_chunk_size = self.tree_chunk_size,
+			read_order = self.read_order,
+			use_fadvise = self.use_fadvise,
+			rate_limit = self.rate_limit)
 		self.subtask_add.save_disabled = True
+		# tree or ordinary checksum is chosen for each file by its saved algorithm, not by current tree_threshold
+		self.subtask_add.stored_algorithms = {f.full_path: f.checksum_algorithm for f in self.dir.files}
 		self._logger.debug(f"init_subtask_add: adding subtask AddDirTask, target_dir_full_path is: {self.dir.full_path}")
 	
 	
@@ -828,7 +1536,7 @@ class SplitDirTask(BaseTask):
 		self.target_dir_id = target_dir.id
 		self.subdirs = []
 		self.subdir_path_dict = dict()
-		self.descr = f"{self._type} for dir {self.dir_obj.id} - ../{os.path.split(self.dir_obj)[-1]}"
+		self.descr = f"{self._type} for dir {self.dir_obj.id} - ../{os.path.split(self.dir_obj.full_path)[-1]}"
 	
 	
 	def get_dict_of_subdirs(self):
@@ -858,17 +1566,25 @@ class SplitDirTask(BaseTask):
 		for subdir_path, subdir_files in self.subdir_path_dict.items():
 			self._logger.debug(f"create_subdirs: creating objects for subdir {subdir_path}")
 			now = datetime.datetime.now()
-			new_dir = self._dir_manager.create(subdir_path, is_etalon = self.dir_obj.is_etalon, date_added = now, date_checked = self.dir_obj.date_checked)
-			new_dir_files = []
-			for f in subdir_files:
-				# copy file into new object
-				new_file = self._file_manager.create(f.full_path, is_etalon = f.is_etalon, date_added = now, date_checked = f.date_checked)
-				new_file.checksum = f.checksum
-				new_dir_files.append(new_file)
-				pass
-			new_dir.files = new_dir_files
+			new_dir = self._dir_manager.create(subdir_path,
+				is_etalon = self.dir_obj.is_etalon,
+				date_added = now,
+				date_checked = self.dir_obj.date_checked,
+				name = os.path.basename(subdir_path))
+			# copy files into new dir
+			self._file_manager.bulk_create([{"full_path": f.full_path,
+				"checksum": f.checksum,
+				"checksum_algorithm": f.checksum_algorithm,
+				"extra_checksums": f.extra_checksums_dict,
+				"is_etalon": f.is_etalon,
+				"date_added": now,
+				"date_checked": f.date_checked,
+				"st_size": f.st_size,
+				"st_mtime_ns": f.st_mtime_ns,
+				"st_ino": f.st_ino,
+				"st_dev": f.st_dev} for f in subdir_files],
+				dir_id = new_dir.id)
 			self.subdirs.append(new_dir)
-			self._dir_manager.update(new_dir)
 			self.progress += progress_increment
 	
 	
@@ -887,7 +1603,7 @@ class SplitDirTask(BaseTask):
 		self.report += f"Directory {self.dir_obj.full_path} split status: {self.state}" + ".\n\n"
 		self.report += "Added dirs:"
 		for d in self.subdirs:
-			self.report += f"Dir {d.full_path} ({len(d.files)} files)"
+			self.report += f"Dir {d.full_path} ({len(self.subdir_path_dict[d.full_path])} files)"
 		self.report += "\n" + f"Task took: {secs_to_hrf(self.duration)}"
 		self._logger.debug(f"generate_report: report ready")
 		return self.report
@@ -928,16 +1644,11 @@ class CompileDirTask(BaseTask):
 		
 	
 	def get_unique_file_list(self, session = None):
-		unique_checksums = set([f.checksum for f in self.all_files_list])
-		self._logger.info(f"get_unique_file_list: got {len(unique_checksums)} unique_checksums")
-		self._logger.debug(f"get_unique_file_list: unique_checksums are: {unique_checksums}")
-		# algo take 1 - simply by checksums
-		for uc in unique_checksums:
-			for file in self._file_manager.get_by_checksum(uc, session = session):
-				if file.dir in self.input_dirs:
-					self.unique_files.append(file)
-					self._logger.debug(f"get_unique_file_list: added file {file.full_path} to target list because its dir {file.dir.full_path} exist in input dir list")
-					break
+		"""first file (by id) for each checksum among files of enabled input dirs, found in compact index of their files"""
+		index = self._file_manager.get_file_index([idir.id for idir in self.input_dirs], session = session, enabled_only = True)
+		first_files = index.first_by_digest()
+		self._logger.info(f"get_unique_file_list: got {len(first_files)} unique checksums")
+		self.unique_files = self._file_manager.get_by_ids([index.ids[i] for i in first_files], session = session)
 		self._logger.debug(f"get_unique_file_list: got list of unique files ({len(self.unique_files)} total): {[file.full_path for file in self.unique_files]}")
 		return self.unique_files
 	
@@ -1059,6 +1770,7 @@ class DeleteDirTask(BaseTask):
 		self.target_dir_full_path = target_dir.full_path
 		self.target_dir_id = target_dir.id
 		self.deleted_files = []
+		self.BATCH_SIZE = 1000 # files are deleted in one commit by batches of this size
 		self.descr = f"{self._type} for dir id: {self.target_dir_id} - {os.path.split(self.target_dir_full_path)[-1]}"
 	
 	
@@ -1074,12 +1786,15 @@ class DeleteDirTask(BaseTask):
 		self.mark_task_start()
 		self._logger.debug(f"run: starting deletion of dir {self.target_dir_id} - {self.target_dir_full_path}")
 		try:
-			num_files = len(self.target_dir.files)
-			progress_increment = 1 / num_files if num_files != 0 else 1.0
-			for f in self.target_dir.files:
-				self._file_manager.delete(f)
-				self.deleted_files.append(str(f))
-				self.progress += progress_increment
+			files = list(self.target_dir.files)
+			num_files = len(files)
+			# files are deleted by batches, and checksum filter is rebuilt (if needed) once after all files are deleted
+			for i in range(0, num_files, self.BATCH_SIZE):
+				batch = files[i:i + self.BATCH_SIZE]
+				self._file_manager.delete_many(batch)
+				self.deleted_files += [str(f) for f in batch]
+				self.progress = (i + len(batch)) / num_files
+			self._file_manager.rebuild_checksum_filter_if_needed()
 			self._dir_manager.delete(self.target_dir)
 			self._logger.debug(f"run: complete, directory deleted")
 			self.mark_result_OK()
@@ -1094,6 +1809,82 @@ class DeleteDirTask(BaseTask):
 
 
 
+class FindAllDuplicatesTask(BaseTask):
+	"""Task to find all files with the same checksum in all enabled dirs. Files table is scanned once, grouped by checksum,
+	and groups are saved to duplicate_groups table as they are read, so ORM objects of files are not created"""
+	
+	def __init__(self, logger = None,
+		db_manager = None,
+		file_manager = None,
+		dir_manager = None,
+		task_manager = None,
+		duplicate_group_manager = None):
+		super(FindAllDuplicatesTask, self).__init__(logger = logger,
+			db_manager = db_manager,
+			file_manager = file_manager,
+			dir_manager = dir_manager,
+			task_manager = task_manager)
+		self._duplicate_group_manager = duplicate_group_manager
+		self.BATCH_SIZE = 1000
+		self.groups_count = 0
+		self.files_count = 0
+		self.wasted_bytes = 0
+		self.descr = f"{self._type} in all enabled dirs"
+	
+	
+	def reinit(self):
+		pass
+	
+	
+	def _update_progress(self, checksum):
+		# groups are read in order of checksums, and checksums are hex strings with uniform distribution
+		try:
+			self.progress = int(checksum[:4], 16) / 0x10000
+		except ValueError:
+			pass
+	
+	
+	def run(self):
+		self.mark_task_start()
+		self._logger.info("run: starting")
+		try:
+			_session = self.get_session()
+			for groups in self._duplicate_group_manager.find_groups(_session, batch_size = self.BATCH_SIZE):
+				self._duplicate_group_manager.store(self.id, groups, session = _session)
+				self.groups_count += len(groups)
+				self.files_count += sum([g["files_count"] for g in groups])
+				self.wasted_bytes += sum([g["wasted_bytes"] for g in groups])
+				self._update_progress(groups[-1]["checksum"])
+				self._logger.debug(f"run: saved {self.groups_count} groups, progress: {self.progress}")
+			self.close_session(_session, commit = True)
+			self._logger.info(f"run: complete, found {self.groups_count} groups of duplicates, {self.files_count} files, {self.wasted_bytes} bytes wasted")
+			if self.groups_count == 0:
+				self.mark_result_OK()
+			else:
+				self.mark_result_failure()
+			self.mark_task_OK()
+		except Exception as e:
+			self._logger.error(f"run: got error {e}, traceback: {traceback.format_exc()}")
+			self.close_session(_session, commit = False)
+			self.mark_task_FAIL()
+		self.mark_task_end()
+		self.generate_report()
+		self.save_task()
+	
+	
+	def generate_report(self):
+		self.report = f"{self.descr}" + "\n"
+		self.report += f"Status: {self.state}" + "\n\n"
+		self.report += f"Groups of files with the same checksum: {self.groups_count}" + "\n"
+		self.report += f"Files in these groups: {self.files_count}" + "\n"
+		self.report += f"Wasted by duplicates: {self.wasted_bytes / MIB:.1f} MiB" + "\n\n"
+		self.report += f"[<a href='/ui/show-duplicates/{self.id}' title='show groups sorted by wasted space'>show duplicates</a>]" + "\n\n"
+		self.report += f"Task took: {self.duration}s"
+		self._logger.debug(f"generate_report: report ready")
+		return self.report
+	
+
+
 # TODO: this should be extended
 class DeleteFilesTask(BaseTask):
 	"""Delete selected files"""
@@ -1109,6 +1900,7 @@ class DeleteFilesTask(BaseTask):
 			dir_manager = dir_manager,
 			task_manager = task_manager)
 		self.files_to_delete = file_list
+		self.BATCH_SIZE = 1000 # files are deleted in one commit by batches of this size
 		self.target_file_list = ",".join([f.full_path for f in file_list])
 		self.descr = f"{self._type} for {len(self.files_to_delete)} files"
 		
@@ -1116,10 +1908,11 @@ class DeleteFilesTask(BaseTask):
 	def run(self):
 		self.mark_task_start()
 		try:
-			progress_increment = 1 / len(self.files_to_delete) if len(self.files_to_delete) != 0 else 0
-			for f in self.files_to_delete:
-				self._file_manager.delete(f)
-				self.progress += progress_increment
+			for i in range(0, len(self.files_to_delete), self.BATCH_SIZE):
+				batch = self.files_to_delete[i:i + self.BATCH_SIZE]
+				self._file_manager.delete_many(batch)
+				self.progress = (i + len(batch)) / len(self.files_to_delete)
+			self._file_manager.rebuild_checksum_filter_if_needed()
 			self.mark_task_OK()
 			self.mark_result_OK()
 		except Exception as e: